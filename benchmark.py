@@ -0,0 +1,706 @@
+import asyncio
+import functools
+import http.server
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Dict, List
+
+os.environ.setdefault("ANTHROPIC_API_KEY", "benchmark")
+
+import claude
+import mock_server
+
+class FakeStream:
+    """Replays text events with a fixed gap, standing in for client.messages.stream"""
+
+    def __init__(self, chunks: List[str], gap: float, prefill: float = 0.0):
+        self.chunks = chunks
+        self.gap = gap
+        self.prefill = prefill
+        self.last_byte = 0.0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def close(self):
+        pass
+
+    async def __aiter__(self):
+        usage = SimpleNamespace(input_tokens=10, output_tokens=1, cache_read_input_tokens=0, cache_creation_input_tokens=0)
+        if self.prefill:
+            await asyncio.sleep(self.prefill)
+        yield SimpleNamespace(type="message_start", message=SimpleNamespace(usage=usage))
+        for chunk in self.chunks:
+            if self.gap:
+                await asyncio.sleep(self.gap)
+            yield SimpleNamespace(type="text", text=chunk)
+        self.last_byte = time.perf_counter()
+        yield SimpleNamespace(type="content_block_stop")
+        yield SimpleNamespace(type="message_delta", delta=SimpleNamespace(stop_reason="end_turn", stop_sequence=None),
+                              usage=SimpleNamespace(output_tokens=len(self.chunks)))
+        yield SimpleNamespace(type="message_stop")
+
+class FakeClient:
+    """Minimal stand-in exposing messages.stream
+
+    prefill_per_mb adds a delay before the first event proportional to the
+    request size, standing in for server-side prompt processing.
+    """
+
+    def __init__(self, chunks: List[str], gap: float, prefill_per_mb: float = 0.0):
+        self.chunks = chunks
+        self.gap = gap
+        self.prefill_per_mb = prefill_per_mb
+        self.streams: List[FakeStream] = []
+        self.requests: List[dict] = []
+        self.messages = self
+
+    def stream(self, **kwargs) -> FakeStream:
+        self.requests.append(kwargs)
+        size = len(json.dumps(kwargs["messages"], ensure_ascii=False).encode("utf-8"))
+        stream = FakeStream(self.chunks, self.gap, self.prefill_per_mb * size / 1e6)
+        self.streams.append(stream)
+        return stream
+
+def bench_render(tokens: int = 200, gap: float = 0.0) -> None:
+    """Measure time-to-last-byte and time-to-last-paint for several speed settings"""
+    chunks = [f"tok{i} " for i in range(tokens)]
+    print(f"render: {tokens} chunks, network gap {gap * 1000:.1f} ms")
+    for speed in (0, 0.005, 0.05):
+        fake = FakeClient(chunks, gap)
+        claude.client = fake
+        claude.local_session.speed = speed
+
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            start = time.perf_counter()
+            asyncio.run(claude.stream_with_retry([{"role": "user", "content": "hi"}], "fake"))
+            done = time.perf_counter()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        ttlb = fake.streams[-1].last_byte - start
+        print(f"  speed={speed:<6} time-to-last-byte={ttlb * 1000:8.1f} ms  time-to-last-paint={(done - start) * 1000:8.1f} ms")
+
+def serve_directory(directory: str) -> http.server.ThreadingHTTPServer:
+    """Serve a directory on a free local port from a background thread"""
+    handler = functools.partial(QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """Static file handler that does not log every request"""
+
+    def log_message(self, format, *args):
+        pass
+
+def bench_fetch(pages: int = 20, size: int = 200_000) -> None:
+    """Compare cold fetches, revalidated fetches and fresh cache hits against a local server"""
+    with tempfile.TemporaryDirectory() as root:
+        site = os.path.join(root, "site")
+        os.makedirs(site)
+        paragraph = "<p>" + "lorem ipsum dolor sit amet " * 40 + "</p>\n"
+        for i in range(pages):
+            with open(os.path.join(site, f"page{i}.html"), "w") as f:
+                f.write("<html><body>" + paragraph * (size // len(paragraph)) + "</body></html>")
+
+        server = serve_directory(site)
+        urls = [f"http://127.0.0.1:{server.server_port}/page{i}.html" for i in range(pages)]
+        cache = claude.FetchCache(os.path.join(root, "cache"))
+        fetcher = claude.WebFetcher(cache)
+
+        async def fetch_all() -> float:
+            start = time.perf_counter()
+            await asyncio.gather(*(fetcher.fetch(url) for url in urls))
+            return time.perf_counter() - start
+
+        print(f"fetch: {pages} pages of {size // 1000} kB")
+        print(f"  cold           {asyncio.run(fetch_all()) * 1000:8.1f} ms")
+        cache.ttl = 0  # Force If-Modified-Since revalidation
+        print(f"  revalidated    {asyncio.run(fetch_all()) * 1000:8.1f} ms")
+        cache.ttl = claude.FETCH_CACHE_TTL
+        print(f"  cache hit      {asyncio.run(fetch_all()) * 1000:8.1f} ms")
+
+        fetcher.close()
+        server.shutdown()
+
+# Saved pages dropped in here are added to the extraction benchmark
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_corpus")
+
+def synthetic_corpus() -> Dict[str, str]:
+    """Generated pages shaped like the ones that make scraping slow"""
+    nav = "<nav>" + "".join(f"<a href='/p{i}'>Section {i}</a>" for i in range(300)) + "</nav>"
+    docs = "".join(f"<h2>Heading {i}</h2><p>Some  documentation text about item {i} &amp; friends.</p>" for i in range(400))
+    bundle = "<script>" + "var a=function(){return 1};" * 80_000 + "</script>"
+    rows = "".join(f"<tr><td>param_{i}</td><td>string</td><td>Description of parameter {i}</td></tr>" for i in range(30_000))
+    return {
+        "docs-page": f"<html><body>{nav}<main>{docs}</main><footer>f</footer></body></html>",
+        "spa-bundle": f"<html><head>{bundle}<style>{'.x{color:red}' * 50_000}</style></head><body>{nav}<div id='app'>{docs}</div>{bundle}</body></html>",
+        "api-reference": f"<html><body>{nav}<table>{rows}</table></body></html>"
+    }
+
+def load_corpus() -> Dict[str, str]:
+    """Synthetic pages plus any saved HTML files in benchmark_corpus/"""
+    corpus = synthetic_corpus()
+    if os.path.isdir(CORPUS_DIR):
+        for name in sorted(os.listdir(CORPUS_DIR)):
+            if name.endswith((".html", ".htm")):
+                with open(os.path.join(CORPUS_DIR, name), "r", encoding="utf-8", errors="replace") as f:
+                    corpus[name] = f.read()
+    return corpus
+
+def bench_extract() -> None:
+    """Compare extraction backends on time and peak memory"""
+    backends = [name for name in claude.EXTRACTORS if name != "lxml" or claude.load_lxml() is not None]
+    print(f"extract: backends {', '.join(backends)}")
+    for name, html in load_corpus().items():
+        print(f"  {name} ({len(html) / 1e6:.1f} MB)")
+        for backend in backends:
+            tracemalloc.start()
+            start = time.perf_counter()
+            text = claude.extract_text(html, backend)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"    {backend:<7} {elapsed * 1000:8.1f} ms  peak {peak / 1e6:7.1f} MB  {len(text)} chars")
+
+def synthetic_manual(sections: int = 160) -> str:
+    """A long plain-text manual where each section documents one setting"""
+    filler = "This paragraph repeats general guidance that applies to every setting in the product. " * 12
+    return "".join(
+        f"Section {i}: setting_{i}\nThe setting_{i} option controls feature_{i}. Its default value is {i * 7} and it accepts values up to {i * 70}.\n{filler}\n\n"
+        for i in range(sections)
+    )
+
+def bench_retrieval(turns: int = 6, prefill_per_mb: float = 2.0) -> None:
+    """Compare request payload and latency of pasting a document versus attaching retrieved chunks"""
+    asked = [12, 150, 99, 47, 133, 5][:turns]
+    questions = [f"What is the default value of setting_{i} and what does it control?" for i in asked]
+    with tempfile.TemporaryDirectory() as root:
+        filename = os.path.join(root, "manual.txt")
+        with open(filename, "w") as f:
+            f.write(synthetic_manual())
+        print(f"retrieval: {os.path.getsize(filename) // 1024} kB document, {len(questions)} questions, simulated prefill {prefill_per_mb}s per MB")
+
+        claude.document_index = claude.DocumentIndex(os.path.join(root, "index.sqlite3"))
+        saved_journal = claude.local_session.journal
+        claude.local_session.journal = claude.SessionJournal(os.path.join(root, "sessions"))
+        claude.local_session.speed = 0
+        for retrieval in (False, True):
+            fake = FakeClient(["Answer. "] * 20, 0, prefill_per_mb)
+            claude.client = fake
+            claude.local_session.retrieval_enabled = retrieval
+            claude.local_session.memory.clear()
+            claude.local_session.sources.clear()
+
+            async def session() -> List[float]:
+                latencies = []
+                for i, question in enumerate(questions):
+                    start = time.perf_counter()
+                    if i == 0:
+                        await claude.handle_read_file(filename, question)
+                    else:
+                        await claude.handle_chat(question)
+                    latencies.append(time.perf_counter() - start)
+                return latencies
+
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, "w")
+            try:
+                latencies = asyncio.run(session())
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+
+            bodies = [json.dumps(request["messages"], ensure_ascii=False) for request in fake.requests]
+            sizes = [len(body.encode("utf-8")) for body in bodies]
+            # A turn is answerable when the section documenting the asked setting was sent
+            found = sum(f"The setting_{i} option" in body for i, body in zip(asked, bodies))
+            label = "retrieval" if retrieval else "full paste"
+            print(f"  {label:<10} total payload {sum(sizes) / 1024:9.1f} kB  last turn {sizes[-1] / 1024:8.1f} kB  "
+                  f"first turn {latencies[0] * 1000:7.1f} ms  later turns p50 {claude.Metrics.percentile(latencies[1:], 50) * 1000:7.1f} ms  "
+                  f"answer sent {found}/{len(bodies)}")
+        claude.document_index.close()
+        claude.local_session.journal.close()
+        claude.local_session.journal = saved_journal
+        claude.local_session.retrieval_enabled = False
+        claude.local_session.memory.clear()
+
+def bench_journal(turn_chars: int = 2000, sizes=(500, 5000)) -> None:
+    """Compare the session journal with rewriting and re-reading the whole conversation as JSON"""
+    print(f"journal: turns of {turn_chars * 2 // 1000} kB, resuming the last {claude.JOURNAL_RESUME_TURNS} turns")
+    for turns in sizes:
+        messages = []
+        for i in range(turns):
+            messages.append({"role": "user", "content": f"question {i} " + "q" * turn_chars})
+            messages.append({"role": "assistant", "content": f"answer {i} " + "a" * turn_chars})
+
+        with tempfile.TemporaryDirectory() as root:
+            whole = os.path.join(root, "conversation.json")
+            start = time.perf_counter()
+            with open(whole, "w", encoding="utf-8") as f:
+                json.dump(messages, f, indent=2)
+            rewrite = time.perf_counter() - start
+            start = time.perf_counter()
+            with open(whole, "r", encoding="utf-8") as f:
+                json.load(f)
+            full_load = time.perf_counter() - start
+
+            journal = claude.SessionJournal(os.path.join(root, "sessions"))
+            journal.append(messages[:-2])
+            start = time.perf_counter()
+            journal.append(messages[-2:])
+            append = time.perf_counter() - start
+            session_id = journal.session_id
+            journal.close()
+            path = journal.path_for(session_id)
+            start = time.perf_counter()
+            tail = claude.read_journal_tail(path)
+            tail_load = time.perf_counter() - start
+
+            print(f"  {turns:>5} turns  json {os.path.getsize(whole) / 1e6:6.1f} MB: save {rewrite * 1000:8.1f} ms  load {full_load * 1000:8.1f} ms"
+                  f"  |  journal {os.path.getsize(path) / 1e6:6.1f} MB: append turn {append * 1000:6.2f} ms  resume {tail_load * 1000:6.2f} ms ({len(tail)} messages)")
+
+def bench_e2e(tokens_per_second: float = 400, output_tokens: int = 100, turns: int = 5) -> None:
+    """Run the stream, chat, read and scrape flows against the local mock API server"""
+    from anthropic import AsyncAnthropic
+
+    settings = mock_server.MockSettings(tokens_per_second=tokens_per_second, burst=2, jitter=0.5, ttft=0.05,
+                                        prefill_per_mb=1.0, output_tokens=output_tokens, retry_after=0.05, seed=7)
+    server, url = mock_server.start_mock_server(settings)
+    saved = (claude.client, claude.retry_policy, claude.BREAKER_COOLDOWN, claude.local_session.speed, claude.fetcher, claude.local_session.journal)
+    # Built like get_client() builds it: the SDK's own retries are off, so RetryPolicy handles every failure
+    claude.client = AsyncAnthropic(base_url=url, api_key="mock", max_retries=0)
+    claude.retry_policy = claude.RetryPolicy(base_delay=0.05)
+    claude.BREAKER_COOLDOWN = 0.5
+    claude.local_session.speed = 0
+
+    with tempfile.TemporaryDirectory() as root:
+        filename = os.path.join(root, "notes.txt")
+        with open(filename, "w") as f:
+            f.write(synthetic_manual(120))
+        os.makedirs(os.path.join(root, "site"))
+        with open(os.path.join(root, "site", "page.html"), "w") as f:
+            f.write(synthetic_corpus()["docs-page"])
+        site = serve_directory(os.path.join(root, "site"))
+        claude.fetcher = claude.WebFetcher(claude.FetchCache(os.path.join(root, "cache")))
+        claude.local_session.journal = claude.SessionJournal(os.path.join(root, "sessions"))
+
+        async def stream_turns():
+            for i in range(turns):
+                await claude.stream_with_retry([{"role": "user", "content": f"question {i}"}], "mock")
+
+        async def chat_turns():
+            for i in range(turns):
+                await claude.handle_chat(f"follow-up question {i}")
+
+        async def read_file():
+            await claude.handle_read_file(filename, "What is the default of setting_42?")
+
+        async def scrape_page():
+            await claude.handle_scrape(f"http://127.0.0.1:{site.server_port}/page.html")
+
+        faults = {"rate_limit_rate": 0.15, "overload_rate": 0.05, "stream_error_rate": 0.1, "disconnect_rate": 0.2}
+        scenarios = [("stream", stream_turns, {}), ("stream+faults", stream_turns, faults),
+                     ("chat", chat_turns, {}), ("read", read_file, {}), ("scrape", scrape_page, {})]
+
+        async def run_all() -> None:
+            # One event loop for every scenario, so the SDK's pooled connections stay usable
+            for name, flow, injected in scenarios:
+                for key, value in injected.items():
+                    setattr(settings, key, value)
+                claude.local_session.memory.clear()
+                claude.metrics.records.clear()
+                retries = claude.retry_policy.total_retries
+                stdout = sys.stdout
+                sys.stdout = open(os.devnull, "w")
+                tracemalloc.start()
+                start = time.perf_counter()
+                try:
+                    await flow()
+                finally:
+                    elapsed = time.perf_counter() - start
+                    _, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                    sys.stdout.close()
+                    sys.stdout = stdout
+                for key in injected:
+                    setattr(settings, key, 0.0)
+
+                records = [r for r in claude.metrics.records if r["kind"] == "turn"]
+                answered = [r for r in records if not r.get("error")]
+                ttft = [r["ttft"] for r in answered if "ttft" in r]
+                rates = [r["tokens_per_second"] for r in answered if "tokens_per_second" in r]
+                latency = [r["latency"] for r in answered if "latency" in r]
+                line = f"  {name:<14} {len(answered)}/{len(records)} ok  {elapsed * 1000:8.1f} ms total"
+                if answered:
+                    line += (f"  ttft p50 {claude.Metrics.percentile(ttft, 50) * 1000:6.1f} ms"
+                             f"  {claude.Metrics.percentile(rates, 50):6.0f} tokens/s"
+                             f"  latency p50 {claude.Metrics.percentile(latency, 50) * 1000:7.1f} ms p90 {claude.Metrics.percentile(latency, 90) * 1000:7.1f} ms")
+                line += f"  retries {claude.retry_policy.total_retries - retries}  peak {peak / 1e6:5.1f} MB"
+                print(line)
+            await claude.client.close()
+
+        print(f"e2e: mock API at {tokens_per_second:.0f} tokens/s, {output_tokens} tokens per answer")
+        asyncio.run(run_all())
+
+        claude.fetcher.close()
+        claude.local_session.journal.close()
+        site.shutdown()
+    server.shutdown()
+    claude.client, claude.retry_policy, claude.BREAKER_COOLDOWN, claude.local_session.speed, claude.fetcher, claude.local_session.journal = saved
+    claude.local_session.memory.clear()
+
+def bench_server(clients: int = 8, turns: int = 4, max_requests: int = 4, session_requests: int = 2,
+                 tokens_per_second: float = 200, output_tokens: int = 60) -> None:
+    """Several console sessions over server mode at once: turn latency, time queued for a request slot, isolation
+
+    The first of the concurrent clients compares two models on every turn,
+    so it asks for twice the requests of the others.
+    """
+    from anthropic import AsyncAnthropic
+
+    settings = mock_server.MockSettings(tokens_per_second=tokens_per_second, ttft=0.05, output_tokens=output_tokens, seed=3)
+    server, url = mock_server.start_mock_server(settings)
+    saved = (claude.client, claude.request_slots, sys.stdout)
+    claude.client = AsyncAnthropic(base_url=url, api_key="mock", max_retries=0)
+    devnull = open(os.devnull, "w")
+    journals = tempfile.TemporaryDirectory()
+
+    async def console_client(port: int, greedy: bool) -> Dict[str, object]:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        await reader.readuntil(b"User>> ")
+        writer.write(b"settings\ns\n0\n")
+        await reader.readuntil(b"Speed changed")
+        await reader.readuntil(b"User>> ")
+        if greedy:
+            writer.write(b"multi compare\n")
+            await reader.readuntil(b"User>> ")
+        latencies = []
+        for i in range(turns):
+            start = time.perf_counter()
+            writer.write(f"question {i}\n".encode())
+            # The next prompt is printed at once, then again when the answer is done
+            await reader.readuntil(b"User>> ")
+            await reader.readuntil(b"Claude")
+            await reader.readuntil(b"User>> ")
+            latencies.append(time.perf_counter() - start)
+        writer.write(b"mem\n")
+        await reader.readuntil(b"Message memory size: ")
+        messages = int((await reader.readuntil(b" ")).decode())
+        writer.write(b"exit\n")
+        await reader.read()
+        writer.close()
+        return {"greedy": greedy, "latencies": latencies, "messages": messages}
+
+    async def run(count: int) -> str:
+        claude.request_slots = claude.RequestSlots(max_requests, session_requests)
+        console_server = claude.ConsoleServer(max_sessions=count, sessions_dir=journals.name)
+        listener = await asyncio.start_server(console_server.handle, "127.0.0.1", 0, limit=claude.SERVER_LINE_LIMIT)
+        port = listener.sockets[0].getsockname()[1]
+        claude.metrics.records.clear()
+        start = time.perf_counter()
+        results = await asyncio.wait_for(asyncio.gather(*(console_client(port, count > 1 and i == 0) for i in range(count))), 120)
+        elapsed = time.perf_counter() - start
+        listener.close()
+        await listener.wait_closed()
+
+        queued = [r.get("queued", 0.0) for r in claude.metrics.records if r["kind"] == "turn"]
+        normal = [latency for result in results if not result["greedy"] for latency in result["latencies"]]
+        greedy = [latency for result in results if result["greedy"] for latency in result["latencies"]]
+        isolated = all(result["messages"] == 2 * turns for result in results)
+        line = (f"  {count:>2} session{'s' if count != 1 else ' '}  {count * turns / elapsed:5.1f} turns/s  "
+                f"turn p50 {claude.Metrics.percentile(normal, 50) * 1000:6.0f} ms p90 {claude.Metrics.percentile(normal, 90) * 1000:6.0f} ms")
+        if greedy:
+            line += f"  comparing session p50 {claude.Metrics.percentile(greedy, 50) * 1000:6.0f} ms"
+        line += f"  queued p90 {claude.Metrics.percentile(queued, 90) * 1000:5.0f} ms  isolated {'yes' if isolated else 'NO'}"
+        return line
+
+    async def run_all() -> None:
+        for count in (1, clients):
+            # The server's own messages go to devnull; each client still gets its session's output
+            sys.stdout = claude.SessionOutput(devnull)
+            try:
+                line = await run(count)
+            finally:
+                sys.stdout = saved[2]
+            print(line)
+        await claude.client.close()
+
+    print(f"server: {turns} turns per session, {max_requests} API requests at once ({session_requests} per session), "
+          f"mock API at {tokens_per_second:.0f} tokens/s")
+    try:
+        asyncio.run(run_all())
+    finally:
+        devnull.close()
+        journals.cleanup()
+        server.shutdown()
+        claude.client, claude.request_slots, sys.stdout = saved
+
+def bench_generation(tokens_per_second: float = 200, output_tokens: int = 400, turns: int = 3, cutoff: int = 100) -> None:
+    """Latency and output tokens of full answers, answers capped by a budget or a stop sequence, and cancelled answers
+
+    Budget and stop sequence both end answers after about cutoff tokens.
+    For cancels, the delay is from cancelling the turn to the mock server
+    noticing the closed connection, and unsent tokens are what it never
+    generated.
+    """
+    from anthropic import AsyncAnthropic
+
+    settings = mock_server.MockSettings(tokens_per_second=tokens_per_second, ttft=0.05, output_tokens=output_tokens)
+    server, url = mock_server.start_mock_server(settings)
+    session = claude.local_session
+    saved = (claude.client, session.speed, dict(session.max_tokens), session.stop_sequences, sys.stdout)
+    claude.client = AsyncAnthropic(base_url=url, api_key="mock", max_retries=0)
+    session.speed = 0
+    # The mock's answer is numbered words; this one is token number cutoff
+    stop_word = mock_server.answer_tokens(cutoff + 1)[cutoff].strip()
+    scenarios = [("default budget", {}, []), (f"budget {cutoff}", {"chat": cutoff}, []), ("stop sequence", {}, [stop_word])]
+    lines = []
+
+    async def run_all() -> None:
+        for name, budgets, stops in scenarios:
+            session.max_tokens.update(budgets or saved[2])
+            session.stop_sequences = stops
+            claude.metrics.records.clear()
+            for i in range(turns):
+                await claude.stream_with_retry([{"role": "user", "content": f"question {i}"}], "mock")
+            records = [r for r in claude.metrics.records if r["kind"] == "turn" and not r.get("error")]
+            latency = [r["latency"] for r in records]
+            tokens = [r.get("output_tokens", 0) for r in records]
+            lines.append(f"  {name:<16} latency p50 {claude.Metrics.percentile(latency, 50) * 1000:7.1f} ms  "
+                         f"output tokens p50 {claude.Metrics.percentile(tokens, 50):4}  stop {records[-1].get('stop_reason')}")
+
+        session.max_tokens.update(saved[2])
+        session.stop_sequences = []
+        delays, unsent = [], []
+        for i in range(turns):
+            closed = server.RequestHandlerClass.stats.counts.get("client_closed", 0)
+            spared = server.RequestHandlerClass.stats.counts.get("tokens_unsent", 0)
+            task = asyncio.ensure_future(claude.stream_with_retry([{"role": "user", "content": f"question {i}"}], "mock"))
+            await asyncio.sleep(0.05 + cutoff / tokens_per_second)
+            task.cancel()
+            cancelled = time.perf_counter()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            # The server notices the closed connection on its next write or two
+            deadline = time.perf_counter() + 1
+            while server.RequestHandlerClass.stats.counts.get("client_closed", 0) == closed and time.perf_counter() < deadline:
+                await asyncio.sleep(0.005)
+            stats = server.RequestHandlerClass.stats
+            if stats.counts.get("client_closed", 0) > closed:
+                delays.append(stats.times["client_closed"] - cancelled)
+                unsent.append(stats.counts["tokens_unsent"] - spared)
+        if delays:
+            lines.append(f"  {'cancel':<16} server stopped p50 {claude.Metrics.percentile(delays, 50) * 1000:5.1f} ms after the cancel, "
+                         f"{claude.Metrics.percentile(unsent, 50)} of {output_tokens} tokens never generated ({len(delays)}/{turns} closes seen)")
+        else:
+            lines.append(f"  {'cancel':<16} server never saw the connection close")
+        await claude.client.close()
+
+    print(f"generation: mock API at {tokens_per_second:.0f} tokens/s, {output_tokens} tokens per full answer, {turns} turns each")
+    sys.stdout = open(os.devnull, "w")
+    try:
+        asyncio.run(run_all())
+    finally:
+        sys.stdout.close()
+        claude.client, session.speed, session.max_tokens, session.stop_sequences, sys.stdout = saved
+        server.shutdown()
+    for line in lines:
+        print(line)
+
+def bench_batch(prompts: int = 24, concurrency: int = 4, tokens_per_second: float = 200, output_tokens: int = 40) -> bool:
+    """Kill a --batch run part way, leave a torn last line, resume it, and check the ids done; returns False on a failure
+
+    claude.py runs in a subprocess against the mock API. Every prompt must
+    end up answered exactly once, and the resumed run must send only the
+    prompts the killed run had not finished.
+    """
+    settings = mock_server.MockSettings(tokens_per_second=tokens_per_second, ttft=0.05, output_tokens=output_tokens)
+    server, url = mock_server.start_mock_server(settings)
+    stats = server.RequestHandlerClass.stats
+    ids = [f"p{i:02}" for i in range(prompts)]
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, ANTHROPIC_BASE_URL=url, ANTHROPIC_API_KEY="mock")
+
+    def results_written(path: str) -> int:
+        if not os.path.exists(path):
+            return 0
+        with open(path, "rb") as f:
+            return f.read().count(b"\n")
+
+    with tempfile.TemporaryDirectory() as root:
+        prompts_path, results_path = os.path.join(root, "prompts.jsonl"), os.path.join(root, "results.jsonl")
+        with open(prompts_path, "w", encoding="utf-8") as f:
+            for i, item_id in enumerate(ids):
+                f.write(json.dumps({"id": item_id, "prompt": f"question {i}"}) + "\n")
+        command = [sys.executable, os.path.join(here, "claude.py"), "--batch", prompts_path, "--output", results_path,
+                   "--concurrency", str(concurrency)]
+
+        # Run outside the checkout so the console log and metrics land in the temporary directory
+        first = subprocess.Popen(command, cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.perf_counter() + 60
+        while results_written(results_path) < prompts // 3 and first.poll() is None and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        first.kill()
+        first.wait()
+        killed_after = results_written(results_path)
+        # A crash in the middle of a write leaves half a record behind
+        with open(results_path, "a", encoding="utf-8") as f:
+            f.write('{"id": "p00", "status": "ok", "respo')
+
+        sent = stats.counts.get("requests", 0)
+        subprocess.run(command, cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=120, check=True)
+        resent = stats.counts.get("requests", 0) - sent
+
+        records, torn = [], 0
+        with open(results_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    torn += 1
+    server.shutdown()
+
+    answered = sorted(r["id"] for r in records if r.get("status") == "ok")
+    missing = prompts - killed_after
+    once = answered == ids
+    ok = once and torn == 1 and resent == missing
+    print(f"batch: {prompts} prompts at concurrency {concurrency}, mock API at {tokens_per_second:.0f} tokens/s")
+    print(f"  killed after {killed_after} results; resumed run sent {resent} requests for {missing} missing prompts, "
+          f"every id answered once {'yes' if once else 'no'}, torn lines {torn}")
+    if not ok:
+        print("  REGRESSION: the resumed batch did not finish every prompt exactly once")
+    return ok
+
+def bench_logging(chunks: int = 20000, rounds: int = 3, api_rate: float = 100) -> None:
+    """Per-chunk cost of streaming with logging off, sampled debug events and every-chunk debug events
+
+    The added cost is also shown as a share of the gap between chunks
+    when the API streams api_rate chunks per second.
+    """
+    fake = FakeClient([f"tok{i} " for i in range(chunks)], 0)
+    saved_client = claude.client
+    claude.client = fake
+
+    def stream_time() -> float:
+        best = float("inf")
+        for _ in range(rounds):
+            start = time.perf_counter()
+            asyncio.run(claude.request_with_retry([{"role": "user", "content": "hi"}], "fake", echo=False))
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    print(f"logging: {chunks} streamed chunks, best of {rounds}; chunk gap at {api_rate:.0f} chunks/s is {1000 / api_rate:.0f} ms")
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "bench.log")
+        claude.setup_logging(path, logging.INFO)
+        baseline = stream_time()
+        print(f"  {'info (no token events)':<34} {baseline / chunks * 1e9:8.0f} ns/chunk")
+        for label, sample in (("debug, 1 in 50 chunks, queued", 50), ("debug, every chunk, queued", 1)):
+            claude.setup_logging(path, logging.DEBUG, sample)
+            elapsed = stream_time()
+            claude.stop_logging()
+            added = (elapsed - baseline) / chunks
+            print(f"  {label:<34} {elapsed / chunks * 1e9:8.0f} ns/chunk  (+{added * 1e9:6.0f} ns, {added * api_rate * 100:.3f}% of a chunk gap)  dropped {claude.log_handler.dropped}")
+
+        # Previous setup for comparison: a plain FileHandler writing on the calling thread
+        claude.setup_logging(path, logging.DEBUG, 1)
+        claude.stop_logging()
+        root_logger = logging.getLogger()
+        root_logger.removeHandler(claude.log_handler)
+        direct = logging.FileHandler(path, encoding="utf-8")
+        direct.setFormatter(claude.JsonFormatter())
+        root_logger.addHandler(direct)
+        elapsed = stream_time()
+        root_logger.removeHandler(direct)
+        direct.close()
+        added = (elapsed - baseline) / chunks
+        print(f"  {'debug, every chunk, synchronous':<34} {elapsed / chunks * 1e9:8.0f} ns/chunk  (+{added * 1e9:6.0f} ns, {added * api_rate * 100:.3f}% of a chunk gap)")
+
+    claude.setup_logging()
+    claude.client = saved_client
+
+# Cold import of claude.py must stay under this many milliseconds (median of the runs)
+STARTUP_BUDGET_MS = 150
+# Modules that must not be imported until a session needs them
+LAZY_MODULES = ("anthropic", "requests", "bs4", "lxml")
+
+def bench_startup(budget_ms: float = STARTUP_BUDGET_MS, runs: int = 5) -> bool:
+    """Time `import claude` with -X importtime in fresh interpreters; returns False on a regression"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=here + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    timings = []
+    self_times: Dict[str, int] = {}
+    eager = set()
+    with tempfile.TemporaryDirectory() as root:
+        for _ in range(runs):
+            # Run outside the checkout so the console log lands in the temporary directory
+            result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import claude"],
+                                    cwd=root, env=env, capture_output=True, text=True, check=True)
+            for line in result.stderr.splitlines():
+                if not line.startswith("import time:") or "|" not in line or "self [us]" in line:
+                    continue
+                own, cumulative, name = line[len("import time:"):].split("|")
+                name = name.strip()
+                self_times[name] = max(self_times.get(name, 0), int(own))
+                if name == "claude":
+                    timings.append(int(cumulative) / 1000)
+                if name.split(".")[0] in LAZY_MODULES:
+                    eager.add(name.split(".")[0])
+
+    median = claude.Metrics.percentile(timings, 50)
+    heaviest = sorted(self_times.items(), key=lambda item: item[1], reverse=True)[:5]
+    print(f"startup: import claude p50 {median:.1f} ms, max {max(timings):.1f} ms over {runs} runs (budget {budget_ms:.0f} ms)")
+    print("  heaviest modules: " + ", ".join(f"{name} {own / 1000:.1f} ms" for name, own in heaviest))
+    ok = median <= budget_ms and not eager
+    if eager:
+        print(f"  REGRESSION: imported at startup: {', '.join(sorted(eager))}")
+    if median > budget_ms:
+        print(f"  REGRESSION: startup over budget by {median - budget_ms:.1f} ms")
+    return ok
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["startup"]:
+        sys.exit(0 if bench_startup() else 1)
+    if sys.argv[1:] == ["e2e"]:
+        bench_e2e()
+        sys.exit(0)
+    if sys.argv[1:] == ["server"]:
+        bench_server()
+        sys.exit(0)
+    if sys.argv[1:] == ["generation"]:
+        bench_generation()
+        sys.exit(0)
+    if sys.argv[1:] == ["batch"]:
+        sys.exit(0 if bench_batch() else 1)
+    startup_ok = bench_startup()
+    bench_render()
+    bench_render(gap=0.002)
+    bench_fetch()
+    bench_extract()
+    bench_retrieval()
+    bench_journal()
+    bench_e2e()
+    bench_server()
+    bench_generation()
+    batch_ok = bench_batch()
+    bench_logging()
+    if not (startup_ok and batch_ok):
+        sys.exit(1)
@@ -2,20 +2,172 @@ import asyncio
 import time
 import os
 import random
-import subprocess
-import requests
-from bs4 import BeautifulSoup
-from anthropic import AsyncAnthropic
-from typing import List, Dict, Any, Optional
+import signal
+import sys
+import threading
+from collections import OrderedDict, deque
+from html.parser import HTMLParser
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Optional, Tuple
 import json
 import logging
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    filename='claude_console.log'
-)
+import hashlib
+import hmac
+import math
+import re
+import secrets
+import shlex
+import sqlite3
+import argparse
+import atexit
+import base64
+import contextvars
+import logging.handlers
+import queue
+import zlib
+from email.utils import parsedate_to_datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows
+
+# Logging: records pass through a bounded queue to a writer thread, so callers never wait on file I/O
+LOG_FILE = "claude_console.log"
+LOG_LEVEL = logging.INFO
+LOG_MAX_BYTES = 5 * 1024 * 1024  # rotate when the file reaches this size...
+LOG_MAX_AGE = 24 * 3600  # ...or once it has been written to for this many seconds
+LOG_BACKUP_COUNT = 3
+LOG_QUEUE_SIZE = 10000  # records below WARNING arriving while the queue is full are dropped, not waited on
+LOG_TOKEN_SAMPLE = 50  # with debug logging, one per-token event for every this many streamed chunks
+# Libraries whose own debug output (per request and per chunk) is kept out of the log
+LOG_QUIET_LOGGERS = ("asyncio", "anthropic", "httpx", "httpcore", "urllib3")
+
+# Timing records kept in memory: the newest across all sessions feed --metrics-prom,
+# and each session keeps its own newest for 'stats'
+METRICS_MAX_RECORDS = 10000
+SESSION_METRICS_RECORDS = 2000
+METRICS_PROM_INTERVAL = 5.0  # seconds between rewrites of the --metrics-prom textfile
+
+# Command (turn) the current task works for; attached to every log record it emits
+current_turn: contextvars.ContextVar = contextvars.ContextVar("current_turn", default=None)
+
+# Name of that command (chat, read, scrape, ...), which selects its output budget
+current_command: contextvars.ContextVar = contextvars.ContextVar("current_command", default="chat")
+
+def new_turn_id() -> str:
+    """Short random id tying together the log records of one command"""
+    return os.urandom(6).hex()
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, message, turn id and any structured fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "message": record.getMessage()
+        }
+        for name in ("turn", "event"):
+            value = getattr(record, name, None)
+            if value:
+                entry[name] = value
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class QueueLogHandler(logging.handlers.QueueHandler):
+    """Hand records to the writer thread without blocking, tagging them with the current turn"""
+
+    def __init__(self, log_queue: queue.SimpleQueue, max_size: int = LOG_QUEUE_SIZE):
+        super().__init__(log_queue)
+        self.max_size = max_size
+        self.dropped = 0
+        self.unreported = 0  # drops not yet written to the log
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Resolve everything that depends on the calling context; formatting happens on the writer thread"""
+        # The root logger's only handler is this one, so the record is updated in place instead of copied
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.turn = current_turn.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self.queue.qsize() < self.max_size:
+            if self.unreported:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    "name": "root", "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": f"Dropped {self.unreported} log records while the log queue was full",
+                    "event": "log_dropped", "fields": {"dropped": self.unreported}, "turn": record.turn
+                }))
+                self.unreported = 0
+            self.queue.put_nowait(record)
+        elif record.levelno >= logging.WARNING:
+            # Warnings and errors are never dropped; they are rare enough not to overrun the queue
+            self.queue.put_nowait(record)
+        else:
+            self.dropped += 1
+            self.unreported += 1
+
+class RotatingLogFile(logging.handlers.RotatingFileHandler):
+    """Rotating file handler that also rolls over once the file has been in use for max_age seconds"""
+
+    def __init__(self, filename: str, max_bytes: int, max_age: float, backup_count: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.max_age = max_age
+        self.started = time.time()
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.max_age and time.time() - self.started >= self.max_age and os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename):
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self.started = time.time()
+
+log_handler: Optional[QueueLogHandler] = None
+log_listener: Optional[logging.handlers.QueueListener] = None
+# Per-token debug events are emitted for every Nth chunk; 0 turns them off
+log_token_every = 0
+
+def setup_logging(path: str = LOG_FILE, level: int = LOG_LEVEL, token_sample: int = LOG_TOKEN_SAMPLE) -> None:
+    """Send the root logger's records as JSON lines to a rotating file, written on a background thread"""
+    global log_handler, log_listener, log_token_every
+    stop_logging()
+    file_handler = RotatingLogFile(path, LOG_MAX_BYTES, LOG_MAX_AGE, LOG_BACKUP_COUNT)
+    file_handler.setFormatter(JsonFormatter())
+    # SimpleQueue is lock-free on the put side; QueueLogHandler bounds it
+    log_handler = QueueLogHandler(queue.SimpleQueue())
+    log_listener = logging.handlers.QueueListener(log_handler.queue, file_handler)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(log_handler)
+    root.setLevel(level)
+    for name in LOG_QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(max(level, logging.INFO))
+    log_token_every = max(token_sample, 1) if level <= logging.DEBUG and token_sample else 0
+    log_listener.start()
+
+def stop_logging() -> None:
+    """Write out queued records and stop the writer thread"""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        for handler in log_listener.handlers:
+            handler.close()
+        log_listener = None
+
+setup_logging()
+atexit.register(stop_logging)
 
 # ANSI color codes
 ORANGE = '\033[38;2;255;165;0m'
@@ -24,11 +176,34 @@ RED = '\033[38;2;255;0;0m'
 GREEN = '\033[38;2;0;255;0m'
 RESET = '\033[0m'
 
-# Create an async Anthropic client
-client = AsyncAnthropic()
-
-# Message memory to store conversation history
-msgMemory = []
+# Async Anthropic client, created on first use by get_client()
+client = None
+
+# anthropic, requests, bs4 and lxml are imported on first use so startup
+# does not pay for HTTP and HTML stacks a session may never need
+def get_client():
+    """The shared AsyncAnthropic client, created on first use"""
+    global client
+    if client is None:
+        from anthropic import AsyncAnthropic
+        # RetryPolicy is the only retry layer, so every retry counts against the shared budget and the breaker
+        client = AsyncAnthropic(max_retries=0)
+    return client
+
+lxml_etree = None
+lxml_checked = False
+
+def load_lxml():
+    """lxml.etree if it is installed, otherwise None"""
+    global lxml_etree, lxml_checked
+    if not lxml_checked:
+        lxml_checked = True
+        try:
+            from lxml import etree
+            lxml_etree = etree
+        except ImportError:
+            lxml_etree = None
+    return lxml_etree
 
 # Models available
 models = [
@@ -36,32 +211,183 @@ models = [
     "claude-3-5-haiku-latest"
 ]
 
-# Model to use
-model = 0
+# System prompt to guide Claude's responses, until a session changes it
+DEFAULT_PROMPT = "You are the best artificial Intelligence Model. You are to provide short concise responses to users questions in the best way possible to the following user request: "
 
-# System prompt to guide Claude's responses
-prompt = "You are the best artificial Intelligence Model. You are to provide short concise responses to users questions in the best way possible to the following user request: "
+# Frames per second used by the token renderer when batching writes to stdout
+RENDER_FPS = 60
 
-# Response speed
-speed = 0.05
+# Maximum tokens Claude may generate per response
+MAX_TOKENS = 4096
+MAX_TOKENS_LIMIT = 64000  # largest budget 'limits' accepts for a model missing from MODEL_MAX_OUTPUT
+# Most output tokens each model can write per request; the API rejects a larger max_tokens with a 400
+MODEL_MAX_OUTPUT = {"claude-3-7-sonnet-20250219": 64000, "claude-3-5-haiku-latest": 8192}
+# Output budget of each command, changed with 'limits' and kept in the config file;
+# read_chunk is the notes on one part of a file too large to send at once
+MAX_TOKENS_BY_COMMAND = {"chat": MAX_TOKENS, "read": MAX_TOKENS, "test": MAX_TOKENS, "scrape": MAX_TOKENS, "read_chunk": 1024, "batch": MAX_TOKENS}
 
 # Retry configuration
 MAX_RETRIES = 5
 BASE_DELAY = 1  # seconds
+MAX_DELAY = 60  # longest single backoff, including server retry-after hints
+RETRY_BUDGET = 10  # retries that can be spent at once across all concurrent requests
+RETRY_BUDGET_RATE = 0.5  # retries regained per second
+BREAKER_THRESHOLD = 5  # consecutive failures across requests before pausing all of them
+BREAKER_COOLDOWN = 30  # seconds
 
 # Config file path
 CONFIG_FILE = "claude_config.json"
 
+# Web fetch configuration
+FETCH_TIMEOUT = 10  # seconds
+FETCH_CONCURRENCY = 8
+FETCH_CACHE_DIR = os.path.join(".claude_cache", "web")
+FETCH_CACHE_TTL = 3600  # seconds a cached page is served without revalidation
+FETCH_CACHE_MAX_BYTES = 50 * 1024 * 1024
+# Scraped text longer than SCRAPE_TRUNCATE_AT characters is cut down to SCRAPE_KEEP_CHARS
+SCRAPE_TRUNCATE_AT = 18000
+SCRAPE_KEEP_CHARS = 8000
+# HTML extraction backend: "auto", "lxml", "stream" or "bs4"
+SCRAPE_EXTRACTOR = "auto"
+SCRAPE_SKIP_TAGS = {"script", "style", "header", "footer", "nav"}
+SCRAPE_FEED_SIZE = 64 * 1024
+# Limits for running generated Python files
+EXEC_TIMEOUT = 60  # wall-clock seconds
+EXEC_CPU_SECONDS = 30
+EXEC_MEMORY_BYTES = 1024 * 1024 * 1024  # address space limit, Linux only
+EXEC_MAX_OUTPUT = 1024 * 1024  # bytes of stdout/stderr before the process is stopped
+EXEC_TAIL_CHARS = 4000  # output kept for sending back to Claude
+EXEC_CONCURRENCY = 2  # generated files running at once, across every session
+
+# Files larger than this are answered by map-reduce over chunks instead of one message
+READ_LARGE_FILE_BYTES = 200 * 1024
+READ_CHUNK_TOKENS = 20000
+READ_MAP_CONCURRENCY = 4
+READ_NOTHING_RELEVANT = "NOTHING RELEVANT"
+
+# Local response cache
+RESPONSE_CACHE_PATH = os.path.join(".claude_cache", "responses.sqlite3")
+RESPONSE_CACHE_TTL = 7 * 24 * 3600  # seconds
+RESPONSE_CACHE_MAX_BYTES = 20 * 1024 * 1024
+
+# Local retrieval index over read and scraped documents
+INDEX_PATH = os.path.join(".claude_cache", "index.sqlite3")
+INDEX_CHUNK_CHARS = 1500
+RETRIEVAL_TOP_K = 5
+RETRIEVAL_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i", "in", "is", "it",
+    "me", "my", "of", "on", "or", "that", "the", "this", "to", "was", "what", "when", "where", "which", "who", "why",
+    "with", "you", "your"
+}
+
+# Prompt caching: messages at least this long get a cache breakpoint (roughly the 1024 token minimum)
+CACHE_MIN_CHARS = 4096
+CACHE_MAX_MESSAGE_BREAKPOINTS = 3  # the API allows four breakpoints; one goes to the system prompt
+
+# Session journal: every finished turn is appended to SESSIONS_DIR/<session>.jsonl
+SESSIONS_DIR = "sessions"
+SERVER_SESSIONS_DIR = os.path.join(SESSIONS_DIR, "server")  # one working and journal directory per server connection
+JOURNAL_FSYNC_INTERVAL = 1.0  # seconds; writes are flushed at once, fsync'd at most this often
+JOURNAL_COMPRESS_MIN = 4096  # with compression on, messages at least this many bytes are stored zlib-compressed
+JOURNAL_RESUME_TURNS = 50  # turns read back from the end of a journal when resuming
+JOURNAL_TAIL_BLOCK = 64 * 1024
+
+# Context window management
+CHARS_PER_TOKEN = 4  # rough local estimate, avoids a tokenizer dependency
+CONTEXT_KEEP_MESSAGES = 4  # most recent messages are never elided
+CONTEXT_ELIDE_CHARS = 2000  # older messages longer than this are cut down to this many characters
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+# Server mode: every connection gets its own session; the API client, caches and sandbox are shared
+SERVER_SOCKET = os.path.join(SERVER_SESSIONS_DIR, "console.sock")  # default address, in a directory only the server's user can enter
+SERVER_HOST = "127.0.0.1"  # TCP is opt-in and needs the access token; keep it local (or behind an SSH tunnel)
+SERVER_TOKEN_ENV = "CLAUDE_CONSOLE_TOKEN"  # TCP access token; a random one is printed at startup when unset
+SERVER_AUTH_TIMEOUT = 30.0  # seconds a TCP client has to send the token
+SERVER_MAX_SESSIONS = 16
+SERVER_MAX_REQUESTS = 8  # API requests in flight at once across every session
+SERVER_SESSION_REQUESTS = 3  # ...and for any one session
+SERVER_SESSION_TURNS = 4  # commands a session may have running or queued
+SERVER_LINE_LIMIT = 1024 * 1024  # longest line a client may send
+
+class Session:
+    """Conversation and settings of one console user
+
+    The local console is one session; in server mode every connection gets
+    its own. Commands find the session they run for with get_session().
+    """
+
+    def __init__(self, name: str = "local", console: Optional["ConsoleInput"] = None, output=None,
+                 config_file: Optional[str] = CONFIG_FILE, max_turns: int = 0):
+        self.name = name
+        # Message memory to store conversation history
+        self.memory: List[Dict[str, Any]] = []
+        # Index into models of the model to use
+        self.model = 0
+        # System prompt to guide Claude's responses
+        self.prompt = DEFAULT_PROMPT
+        # Response speed (seconds per streamed chunk, display only)
+        self.speed = 0.05
+        # Estimated tokens of conversation history sent with each request
+        self.context_budget = 100000
+        # Replay identical requests from the local response cache (opt-in)
+        self.response_cache_enabled = False
+        # Attach only the most relevant indexed excerpts of read/scraped documents (opt-in)
+        self.retrieval_enabled = False
+        # Send each turn to several models: "off", "compare", "race" or "draft"
+        self.multi_mode = "off"
+        # Indexes into models used by compare and race; empty means every model
+        self.multi_models: List[int] = []
+        # Output budget (max_tokens) per command, and sequences that end an answer early
+        self.max_tokens: Dict[str, int] = dict(MAX_TOKENS_BY_COMMAND)
+        self.stop_sequences: List[str] = []
+        # Documents indexed during this session; questions only search these
+        self.sources: List[str] = []
+        # Code blocks and token usage of the most recent response
+        self.last_code_blocks: List["CodeBlock"] = []
+        self.last_usage: Dict[str, int] = {}
+        # Response cache lookups of this session; the cache itself is shared in server mode
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.records: deque = deque(maxlen=SESSION_METRICS_RECORDS)  # this session's metrics, for 'stats'
+        # Directory the session's files are read from, written to and run in; None is the process's working directory
+        self.workdir: Optional[str] = None
+        # Whether written Python files may be run; server sessions need the operator's --allow-exec
+        self.allow_exec = True
+        self.journal = SessionJournal()
+        self.console = console or ConsoleInput()
+        # Stream print() output is written to; None is this process's stdout
+        self.output = output
+        # File settings changes are saved to; None keeps them to this session
+        self.config_file = config_file
+        self.turns = TurnScheduler(max_turns)
+
+    def add_source(self, source: str) -> None:
+        """Remember a document indexed during this session"""
+        if source not in self.sources:
+            self.sources.append(source)
+
 def save_config() -> None:
-    """Save current configuration to a file"""
+    """Save the current session's configuration to a file"""
+    session = get_session()
+    if session.config_file is None:
+        print(f"{BLUE}System>> {RESET}Setting changed for this session.")
+        return
     config_data = {
-        "model_index": model,
-        "prompt": prompt,
-        "speed": speed
+        "model_index": session.model,
+        "prompt": session.prompt,
+        "speed": session.speed,
+        "context_budget": session.context_budget,
+        "response_cache": session.response_cache_enabled,
+        "retrieval": session.retrieval_enabled,
+        "multi_mode": session.multi_mode,
+        "multi_models": session.multi_models,
+        "max_tokens": session.max_tokens,
+        "stop_sequences": session.stop_sequences,
+        "journal_compress": session.journal.compress
     }
 
     try:
-        with open(CONFIG_FILE, 'w') as f:
+        with open(session.config_file, 'w') as f:
             json.dump(config_data, f)
         print(f"{BLUE}System>> {RESET}Configuration saved.")
     except Exception as e:
@@ -69,8 +395,8 @@ def save_config() -> None:
         logging.error(f"Error saving configuration: {str(e)}")
 
 def load_config() -> None:
-    """Load configuration from file if it exists"""
-    global model, prompt, speed
+    """Load configuration from file if it exists into the current session"""
+    session = get_session()
 
     if not os.path.exists(CONFIG_FILE):
         return
@@ -79,50 +405,1216 @@ def load_config() -> None:
         with open(CONFIG_FILE, 'r') as f:
             config_data = json.load(f)
 
-        model = config_data.get("model_index", 0)
-        prompt = config_data.get("prompt", prompt)
-        speed = config_data.get("speed", 0.05)
+        session.model = config_data.get("model_index", 0)
+        session.prompt = config_data.get("prompt", session.prompt)
+        session.speed = config_data.get("speed", 0.05)
+        session.context_budget = config_data.get("context_budget", session.context_budget)
+        session.response_cache_enabled = config_data.get("response_cache", session.response_cache_enabled)
+        session.retrieval_enabled = config_data.get("retrieval", session.retrieval_enabled)
+        session.multi_mode = config_data.get("multi_mode", session.multi_mode)
+        session.multi_models = config_data.get("multi_models", session.multi_models)
+        session.max_tokens.update(config_data.get("max_tokens", {}))
+        session.stop_sequences = config_data.get("stop_sequences", session.stop_sequences)
+        session.journal.compress = config_data.get("journal_compress", session.journal.compress)
         print(f"{BLUE}System>> {RESET}Configuration loaded.")
     except Exception as e:
         print(f"{RED}System>> Error loading configuration: {str(e)}{RESET}")
         logging.error(f"Error loading configuration: {str(e)}")
 
+class Metrics:
+    """In-memory timing records for the session, with optional JSONL and Prometheus textfile export"""
+
+    # Fields summarised by the stats command, per record kind
+    SUMMARY_FIELDS = {
+        "turn": ["latency", "ttft", "tokens_per_second", "stream_seconds", "render_seconds",
+                 "input_tokens", "output_tokens", "cache_read_input_tokens", "attempts", "backoff", "queued"],
+        "scrape": ["fetch_seconds", "parse_seconds", "html_bytes", "text_chars"],
+        "exec": ["seconds", "peak_rss"],
+        "read_chunk": ["seconds", "chars", "output_tokens"],
+        "command": ["seconds"]
+    }
+
+    def __init__(self):
+        # Only the newest records are kept, so a long-running server does not grow without bound
+        self.records: deque = deque(maxlen=METRICS_MAX_RECORDS)
+        self.jsonl_path: Optional[str] = None
+        self.prom_path: Optional[str] = None
+        self.prom_timer: Optional[asyncio.TimerHandle] = None
+        self.prom_lock = threading.Lock()
+
+    def record(self, kind: str, **fields) -> None:
+        """Store one measurement and export it if configured"""
+        session = get_session()
+        record = {"kind": kind, "time": round(time.time(), 3), "session": session.name}
+        for name, value in fields.items():
+            record[name] = round(value, 4) if isinstance(value, float) else value
+        self.records.append(record)
+        session.records.append(record)
+        logging.info(kind, extra={"event": kind, "fields": {k: v for k, v in record.items() if k not in ("kind", "time")}})
+
+        try:
+            if self.jsonl_path:
+                with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            logging.error(f"Error exporting metrics: {str(e)}")
+        if self.prom_path:
+            self.schedule_prometheus()
+
+    def schedule_prometheus(self) -> None:
+        """Rewrite the textfile within METRICS_PROM_INTERVAL, on a worker thread"""
+        if self.prom_timer is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.export_prometheus()
+            return
+        self.prom_timer = loop.call_later(METRICS_PROM_INTERVAL, self._start_prometheus, loop)
+
+    def _start_prometheus(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.prom_timer = None
+        # The summary sorts every record, so it is computed off the loop from a snapshot
+        loop.run_in_executor(None, self.export_prometheus, list(self.records))
+
+    def export_prometheus(self, records: Optional[List[Dict[str, Any]]] = None) -> None:
+        """Write the textfile now, logging rather than raising on failure"""
+        try:
+            with self.prom_lock:
+                self.write_prometheus(self.prom_path, records)
+        except OSError as e:
+            logging.error(f"Error exporting metrics: {str(e)}")
+
+    def flush(self) -> None:
+        """Write a textfile update still waiting for its timer"""
+        if self.prom_timer is not None:
+            self.prom_timer.cancel()
+            self.prom_timer = None
+            self.export_prometheus()
+
+    def values(self, kind: str, field: str, records: Optional[List[Dict[str, Any]]] = None) -> List[float]:
+        """Every recorded value of one field, from all records or the given ones"""
+        records = self.records if records is None else records
+        return [r[field] for r in records if r["kind"] == kind and isinstance(r.get(field), (int, float))]
+
+    @staticmethod
+    def percentile(values: List[float], p: float) -> float:
+        """Nearest-rank percentile"""
+        ordered = sorted(values)
+        index = max(0, min(len(ordered) - 1, math.ceil(p * len(ordered) / 100) - 1))
+        return ordered[index]
+
+    def summary(self, records: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """count/p50/p90/p99/max for every summarised field that has data"""
+        result = {}
+        for kind, fields in self.SUMMARY_FIELDS.items():
+            for field in fields:
+                values = self.values(kind, field, records)
+                if values:
+                    result.setdefault(kind, {})[field] = {
+                        "count": len(values),
+                        "sum": sum(values),
+                        "p50": self.percentile(values, 50),
+                        "p90": self.percentile(values, 90),
+                        "p99": self.percentile(values, 99),
+                        "max": max(values)
+                    }
+        return result
+
+    def write_prometheus(self, path: str, records: Optional[List[Dict[str, Any]]] = None) -> None:
+        """Write the summary of all records, or the given ones, in the node_exporter textfile format"""
+        lines = []
+        for kind, fields in self.summary(records).items():
+            for field, stats in fields.items():
+                name = f"claude_console_{kind}_{field}"
+                lines.append(f"# TYPE {name} summary")
+                for quantile, key in (("0.5", "p50"), ("0.9", "p90"), ("0.99", "p99")):
+                    lines.append(f'{name}{{quantile="{quantile}"}} {stats[key]}')
+                lines.append(f"{name}_sum {stats['sum']}")
+                lines.append(f"{name}_count {stats['count']}")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+metrics = Metrics()
+
+class ConsoleInput:
+    """Read stdin on a background thread and hand each line to the newest waiting prompt"""
+
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.waiters: List[asyncio.Future] = []
+        self.prompts: List[str] = []
+        self.pending = deque()
+        self.eof = False
+
+    def start(self) -> None:
+        """Start the reader thread for the running event loop"""
+        if self.loop:
+            return
+        self.loop = asyncio.get_running_loop()
+        threading.Thread(target=self._reader, daemon=True).start()
+
+    def _reader(self) -> None:
+        """Forward stdin lines to the event loop until EOF"""
+        while True:
+            line = sys.stdin.readline()
+            self.loop.call_soon_threadsafe(self._deliver, line)
+            if not line:
+                return
+
+    def _deliver(self, line: str) -> None:
+        """Resolve the most recent prompt, or buffer the line if nobody is waiting"""
+        if not line:
+            self.eof = True
+        while self.waiters:
+            waiter = self.waiters.pop()
+            self.prompts.pop()
+            if waiter.done():
+                continue
+            if line:
+                waiter.set_result(line.rstrip("\n"))
+            else:
+                waiter.set_exception(EOFError())
+            return
+        self.pending.append(line)
+
+    async def read(self, prompt: str = "") -> str:
+        """Print a prompt and wait for the next line without blocking the event loop"""
+        print(prompt, end="", flush=True)
+        if self.pending:
+            line = self.pending.popleft()
+            if line:
+                return line.rstrip("\n")
+        if self.eof:
+            raise EOFError()
+        waiter = self.loop.create_future()
+        self.waiters.append(waiter)
+        self.prompts.append(prompt)
+        try:
+            return await waiter
+        finally:
+            if waiter in self.waiters:
+                index = self.waiters.index(waiter)
+                del self.waiters[index]
+                del self.prompts[index]
+
+    def reprompt(self) -> None:
+        """Print the newest waiting prompt again after background output"""
+        if self.prompts:
+            print(self.prompts[-1], end="", flush=True)
+
+class ConnectionInput(ConsoleInput):
+    """Lines sent by a server client, handed to waiting prompts the same way as console input"""
+
+    def __init__(self, reader: asyncio.StreamReader):
+        super().__init__()
+        self.reader = reader
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Start reading the connection on the running event loop"""
+        if self.loop:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.create_task(self._read_connection())
+
+    async def _read_connection(self) -> None:
+        """Forward client lines until the connection closes"""
+        while True:
+            try:
+                line = await self.reader.readline()
+            except (ConnectionError, ValueError):
+                line = b""  # Reset by the client, or a line over SERVER_LINE_LIMIT
+            # Telnet ends lines with CRLF
+            text = line.decode("utf-8", errors="replace").rstrip("\r\n") + "\n" if line else ""
+            self._deliver(text)
+            if not line:
+                return
+
+    def stop(self) -> None:
+        """Stop reading the connection"""
+        if self.task:
+            self.task.cancel()
+
+async def ainput(prompt: str = "") -> str:
+    """Asynchronous replacement for input(), reading from the current session's console or connection"""
+    console = get_session().console
+    console.start()
+    return await console.read(prompt)
+
+class TurnScheduler:
+    """Run conversation commands as tasks, one at a time, so the prompt stays responsive"""
+
+    def __init__(self, max_turns: int = 0):
+        self.lock = asyncio.Lock()
+        self.tasks = set()
+        self.active: Optional[asyncio.Task] = None
+        # Commands allowed to be running or queued at once; 0 means no limit
+        self.max_turns = max_turns
+
+    def submit(self, coro, name: str = "") -> Optional[asyncio.Task]:
+        """Queue a conversation command behind any turn already in flight"""
+        if self.max_turns and len(self.tasks) >= self.max_turns:
+            coro.close()
+            print(f"{RED}System>> {len(self.tasks)} commands are already running or queued; wait for one to finish or type 'cancel'.{RESET}")
+            return None
+        task = asyncio.create_task(self._run(coro, name))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _run(self, coro, name: str) -> None:
+        """Hold the turn lock for the duration of one command"""
+        try:
+            async with self.lock:
+                self.active = asyncio.current_task()
+                current_turn.set(new_turn_id())
+                current_command.set(name)
+                started = time.perf_counter()
+                await coro
+                metrics.record("command", command=name, seconds=time.perf_counter() - started)
+        except asyncio.CancelledError:
+            print(f"\n{BLUE}System>> {RESET}Response cancelled.")
+        except Exception as e:
+            print(f"\n{RED}System>> Error: {str(e)}{RESET}")
+            logging.error(f"Command error: {str(e)}")
+        finally:
+            coro.close()
+            if self.active is asyncio.current_task():
+                self.active = None
+                get_session().console.reprompt()
+
+    def busy(self, command: str) -> bool:
+        """True, with a notice, while turns are running or queued; commands that replace memory must wait"""
+        if not self.tasks:
+            return False
+        print(f"{RED}System>> Wait for the response in progress to finish, or type 'cancel', before '{command}'.{RESET}")
+        return True
+
+    def interrupt(self) -> bool:
+        """Cancel the turn currently running, if any"""
+        if self.active and not self.active.done():
+            self.active.cancel()
+            return True
+        return False
+
+    async def drain(self) -> None:
+        """Wait for every queued or running turn to finish, including turns they queue"""
+        while self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def shutdown(self) -> None:
+        """Cancel every queued or running turn and wait for them to unwind"""
+        for task in list(self.tasks):
+            task.cancel()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+class TokenRenderer:
+    """Paint streamed text at the configured speed without blocking the network consumer"""
+
+    def __init__(self, delay: float, fps: int = RENDER_FPS):
+        self.delay = delay
+        self.frame = 1 / max(fps, 1)
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Start the paint loop as a background task"""
+        self.task = asyncio.create_task(self._paint())
+
+    def feed(self, text: str) -> None:
+        """Queue a chunk of text for display; never waits"""
+        self.queue.put_nowait(text)
+
+    async def finish(self) -> None:
+        """Wait until every queued chunk has been painted"""
+        self.queue.put_nowait(None)
+        if self.task:
+            await self.task
+
+    async def flush(self) -> None:
+        """Stop pacing and print everything still queued"""
+        await self.cancel()
+        rest = []
+        while not self.queue.empty():
+            chunk = self.queue.get_nowait()
+            if chunk is not None:
+                rest.append(chunk)
+        print("".join(rest), end="", flush=True)
+
+    async def cancel(self) -> None:
+        """Stop painting immediately, dropping anything still queued"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def _paint(self) -> None:
+        """Write queued chunks once per frame, releasing as many as the speed allows"""
+        budget = 0.0
+        last = time.perf_counter()
+        while True:
+            await asyncio.sleep(self.frame)
+            now = time.perf_counter()
+            budget += (now - last) / self.delay
+            last = now
+
+            batch = []
+            while budget >= 1 and not self.queue.empty():
+                chunk = self.queue.get_nowait()
+                if chunk is None:
+                    print("".join(batch), end="", flush=True)
+                    return
+                batch.append(chunk)
+                budget -= 1
+            if batch:
+                print("".join(batch), end="", flush=True)
+            if self.queue.empty():
+                # Do not bank time while idle, otherwise a burst would be dumped at once
+                budget = min(budget, 1.0)
+
+class ResponseCache:
+    """SQLite store of finished responses keyed by a hash of the request, with TTL and size eviction"""
+
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, ttl: float = RESPONSE_CACHE_TTL, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.db: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open the database on first use"""
+        if self.db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.db = sqlite3.connect(self.path)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, "
+                "created REAL, accessed REAL, hits INTEGER DEFAULT 0)"
+            )
+            self.db.commit()
+        return self.db
+
+    @staticmethod
+    def make_key(model_name: str, system: str, max_tokens: int, messages: List[Dict[str, Any]], stop_sequences: Optional[List[str]] = None) -> str:
+        """Stable hash of everything that determines a response"""
+        # Stop sequences are only part of the key when set, so entries stored before they existed still match
+        request = [model_name, system, max_tokens, messages] + ([stop_sequences] if stop_sequences else [])
+        payload = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return a cached response that has not expired"""
+        db = self._connect()
+        row = db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            if row is not None:
+                db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                db.commit()
+            self.misses += 1
+            return None
+        db.execute("UPDATE responses SET accessed = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+        db.commit()
+        self.hits += 1
+        return row[0]
+
+    def put(self, key: str, model_name: str, response: str) -> None:
+        """Store a response and evict least recently used entries over the size limit"""
+        db = self._connect()
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        db.execute(
+            "INSERT OR REPLACE INTO responses (key, model, response, size, created, accessed, hits) VALUES (?, ?, ?, ?, ?, ?, 0)",
+            (key, model_name, response, size, now, now)
+        )
+        db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total > self.max_bytes:
+            for old_key, old_size in db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+                if total <= self.max_bytes:
+                    break
+                db.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                total -= old_size
+        db.commit()
+
+    def stats(self) -> Dict[str, int]:
+        """Entry count, stored bytes, lifetime hits and this process's hit counters"""
+        db = self._connect()
+        entries, size, hits = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0) FROM responses").fetchone()
+        return {"entries": entries, "bytes": size, "stored_hits": hits, "hits": self.hits, "misses": self.misses}
+
+    def clear(self) -> None:
+        """Remove every cached response"""
+        db = self._connect()
+        db.execute("DELETE FROM responses")
+        db.commit()
+        db.execute("VACUUM")
+
+    def close(self) -> None:
+        """Close the database connection"""
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+response_cache = ResponseCache()
+
+def iter_text_chunks(lines: Iterable[str], chunk_chars: int) -> Iterator[str]:
+    """Group lines into pieces of about chunk_chars characters, split at line ends"""
+    buffer: List[str] = []
+    size = 0
+    for line in lines:
+        # Pathological single lines are split on their own
+        while len(line) > chunk_chars:
+            if buffer:
+                yield "".join(buffer)
+                buffer, size = [], 0
+            yield line[:chunk_chars]
+            line = line[chunk_chars:]
+        if size + len(line) > chunk_chars and buffer:
+            yield "".join(buffer)
+            buffer, size = [], 0
+        buffer.append(line)
+        size += len(line)
+    if buffer:
+        yield "".join(buffer)
+
+class DocumentIndex:
+    """SQLite FTS5 index of document chunks ranked with BM25, updated one document at a time"""
+
+    def __init__(self, path: str = INDEX_PATH, chunk_chars: int = INDEX_CHUNK_CHARS):
+        self.path = path
+        self.chunk_chars = chunk_chars
+        self.db: Optional[sqlite3.Connection] = None
+        # Files are indexed from a worker thread while the loop may search
+        self.lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open the database on first use"""
+        if self.db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "source TEXT PRIMARY KEY, digest TEXT, chunks INTEGER, chars INTEGER, indexed REAL)"
+            )
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(text, source UNINDEXED, position UNINDEXED)")
+            self.db.commit()
+        return self.db
+
+    def add(self, source: str, digest: str, chunks: Iterable[str]) -> Tuple[int, bool]:
+        """Index a document unless the stored copy has the same digest; returns (chunk count, reindexed)"""
+        with self.lock:
+            db = self._connect()
+            row = db.execute("SELECT digest, chunks FROM documents WHERE source = ?", (source,)).fetchone()
+            if row is not None and row[0] == digest:
+                return row[1], False
+
+            db.execute("DELETE FROM chunks WHERE source = ?", (source,))
+            count = chars = 0
+            for position, chunk in enumerate(chunks):
+                db.execute("INSERT INTO chunks (text, source, position) VALUES (?, ?, ?)", (chunk, source, position))
+                count += 1
+                chars += len(chunk)
+            db.execute(
+                "INSERT OR REPLACE INTO documents (source, digest, chunks, chars, indexed) VALUES (?, ?, ?, ?, ?)",
+                (source, digest, count, chars, time.time())
+            )
+            db.commit()
+            return count, True
+
+    def add_text(self, source: str, text: str) -> Tuple[int, bool]:
+        """Index text already in memory, such as a scraped page"""
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return self.add(source, digest, iter_text_chunks(text.splitlines(keepends=True), self.chunk_chars))
+
+    def add_file(self, filename: str) -> Tuple[int, bool]:
+        """Index a file from disk; unchanged files (same size and mtime) are not read again"""
+        source = os.path.abspath(filename)
+        stat = os.stat(filename)
+        digest = f"{stat.st_size}:{stat.st_mtime_ns}"
+        with open(filename, "r", encoding="utf-8", errors="replace") as f:
+            return self.add(source, digest, iter_text_chunks(f, self.chunk_chars))
+
+    @staticmethod
+    def match_query(question: str) -> str:
+        """FTS5 query matching any significant word of the question"""
+        words = []
+        for word in re.findall(r"\w+", question.lower()):
+            if word not in RETRIEVAL_STOPWORDS and word not in words:
+                words.append(word)
+        return " OR ".join(f'"{word}"' for word in words)
+
+    def search(self, question: str, sources: Optional[List[str]] = None, k: int = RETRIEVAL_TOP_K) -> List[Tuple[str, int, str]]:
+        """Top-k (source, position, text) chunks for a question, best first"""
+        query = self.match_query(question)
+        if not query or sources == []:
+            return []
+        sql = "SELECT source, position, text FROM chunks WHERE chunks MATCH ?"
+        params: List[Any] = [query]
+        if sources is not None:
+            sql += f" AND source IN ({', '.join('?' * len(sources))})"
+            params.extend(sources)
+        sql += " ORDER BY bm25(chunks) LIMIT ?"
+        params.append(k)
+        with self.lock:
+            rows = self._connect().execute(sql, params).fetchall()
+        return [(source, int(position), text) for source, position, text in rows]
+
+    def head(self, source: str, k: int = RETRIEVAL_TOP_K) -> List[Tuple[str, int, str]]:
+        """The first k chunks of a document, for requests without a specific question"""
+        with self.lock:
+            rows = self._connect().execute(
+                "SELECT source, position, text FROM chunks WHERE source = ? ORDER BY CAST(position AS INTEGER) LIMIT ?", (source, k)
+            ).fetchall()
+        return [(source, int(position), text) for source, position, text in rows]
+
+    def stats(self) -> Dict[str, int]:
+        """Document, chunk and character counts"""
+        with self.lock:
+            documents, chunks, chars = self._connect().execute(
+                "SELECT COUNT(*), COALESCE(SUM(chunks), 0), COALESCE(SUM(chars), 0) FROM documents"
+            ).fetchone()
+        return {"documents": documents, "chunks": chunks, "chars": chars}
+
+    def clear(self) -> None:
+        """Remove every indexed document"""
+        with self.lock:
+            db = self._connect()
+            db.execute("DELETE FROM documents")
+            db.execute("DELETE FROM chunks")
+            db.commit()
+            db.execute("VACUUM")
+
+    def close(self) -> None:
+        """Close the database connection"""
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+document_index = DocumentIndex()
+
+def format_excerpts(hits: List[Tuple[str, int, str]]) -> str:
+    """Render retrieved chunks in document order with their source and part number"""
+    return "\n\n".join(f"--- {source}, part {position + 1} ---\n{text}" for source, position, text in sorted(hits, key=lambda hit: hit[:2]))
+
+async def replay_response(text: str, label: str = "Claude") -> None:
+    """Display a finished response through the normal renderer"""
+    print(f"\r\033[2K{ORANGE}{label}>> {RESET}", end="", flush=True)
+    speed = get_session().speed
+    if speed > 0:
+        renderer = TokenRenderer(speed)
+        renderer.start()
+        try:
+            for piece in re.findall(r"\S*\s*", text):
+                if piece:
+                    renderer.feed(piece)
+        except BaseException:
+            await renderer.cancel()
+            raise
+        await renderer.finish()
+    else:
+        print(text, end="")
+    print()
+
+def system_blocks() -> List[Dict[str, Any]]:
+    """System prompt marked as a cacheable prefix"""
+    return [{"type": "text", "text": get_session().prompt, "cache_control": {"type": "ephemeral"}}]
+
+def build_request_messages(messages: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+    """Copy messages for a request, marking the latest large ones (file and scrape bodies) as cacheable"""
+    request = list(messages)
+    marked = 0
+    for i in range(len(request) - 1, -1, -1):
+        if marked == CACHE_MAX_MESSAGE_BREAKPOINTS:
+            break
+        message = request[i]
+        if isinstance(message["content"], str) and len(message["content"]) >= CACHE_MIN_CHARS:
+            request[i] = {
+                "role": message["role"],
+                "content": [{"type": "text", "text": message["content"], "cache_control": {"type": "ephemeral"}}]
+            }
+            marked += 1
+    return request
+
+USAGE_FIELDS = ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens")
+
+def merge_usage(totals: Dict[str, int], usage: Any) -> None:
+    """Fold a usage block from message_start or message_delta into totals"""
+    for field in USAGE_FIELDS:
+        value = getattr(usage, field, None)
+        if value:
+            totals[field] = value
+
+def record_usage(usage: Dict[str, int], expect_cache: bool) -> None:
+    """Remember token usage and show prompt cache results"""
+    last_usage = get_session().last_usage
+    last_usage.clear()
+    for field in USAGE_FIELDS:
+        last_usage[field] = usage.get(field, 0)
+
+    cache_read = last_usage["cache_read_input_tokens"]
+    cache_write = last_usage["cache_creation_input_tokens"]
+    if expect_cache or cache_read or cache_write:
+        status = "hit" if cache_read else "miss"
+        print(f"{BLUE}System>> {RESET}Prompt cache {status}: {cache_read} tokens read, {cache_write} written, {last_usage['input_tokens']} uncached input tokens.")
+
+class RetryPolicy:
+    """Decide which failures to retry and how long to wait, shared by every concurrent request
+
+    Server hints (retry-after) and repeated failures pause all callers, and a
+    token bucket caps how many retries can be spent at once so a burst of
+    failures does not turn into a retry storm.
+    """
+
+    RETRYABLE_ERRORS = {"overloaded_error", "rate_limit_error", "api_error"}
+    DISCONNECT_ERRORS = {"RemoteProtocolError", "ReadError", "ReadTimeout", "WriteError", "ConnectError", "IncompleteRead"}
+
+    def __init__(self, max_retries: int = MAX_RETRIES, base_delay: float = BASE_DELAY, max_delay: float = MAX_DELAY):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = float(RETRY_BUDGET)
+        self.budget_updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.consecutive_failures = 0
+        self.total_retries = 0
+        self.total_backoff = 0.0
+
+    def classify(self, error: Exception) -> Optional[str]:
+        """Return a short reason if the error is worth retrying, otherwise None"""
+        # API errors can only occur once the SDK has been imported
+        anthropic = sys.modules.get("anthropic")
+        if anthropic is not None and isinstance(error, anthropic.APIStatusError):
+            body = error.body if isinstance(error.body, dict) else {}
+            error_type = (body.get("error") or {}).get("type") if isinstance(body.get("error"), dict) else None
+            if error.status_code == 429 or error_type == "rate_limit_error":
+                return "Rate limited"
+            if error.status_code == 529 or error_type == "overloaded_error":
+                return "API overloaded"
+            if error.status_code >= 500 or error_type in self.RETRYABLE_ERRORS:
+                return "Server error"
+            return None
+        if anthropic is not None and isinstance(error, anthropic.APIConnectionError):
+            return "Connection lost"
+        if isinstance(error, (ConnectionError, asyncio.TimeoutError)):
+            return "Connection lost"
+        if type(error).__name__ in self.DISCONNECT_ERRORS:
+            return "Connection lost"
+        if "overloaded_error" in str(error):
+            return "API overloaded"
+        return None
+
+    def server_delay(self, error: Exception) -> Optional[float]:
+        """Seconds the server asked us to wait, from the retry-after header"""
+        response = getattr(error, "response", None)
+        value = response.headers.get("retry-after") if response is not None else None
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        """Delay before the next attempt: the server hint if given, else exponential backoff with jitter"""
+        hint = self.server_delay(error)
+        if hint is not None:
+            return min(hint, self.max_delay)
+        return min(self.base_delay * (2 ** attempt), self.max_delay) + (random.random() * 0.5)
+
+    def take_retry(self) -> bool:
+        """Spend one retry from the shared budget"""
+        now = time.monotonic()
+        self.budget = min(RETRY_BUDGET, self.budget + (now - self.budget_updated) * RETRY_BUDGET_RATE)
+        self.budget_updated = now
+        if self.budget < 1:
+            return False
+        self.budget -= 1
+        return True
+
+    def record_failure(self, delay: float, shared: bool) -> None:
+        """Count a failure; server hints and repeated failures pause every caller"""
+        now = time.monotonic()
+        self.consecutive_failures += 1
+        if shared:
+            self.blocked_until = max(self.blocked_until, now + delay)
+        if self.consecutive_failures >= BREAKER_THRESHOLD:
+            self.blocked_until = max(self.blocked_until, now + BREAKER_COOLDOWN)
+            logging.warning(f"{self.consecutive_failures} consecutive failures; pausing requests for {BREAKER_COOLDOWN}s")
+
+    def record_success(self) -> None:
+        """Close the breaker after a successful request"""
+        self.consecutive_failures = 0
+
+    async def wait_ready(self) -> float:
+        """Sleep until no shared pause is in effect, returning the time waited"""
+        delay = self.blocked_until - time.monotonic()
+        if delay <= 0:
+            return 0.0
+        await asyncio.sleep(delay)
+        return delay
+
+retry_policy = RetryPolicy()
+
+class RequestSlots:
+    """Share API requests in flight between sessions in round-robin order, with a cap per session
+
+    A capacity of 0 means no limit, as in the local console; server mode
+    sets SERVER_MAX_REQUESTS and SERVER_SESSION_REQUESTS. A freed slot goes
+    to the next session in turn that has a request waiting, so one
+    session's fan-out or chunked read cannot starve the others.
+    """
+
+    def __init__(self, capacity: int = 0, per_session: int = 0):
+        self.capacity = capacity
+        self.per_session = per_session
+        self.in_use = 0
+        self.active: Dict[Any, int] = {}
+        # Waiting requests of each session; sessions are served in this order and move to the back when served
+        self.waiting: "OrderedDict[Any, deque]" = OrderedDict()
+
+    def has_room(self, owner: Any) -> bool:
+        """Whether the owner may start a request now"""
+        if self.capacity and self.in_use >= self.capacity:
+            return False
+        return not self.per_session or self.active.get(owner, 0) < self.per_session
+
+    def _grant(self, owner: Any) -> None:
+        self.in_use += 1
+        self.active[owner] = self.active.get(owner, 0) + 1
+
+    async def acquire(self, owner: Any) -> float:
+        """Wait for a slot, returning the seconds spent waiting"""
+        if not self.waiting.get(owner) and self.has_room(owner):
+            self._grant(owner)
+            return 0.0
+        started = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(owner, deque()).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the request was cancelled
+                self.release(owner)
+            else:
+                queue = self.waiting.get(owner)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self.waiting[owner]
+            raise
+        return time.perf_counter() - started
+
+    def release(self, owner: Any) -> None:
+        """Return a slot and hand free slots to waiting sessions in turn"""
+        self.in_use -= 1
+        self.active[owner] -= 1
+        if not self.active[owner]:
+            del self.active[owner]
+        while True:
+            ready = next((candidate for candidate in self.waiting if self.has_room(candidate)), None)
+            if ready is None:
+                return
+            queue = self.waiting.pop(ready)
+            waiter = queue.popleft()
+            if queue:
+                self.waiting[ready] = queue
+            if waiter.done():
+                continue  # Cancelled while waiting
+            self._grant(ready)
+            waiter.set_result(None)
+
+request_slots = RequestSlots()
+
+class StreamState:
+    """Text, usage and retry counters accumulated across the attempts of one request"""
+
+    def __init__(self):
+        # Streamed pieces are collected in a list; repeated += on an attribute copies the whole answer each time
+        self.parts: List[str] = []
+        self.chars = 0
+        self.usage: Dict[str, int] = {}
+        self.attempts = 0
+        self.backoff = 0.0
+        self.header_shown = False
+        self.started = time.perf_counter()
+        self.first_token: Optional[float] = None
+        self.last_byte: Optional[float] = None
+        self.overlap = ""
+        self.code = CodeBlockParser()
+        self.chunks = 0
+        self.queued = 0.0
+        # Why generation ended: end_turn, max_tokens or stop_sequence
+        self.stop_reason: Optional[str] = None
+        self.stop_sequence: Optional[str] = None
+
+    @property
+    def text(self) -> str:
+        """Everything received so far"""
+        return "".join(self.parts)
+
+async def stream_once(request_messages: List[Dict[str, Any]], model: str, state: StreamState, echo: bool = True,
+                      max_tokens: int = MAX_TOKENS, stop_sequences: Optional[List[str]] = None) -> None:
+    """Run one streaming attempt, appending text and usage to state; raises on failure
+
+    If earlier attempts already produced text, it is sent back as an
+    assistant prefill so the answer continues where it stopped, within
+    what is left of max_tokens.
+    """
+    if state.text:
+        # The API rejects a prefill that ends in whitespace; whatever the
+        # continuation repeats of the trimmed tail is skipped below
+        prefill = state.text.rstrip()
+        state.overlap = state.text[len(prefill):]
+        request_messages = request_messages + [{"role": "assistant", "content": prefill}]
+        # Only failed attempts get here, and they never report their output tokens
+        max_tokens -= estimate_tokens(state.text)
+        if max_tokens <= 0:
+            state.stop_reason = "max_tokens"
+            return
+
+    options = {"stop_sequences": stop_sequences} if stop_sequences else {}
+    async with get_client().messages.stream(
+        max_tokens=max_tokens,
+        messages=request_messages,
+        model=model,
+        system=system_blocks(),
+        **options
+    ) as stream:
+        renderer = None
+        if echo:
+            if not state.header_shown:
+                # Clear a prompt the input loop may already have printed on this line
+                print(f"\r\033[2K{ORANGE}Claude>> {RESET}", end="", flush=True)
+                state.header_shown = True
+            speed = get_session().speed
+            renderer = TokenRenderer(speed) if speed > 0 else None
+            if renderer:
+                renderer.start()
+        usage: Dict[str, int] = {}
+        try:
+            async for event in stream:
+                if event.type == "message_start":
+                    merge_usage(usage, event.message.usage)
+                elif event.type == "message_delta":
+                    merge_usage(usage, event.usage)
+                    state.stop_reason = event.delta.stop_reason
+                    state.stop_sequence = event.delta.stop_sequence
+                elif event.type == "text":
+                    text = event.text
+                    if state.overlap:
+                        if text.startswith(state.overlap):
+                            text = text[len(state.overlap):]
+                        state.overlap = ""
+                    if renderer:
+                        renderer.feed(text)
+                    elif echo:
+                        print(text, end="", flush=True)
+                    if state.first_token is None:
+                        state.first_token = time.perf_counter()
+                    state.parts.append(text)
+                    state.chars += len(text)
+                    state.code.feed(text)
+                    state.chunks += 1
+                    if log_token_every and state.chunks % log_token_every == 0:
+                        logging.debug("token", extra={"event": "token", "fields": {
+                            "model": model, "chunk": state.chunks, "chars": state.chars,
+                            "elapsed": round(time.perf_counter() - state.started, 4)
+                        }})
+            state.last_byte = time.perf_counter()
+        except asyncio.CancelledError:
+            # Close the connection before anything else, so the server stops generating at once
+            await stream.close()
+            if renderer:
+                await renderer.cancel()
+            raise
+        except BaseException:
+            # Show what did arrive; a retry continues from it
+            if renderer:
+                await renderer.flush()
+            raise
+        finally:
+            for field, value in usage.items():
+                state.usage[field] = state.usage.get(field, 0) + value
+    # The stream is closed at this point; only the display is left to catch up
+    if renderer:
+        try:
+            await renderer.finish()
+        except asyncio.CancelledError:
+            # The whole answer has arrived, so cancelling only skips the pacing and the reply is kept
+            await renderer.flush()
+            task = asyncio.current_task()
+            if hasattr(task, "uncancel"):
+                task.uncancel()
+    if echo:
+        print()
+
+def model_output_limit(model_name: str) -> int:
+    """Largest max_tokens a model accepts"""
+    return MODEL_MAX_OUTPUT.get(model_name, MAX_TOKENS_LIMIT)
+
+def generation_budget(command: Optional[str] = None, model: Optional[str] = None) -> int:
+    """max_tokens for requests made by a command, by default the one running, capped at what the model can write"""
+    budget = get_session().max_tokens.get(command or current_command.get(), MAX_TOKENS)
+    return min(budget, model_output_limit(model)) if model else budget
+
+async def request_with_retry(messages: List[Dict[str, Any]], model: str, echo: bool = True, cache_messages: bool = True,
+                             state: Optional[StreamState] = None, max_tokens: Optional[int] = None,
+                             stop_sequences: Optional[List[str]] = None):
+    """Send messages, retrying transient failures, and return (text, usage)
+
+    usage also carries the attempt count, seconds spent backing off and
+    why generation stopped. max_tokens defaults to the running command's
+    budget and stop_sequences to the session's. Pass a state to see how
+    much arrived if the request is cancelled. Raises the last error once
+    retries or the shared retry budget run out.
+    """
+    # One-off requests skip message breakpoints; writing a cache entry costs more than a plain read
+    request_messages = build_request_messages(messages) if cache_messages else list(messages)
+    state = state or StreamState()
+    session = get_session()
+    max_tokens = min(max_tokens or generation_budget(), model_output_limit(model))
+    stop_sequences = session.stop_sequences if stop_sequences is None else stop_sequences
+    if echo:
+        # The answer on screen: each of its code blocks is usable as soon as its fence closes
+        session.last_code_blocks.clear()
+        state.code.on_block = session.last_code_blocks.append
+    while True:
+        state.backoff += await retry_policy.wait_ready()
+        state.attempts += 1
+        try:
+            state.queued += await request_slots.acquire(session)
+            try:
+                await stream_once(request_messages, model, state, echo, max_tokens, stop_sequences)
+            finally:
+                request_slots.release(session)
+            retry_policy.record_success()
+            break
+        except Exception as e:
+            reason = retry_policy.classify(e)
+            if reason is None or state.attempts >= retry_policy.max_retries or not retry_policy.take_retry():
+                raise
+            delay = retry_policy.backoff(state.attempts - 1, e)
+            retry_policy.record_failure(delay, shared=reason in ["Rate limited", "API overloaded"])
+            retry_policy.total_retries += 1
+            retry_policy.total_backoff += delay
+            state.backoff += delay
+            resume = " Continuing from the partial answer." if state.text else ""
+            if echo:
+                print(f"\n{RED}{reason}. Retrying in {delay:.2f} seconds... (Attempt {state.attempts}/{retry_policy.max_retries}){resume}{RESET}")
+            logging.warning(f"{reason}: {str(e)}. Retrying (Attempt {state.attempts}/{retry_policy.max_retries})")
+            await asyncio.sleep(delay)
+
+    state.code.close()
+
+    usage = dict(state.usage)
+    usage["attempts"] = state.attempts
+    usage["backoff"] = round(state.backoff, 3)
+    usage["max_tokens"] = max_tokens
+    if state.stop_reason:
+        usage["stop_reason"] = state.stop_reason
+    if request_slots.capacity:
+        usage["queued"] = round(state.queued, 3)
+    if state.first_token is not None:
+        usage["ttft"] = round(state.first_token - state.started, 4)
+        usage["stream_seconds"] = round(state.last_byte - state.started, 4)
+        generating = state.last_byte - state.first_token
+        if generating > 0 and usage.get("output_tokens"):
+            usage["tokens_per_second"] = round(usage["output_tokens"] / generating, 1)
+    return state.text, usage
+
 async def stream_with_retry(messages: List[Dict[str, str]], model: str) -> str:
     """Stream responses from Claude with retry logic"""
-    retries = 0
-    while retries < MAX_RETRIES:
+    started = time.perf_counter()
+    session = get_session()
+    session.last_code_blocks.clear()
+    command = current_command.get()
+    max_tokens = generation_budget(command, model)
+    cache_key = None
+    if session.response_cache_enabled:
+        cache_key = ResponseCache.make_key(model, session.prompt, max_tokens, messages, session.stop_sequences)
         try:
-            async with client.messages.stream(
-                max_tokens=4096,
-                messages=messages,
-                model=model,
-                system=prompt
-            ) as stream:
-                print(f"{ORANGE}Claude>> {RESET}", end="", flush=True)
-                message_text = ""
-                async for event in stream:
-                    if event.type == "text":
-                        time.sleep(speed)  # Reduced a bit for better responsiveness
-                        print(event.text, end="", flush=True)
-                        message_text += event.text
-                    elif event.type == "content_block_stop":
-                        print()
-                        return message_text
-        except Exception as e:
-            if "overloaded_error" in str(e) and retries < MAX_RETRIES - 1:
-                # Calculate backoff time with jitter
-                delay = (BASE_DELAY * (2 ** retries)) + (random.random() * 0.5)
-                retries += 1
-                print(f"\n{RED}API overloaded. Retrying in {delay:.2f} seconds... (Attempt {retries}/{MAX_RETRIES}){RESET}")
-                logging.warning(f"API overloaded. Retrying (Attempt {retries}/{MAX_RETRIES})")
-                await asyncio.sleep(delay)
+            cached = response_cache.get(cache_key)
+        except sqlite3.Error as e:
+            logging.error(f"Response cache error: {str(e)}")
+            cached = cache_key = None
+        if cache_key is not None:
+            if cached is None:
+                session.cache_misses += 1
             else:
-                print(f"\n{RED}Error: {e}{RESET}")
-                logging.error(f"Stream error: {str(e)}")
-                return f"Sorry, I encountered an error: {e}"
+                session.cache_hits += 1
+        if cached is not None:
+            session.last_code_blocks[:] = extract_code_blocks(cached)
+            await replay_response(cached)
+            print(f"{BLUE}System>> {RESET}Response served from the local cache.")
+            metrics.record("turn", model=model, latency=time.perf_counter() - started, response_cache_hit=1)
+            return cached
+
+    state = StreamState()
+    try:
+        message_text, usage = await request_with_retry(messages, model, state=state, max_tokens=max_tokens)
+    except asyncio.CancelledError:
+        # The stream is already closed; keep what arrived so stats can tell what stopping early saved
+        metrics.record("turn", model=model, latency=time.perf_counter() - started, cancelled=1,
+                       max_tokens=max_tokens, generated_tokens=estimate_tokens(state.text))
+        raise
+    except Exception as e:
+        print(f"\n{RED}Error: {e}{RESET}")
+        logging.error(f"Stream error: {str(e)}")
+        metrics.record("turn", model=model, latency=time.perf_counter() - started, error=1)
+        return f"Sorry, I encountered an error: {e}"
+
+    latency = time.perf_counter() - started
+    # Anything after the last byte is the display catching up at the configured speed
+    render_seconds = latency - usage["stream_seconds"] if "stream_seconds" in usage else 0
+    metrics.record("turn", model=model, latency=latency, render_seconds=render_seconds, **usage)
+    if usage.get("stop_reason") == "max_tokens":
+        print(f"{BLUE}System>> {RESET}Answer cut off at the {max_tokens}-token budget for '{command}'; "
+              f"raise it with: limits {command} <tokens>")
+    elif usage.get("stop_reason") == "stop_sequence":
+        print(f"{BLUE}System>> {RESET}Stopped at the stop sequence {state.stop_sequence!r}.")
+
+    expect_cache = any(isinstance(m["content"], str) and len(m["content"]) >= CACHE_MIN_CHARS for m in messages)
+    record_usage(usage, expect_cache)
+    if cache_key and message_text:
+        try:
+            response_cache.put(cache_key, model, message_text)
+        except sqlite3.Error as e:
+            logging.error(f"Response cache error: {str(e)}")
+    return message_text
+
+def multi_model_names() -> List[str]:
+    """Models taking part in compare and race modes"""
+    names = [models[i] for i in get_session().multi_models if 0 <= i < len(models)]
+    return names or list(models)
+
+def draft_model_name() -> str:
+    """Fastest model, used for drafts"""
+    for name in models:
+        if "haiku" in name:
+            return name
+    return models[-1]
+
+def describe_usage(name: str, usage: Dict[str, Any]) -> str:
+    """One-line latency and token summary for a model's answer"""
+    parts = [f"{name} in {usage['latency']:.2f}s"]
+    if "ttft" in usage:
+        parts.append(f"first token {usage['ttft']:.2f}s")
+    if usage.get("output_tokens"):
+        parts.append(f"{usage['output_tokens']} tokens")
+    if "tokens_per_second" in usage:
+        parts.append(f"{usage['tokens_per_second']:.0f} tokens/s")
+    return ", ".join(parts)
+
+async def fan_out(messages: List[Dict[str, Any]], mode: str) -> str:
+    """Send one turn to several models at once and return the answer to keep
+
+    compare shows every answer as it finishes and keeps the selected
+    model's; race keeps the first complete answer and cancels the rest;
+    draft streams the fastest model live while the selected model answers,
+    then shows and keeps the selected model's answer. Every model's
+    latency and tokens are recorded as turn metrics.
+    """
+    session = get_session()
+    selected = models[session.model]
+    if mode == "draft" and draft_model_name() == selected:
+        # Nothing faster than the selected model to draft with
+        return await stream_with_retry(messages, selected)
+
+    started = time.perf_counter()
+    session.last_code_blocks.clear()
+    names = [draft_model_name(), selected] if mode == "draft" else multi_model_names()
+
+    async def ask(name: str, echo: bool):
+        began = time.perf_counter()
+        state = StreamState()
+        try:
+            text, usage = await request_with_retry(messages, name, echo=echo, state=state)
+        except asyncio.CancelledError:
+            metrics.record("turn", model=name, mode=mode, latency=time.perf_counter() - began, cancelled=1,
+                           max_tokens=generation_budget(model=name), generated_tokens=estimate_tokens(state.text))
+            raise
+        except Exception as e:
+            logging.error(f"Stream error from {name}: {str(e)}")
+            metrics.record("turn", model=name, mode=mode, latency=time.perf_counter() - began, error=1)
+            raise
+        usage["latency"] = round(time.perf_counter() - began, 3)
+        metrics.record("turn", model=name, mode=mode, **usage)
+        # Blocks the stream already parsed; the kept answer is not scanned again
+        code[name] = state.code.blocks
+        return text, usage
+
+    code: Dict[str, List[CodeBlock]] = {}
+    live = names[0] if mode == "draft" else None
+    tasks = {asyncio.ensure_future(ask(name, name == live)): name for name in names}
+    if live:
+        print(f"{BLUE}System>> {RESET}Drafting with {live} while {selected} answers...")
+    else:
+        print(f"{BLUE}System>> {RESET}Asking {', '.join(names)} ({mode})...")
 
-    logging.error("Failed to get a response after multiple retries")
-    return "Failed to get a response after multiple retries. Please try again later."
+    answers: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+    errors: Dict[str, Exception] = {}
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name = tasks[task]
+                if task.exception() is not None:
+                    errors[name] = task.exception()
+                    print(f"{RED}System>> {name} failed: {task.exception()}{RESET}")
+                    continue
+                answers[name] = task.result()
+                text, usage = answers[name]
+                if name == live:
+                    print(f"{BLUE}System>> {RESET}Draft from {describe_usage(name, usage)}; waiting for {selected}...")
+                elif mode != "race":
+                    await replay_response(text, f"Claude [{name}]")
+                    print(f"{BLUE}System>> {RESET}{describe_usage(name, usage)}")
+            if mode == "race" and answers:
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    if not answers:
+        error = next(iter(errors.values()), None)
+        print(f"\n{RED}Error: {error}{RESET}")
+        return f"Sorry, I encountered an error: {error}"
+
+    if mode == "race":
+        keep = next(iter(answers))
+        await replay_response(answers[keep][0], f"Claude [{keep}]")
+        cancelled = f"; cancelled {len(pending)} slower model{'s' if len(pending) != 1 else ''}" if pending else ""
+        print(f"{BLUE}System>> {RESET}{describe_usage(keep, answers[keep][1])}{cancelled}.")
+    else:
+        keep = selected if selected in answers else next(iter(answers))
+
+    text, usage = answers[keep]
+    session.last_code_blocks[:] = code[keep]
+    expect_cache = any(isinstance(m["content"], str) and len(m["content"]) >= CACHE_MIN_CHARS for m in messages)
+    record_usage(usage, expect_cache)
+    logging.info(f"{mode} turn across {', '.join(names)} kept {keep} after {time.perf_counter() - started:.2f}s")
+    return text
 
 def normalize_url(url: str) -> str:
     """Normalize URL by adding https:// if not present"""
@@ -130,58 +1622,418 @@ def normalize_url(url: str) -> str:
         return "https://" + url
     return url
 
-def scrape_website(url: str) -> str:
-    """Scrapes content from a website URL"""
-    url = normalize_url(url)
-    try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        response = requests.get(url, headers=headers, timeout=10)
+class FetchCache:
+    """On-disk page cache honouring ETag/Last-Modified, with a TTL and size-based eviction"""
+
+    def __init__(self, directory: str = FETCH_CACHE_DIR, ttl: float = FETCH_CACHE_TTL, max_bytes: int = FETCH_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    def _path(self, url: str) -> str:
+        """Cache file for a URL"""
+        return os.path.join(self.directory, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, url: str) -> Optional[Dict[str, Any]]:
+        """Return the cached entry for a URL, or None"""
+        path = self._path(url)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(path)  # Track recency for eviction
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def is_fresh(self, entry: Dict[str, Any]) -> bool:
+        """Whether an entry can be served without asking the server"""
+        return time.time() - entry.get("fetched_at", 0) < self.ttl
+
+    def validators(self, entry: Dict[str, Any]) -> Dict[str, str]:
+        """Conditional request headers for revalidating an entry"""
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def put(self, url: str, body: str, etag: Optional[str] = None, last_modified: Optional[str] = None) -> None:
+        """Store a page and evict the least recently used entries over the size limit"""
+        entry = {
+            "url": url,
+            "body": body,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": time.time()
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(url)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+            self.evict()
+        except OSError as e:
+            logging.error(f"Error writing fetch cache: {str(e)}")
+
+    def refresh(self, url: str, entry: Dict[str, Any]) -> None:
+        """Restart the TTL of an entry the server confirmed is unchanged"""
+        self.put(url, entry["body"], entry.get("etag"), entry.get("last_modified"))
+
+    def evict(self) -> None:
+        """Remove least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def clear(self) -> None:
+        """Remove every cached page"""
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+class WebFetcher:
+    """Fetch pages off the event loop through one pooled, keep-alive session"""
+
+    def __init__(self, cache: Optional[FetchCache] = None, concurrency: int = FETCH_CONCURRENCY):
+        self.cache = cache
+        self.concurrency = concurrency
+        self.session = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _session(self):
+        """Shared requests.Session; requests negotiates gzip, and brotli when the brotli package is installed"""
+        if self.session is None:
+            import requests
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=self.concurrency, pool_maxsize=self.concurrency)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["User-Agent"] = USER_AGENT
+            self.session = session
+        return self.session
+
+    def _get(self, url: str) -> str:
+        """Blocking cache lookup and fetch with revalidation, run in a worker thread"""
+        # Reading a cached page loads and parses the whole entry, so it stays off the event loop too
+        entry = self.cache.get(url) if self.cache else None
+        if entry and self.cache.is_fresh(entry):
+            return entry["body"]
+
+        headers = self.cache.validators(entry) if entry else {}
+        response = self._session().get(url, headers=headers, timeout=FETCH_TIMEOUT)
+
+        if response.status_code == 304 and entry:
+            self.cache.refresh(url, entry)
+            return entry["body"]
+
         response.raise_for_status()
+        body = response.text
+        if self.cache:
+            self.cache.put(url, body, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return body
+
+    async def fetch(self, url: str) -> str:
+        """Return the body of a URL, from the cache when it is still fresh"""
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # Semaphores belong to one event loop
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            self.loop = loop
+        async with self.semaphore:
+            return await loop.run_in_executor(None, self._get, url)
+
+    def close(self) -> None:
+        """Release pooled connections"""
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+# Shared fetcher used by the scrape command
+fetcher = WebFetcher(FetchCache())
+
+class ExtractionDone(Exception):
+    """Raised by TextCollector once the character budget is spent"""
+
+class TextCollector:
+    """Parser target that keeps cleaned text, skips unwanted subtrees and stops at a budget"""
+
+    def __init__(self, budget: int = SCRAPE_TRUNCATE_AT):
+        self.budget = budget
+        self.size = 0
+        self.skip_depth = 0
+        self.pending: List[str] = []
+        self.chunks: List[str] = []
+
+    def start(self, tag: str, attrs=None) -> None:
+        self._flush()
+        if tag.lower() in SCRAPE_SKIP_TAGS:
+            self.skip_depth += 1
+
+    def end(self, tag: str) -> None:
+        self._flush()
+        if self.skip_depth and tag.lower() in SCRAPE_SKIP_TAGS:
+            self.skip_depth -= 1
+
+    def data(self, text: str) -> None:
+        # Parsers may split one text node across several calls (e.g. around entities)
+        if not self.skip_depth:
+            self.pending.append(text)
+
+    def _flush(self) -> None:
+        """Clean the buffered text node the same way the get_text() pipeline does"""
+        if not self.pending:
+            return
+        text = "".join(self.pending)
+        self.pending = []
+        for line in text.splitlines():
+            for phrase in line.split("  "):
+                phrase = phrase.strip()
+                if phrase:
+                    self.chunks.append(phrase)
+                    self.size += len(phrase) + 1
+        if self.size > self.budget:
+            raise ExtractionDone()
+
+    def close(self) -> str:
+        try:
+            self._flush()
+        except ExtractionDone:
+            pass
+        return truncate_text('\n'.join(self.chunks))
+
+class StreamingExtractor(HTMLParser):
+    """Standard library tokenizer feeding a TextCollector without building a tree"""
 
-        soup = BeautifulSoup(response.text, 'html.parser')
+    def __init__(self, collector: TextCollector):
+        super().__init__(convert_charrefs=True)
+        self.collector = collector
 
-        # Remove script and style elements
-        for script in soup(["script", "style", "header", "footer", "nav"]):
-            script.extract()
+    def handle_starttag(self, tag, attrs):
+        self.collector.start(tag)
 
-        # Extract text content
-        text = soup.get_text(separator='\n')
+    def handle_endtag(self, tag):
+        self.collector.end(tag)
 
-        # Clean up the text (remove extra whitespace)
-        lines = (line.strip() for line in text.splitlines())
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        text = '\n'.join(chunk for chunk in chunks if chunk)
+    def handle_data(self, data):
+        self.collector.data(data)
 
-        # Truncate if too long
-        if len(text) > 18000:
-            text = text[:8000] + "... [content truncated]"
+def truncate_text(text: str) -> str:
+    """Apply the scrape length limit"""
+    if len(text) > SCRAPE_TRUNCATE_AT:
+        text = text[:SCRAPE_KEEP_CHARS] + "... [content truncated]"
+    return text
 
-        return text
+def extract_text_stream(html: str) -> str:
+    """Extract text with the standard library tokenizer, stopping once the budget is reached"""
+    collector = TextCollector()
+    parser = StreamingExtractor(collector)
+    try:
+        for i in range(0, len(html), SCRAPE_FEED_SIZE):
+            parser.feed(html[i:i + SCRAPE_FEED_SIZE])
+        parser.close()
+    except ExtractionDone:
+        pass
+    return collector.close()
+
+def extract_text_lxml(html: str) -> str:
+    """Extract text with lxml's C parser in target mode, so no tree is built"""
+    collector = TextCollector()
+    parser = load_lxml().HTMLParser(target=collector)
+    try:
+        for i in range(0, len(html), SCRAPE_FEED_SIZE):
+            parser.feed(html[i:i + SCRAPE_FEED_SIZE])
+        parser.close()
+    except ExtractionDone:
+        pass
+    return collector.close()
+
+def extract_text_bs4(html: str) -> str:
+    """Extract text by building a full BeautifulSoup tree"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+
+    # Remove script and style elements
+    for script in soup(list(SCRAPE_SKIP_TAGS)):
+        script.extract()
+
+    # Extract text content
+    text = soup.get_text(separator='\n')
+
+    # Clean up the text (remove extra whitespace)
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    return truncate_text('\n'.join(chunk for chunk in chunks if chunk))
+
+EXTRACTORS = {
+    "lxml": extract_text_lxml,
+    "stream": extract_text_stream,
+    "bs4": extract_text_bs4
+}
+
+def extract_text(html: str, backend: Optional[str] = None) -> str:
+    """Extract readable text from an HTML document with the configured backend"""
+    backend = backend or SCRAPE_EXTRACTOR
+    if backend == "auto":
+        backend = "lxml" if load_lxml() is not None else "stream"
+    elif backend == "lxml" and load_lxml() is None:
+        logging.warning("lxml is not installed; falling back to the streaming extractor")
+        backend = "stream"
+    return EXTRACTORS[backend](html)
+
+async def fetch_page_text(url: str) -> str:
+    """Fetch a page and extract its text in a worker thread; raises on failure"""
+    started = time.perf_counter()
+    html = await fetcher.fetch(normalize_url(url))
+    fetched = time.perf_counter()
+    text = await asyncio.get_running_loop().run_in_executor(None, extract_text, html)
+    metrics.record("scrape", fetch_seconds=fetched - started, parse_seconds=time.perf_counter() - fetched,
+                   html_bytes=len(html), text_chars=len(text))
+    return text
+
+async def scrape_website(url: str) -> str:
+    """Scrapes content from a website URL"""
+    try:
+        return await fetch_page_text(url)
     except Exception as e:
         logging.error(f"Error scraping website: {str(e)}")
         return f"Error scraping website: {str(e)}"
 
+async def scrape_many(urls: List[str], workers: int = FETCH_CONCURRENCY):
+    """Scrape several URLs concurrently, yielding (url, text, seconds, error) as each page finishes"""
+    semaphore = asyncio.Semaphore(workers)
+
+    async def scrape_one(url: str):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                text = await fetch_page_text(url)
+                return url, text, time.perf_counter() - start, None
+            except Exception as e:
+                logging.error(f"Error scraping {url}: {str(e)}")
+                return url, None, time.perf_counter() - start, str(e)
+
+    tasks = [asyncio.ensure_future(scrape_one(url)) for url in urls]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def parse_scrape_targets(args: str) -> List[str]:
+    """Expand scrape arguments into URLs; '@file' reads one URL per line"""
+    urls = []
+    for arg in args.split():
+        if arg.startswith("@"):
+            with open(session_path(arg[1:]), "r", encoding="utf-8") as f:
+                urls.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+        else:
+            urls.append(arg)
+    # Keep the first occurrence of each URL
+    return list(dict.fromkeys(urls))
+
+class CodeBlock:
+    """A fenced code block found in a response"""
+
+    def __init__(self, language: str, code: str, complete: bool = True):
+        self.language = language
+        self.code = code
+        self.complete = complete
+
+class CodeBlockParser:
+    """Incremental markdown fence parser fed with streamed text
+
+    Blocks are appended to self.blocks, and passed to on_block, as soon as
+    their closing fence arrives, so the full response never has to be
+    scanned again.
+    """
+
+    def __init__(self, on_block: Optional[Callable[[CodeBlock], None]] = None):
+        self.on_block = on_block
+        self.blocks: List[CodeBlock] = []
+        self.partial: List[str] = []  # pieces of the current unfinished line
+        self.fence: Optional[str] = None
+        self.language = ""
+        self.lines: List[str] = []
+
+    def feed(self, text: str) -> None:
+        """Consume a chunk of streamed text"""
+        self.partial.append(text)
+        if "\n" not in text:
+            return
+        *complete, rest = "".join(self.partial).split("\n")
+        self.partial = [rest] if rest else []
+        for line in complete:
+            self._line(line)
+
+    def close(self) -> None:
+        """Finish the stream; an unterminated block is kept and marked incomplete"""
+        if self.partial:
+            self._line("".join(self.partial))
+            self.partial = []
+        if self.fence is not None:
+            self._emit(CodeBlock(self.language, self._code(), complete=False))
+            self.fence = None
+
+    def _code(self) -> str:
+        return "\n".join(self.lines) + "\n" if self.lines else ""
+
+    def _emit(self, block: CodeBlock) -> None:
+        self.blocks.append(block)
+        if self.on_block:
+            self.on_block(block)
+
+    def _line(self, line: str) -> None:
+        stripped = line.strip()
+        if self.fence is None:
+            if stripped.startswith("```") or stripped.startswith("~~~"):
+                marker = stripped[0]
+                self.fence = marker * (len(stripped) - len(stripped.lstrip(marker)))
+                self.language = stripped[len(self.fence):].strip()
+                self.lines = []
+        elif stripped.startswith(self.fence) and not stripped.lstrip(self.fence[0]):
+            self._emit(CodeBlock(self.language, self._code()))
+            self.fence = None
+        else:
+            self.lines.append(line)
+
+def extract_code_blocks(response_text: str) -> List[CodeBlock]:
+    """Every fenced code block in a finished response"""
+    parser = CodeBlockParser()
+    parser.feed(response_text)
+    parser.close()
+    return parser.blocks
+
 def extract_code_from_response(response_text: str) -> Optional[list]:
     """Extract code from a response containing markdown code blocks"""
-    if "```" not in response_text:
+    blocks = extract_code_blocks(response_text)
+    if not blocks:
         return None
-
-    # Extract code between first pair of ``` markers
-    parts = response_text.split("```", 2)
-    if len(parts) < 3:
-        return None
-
-    code_block = parts[1]
-
-    # Handle language identifier if present (e.g., ```python)
-    if "\n" in code_block:
-        lines = code_block.split("\n", 1)
-        if len(lines) > 1 and lines[0].strip():
-            language = lines[0].strip()  # Check if first line has content (language identifier)
-            return [lines[1], language]
-        return [code_block, ""]
-
-    return [code_block, ""]
+    return [blocks[0].code, blocks[0].language]
 
 def determine_file_extension(language: str) -> str:
     """Determine file extension based on language identifier"""
@@ -223,65 +2075,417 @@ def determine_file_extension(language: str) -> str:
 
     return extensions.get(language, ".txt")
 
+def ends_with_partial_line(path: str) -> bool:
+    """True when a non-empty file does not end with a newline, as a crash mid-write leaves it"""
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return False
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) != b"\n"
+
+def encode_journal_record(message: Dict[str, Any], compress: bool = True) -> str:
+    """One JSONL line for a message, compressing large ones unless compress is off"""
+    record = {"time": round(time.time(), 3), "role": message["role"], "content": message["content"]}
+    line = json.dumps(record, ensure_ascii=False)
+    if compress and len(line) >= JOURNAL_COMPRESS_MIN:
+        packed = base64.b64encode(zlib.compress(json.dumps(message["content"], ensure_ascii=False).encode("utf-8"))).decode("ascii")
+        line = json.dumps({"time": record["time"], "role": message["role"], "zlib": packed})
+    return line
+
+def decode_journal_record(line: str) -> Optional[Dict[str, Any]]:
+    """The message stored in a journal line, or None for a torn or unreadable line"""
+    try:
+        record = json.loads(line)
+        if "zlib" in record:
+            content = json.loads(zlib.decompress(base64.b64decode(record["zlib"])).decode("utf-8"))
+        else:
+            content = record["content"]
+        return {"role": record["role"], "content": content}
+    except (ValueError, KeyError, TypeError, zlib.error):
+        return None
+
+def read_journal_tail(path: str, turns: int = JOURNAL_RESUME_TURNS) -> List[Dict[str, Any]]:
+    """Read the last `turns` user/assistant turns by scanning backwards from the end of the file"""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b""
+        messages: List[Dict[str, Any]] = []
+        user_messages = 0
+        while position > 0 and user_messages < turns:
+            step = min(JOURNAL_TAIL_BLOCK, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+            lines = data.split(b"\n")
+            # The first line may be cut by the block boundary; keep it for the next pass
+            data = lines[0] if position > 0 else b""
+            complete = lines[1:] if position > 0 else lines
+            for raw in reversed(complete):
+                message = decode_journal_record(raw.decode("utf-8", errors="replace")) if raw.strip() else None
+                if message is None:
+                    continue
+                messages.append(message)
+                if message["role"] == "user":
+                    user_messages += 1
+                    if user_messages >= turns:
+                        break
+    messages.reverse()
+    # A conversation must open with a user message
+    while messages and messages[0]["role"] != "user":
+        messages.pop(0)
+    return messages
+
+class SessionJournal:
+    """Append-only JSONL record of the conversation, written turn by turn
+
+    The journal file is created on the first finished turn and listed in
+    SESSIONS_INDEX. Lines are flushed immediately so a crash of this process
+    loses nothing; fsync is batched to at most once per fsync_interval,
+    and a turn written within the interval is synced when it ends.
+    """
+
+    def __init__(self, directory: str = SESSIONS_DIR, fsync_interval: float = JOURNAL_FSYNC_INTERVAL, compress: bool = True):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.compress = compress
+        self.session_id: Optional[str] = None
+        self.file = None
+        self.last_sync = 0.0
+        self.unsynced = False
+        self.sync_timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def index_path(self) -> str:
+        """Append-only list of sessions, one JSON line each"""
+        return os.path.join(self.directory, "index.jsonl")
+
+    def path_for(self, session_id: str) -> str:
+        """Journal file of a session"""
+        return os.path.join(self.directory, f"{session_id}.jsonl")
+
+    def _open(self, first_message: Optional[Dict[str, Any]]) -> None:
+        """Start a new session file and add it to the index"""
+        os.makedirs(self.directory, exist_ok=True)
+        if self.session_id is None:
+            base = time.strftime("%Y%m%d-%H%M%S")
+            self.session_id = base
+            suffix = 1
+            while os.path.exists(self.path_for(self.session_id)):
+                suffix += 1
+                self.session_id = f"{base}-{suffix}"
+            title = ""
+            if first_message and isinstance(first_message["content"], str):
+                title = " ".join(first_message["content"].split())[:80]
+            with open(self.index_path, "a", encoding="utf-8") as index:
+                index.write(json.dumps({"id": self.session_id, "started": round(time.time(), 3), "title": title}, ensure_ascii=False) + "\n")
+        path = self.path_for(self.session_id)
+        torn = ends_with_partial_line(path)
+        self.file = open(path, "a", encoding="utf-8")
+        if torn:
+            # Close off a line cut short by a crash so the next record starts cleanly
+            self.file.write("\n")
+
+    def append(self, messages: List[Dict[str, Any]]) -> None:
+        """Write finished messages to the end of the journal"""
+        if not messages:
+            return
+        if self.file is None:
+            self._open(messages[0])
+        self.file.write("".join(encode_journal_record(message, self.compress) + "\n" for message in messages))
+        self.file.flush()
+        self.unsynced = True
+        wait = self.fsync_interval - (time.monotonic() - self.last_sync)
+        if wait <= 0:
+            self.sync()
+        elif self.sync_timer is None:
+            # Sync later even if no other turn comes, so an idle session's last turn reaches the disk
+            try:
+                self.sync_timer = asyncio.get_running_loop().call_later(wait, self.sync)
+            except RuntimeError:
+                self.sync()  # No event loop to come back on
+
+    def sync(self) -> None:
+        """Force written records to disk"""
+        if self.sync_timer is not None:
+            self.sync_timer.cancel()
+            self.sync_timer = None
+        if self.file is not None and self.unsynced:
+            os.fsync(self.file.fileno())
+            self.unsynced = False
+            self.last_sync = time.monotonic()
+
+    def resume(self, session_id: str) -> None:
+        """Continue appending to an existing session"""
+        self.close()
+        self.session_id = session_id
+        self._open(None)
+
+    def close(self) -> None:
+        """Sync and close the journal; the next turn starts a new session unless resume is called"""
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+        self.session_id = None
+
+    def sessions(self) -> List[Dict[str, Any]]:
+        """Indexed sessions, newest first, with their journal size and last write time"""
+        if not os.path.exists(self.index_path):
+            return []
+        found = []
+        with open(self.index_path, "r", encoding="utf-8") as index:
+            for line in index:
+                try:
+                    entry = json.loads(line)
+                    stat = os.stat(self.path_for(entry["id"]))
+                except (ValueError, KeyError, OSError):
+                    continue
+                entry["bytes"] = stat.st_size
+                entry["updated"] = stat.st_mtime
+                found.append(entry)
+        found.reverse()
+        return found
+
+# The local console's session, used wherever no server connection has set its own
+local_session = Session()
+current_session: contextvars.ContextVar = contextvars.ContextVar("current_session", default=local_session)
+
+def get_session() -> Session:
+    """Session of the command being run"""
+    return current_session.get()
+
+def session_path(filename: str) -> str:
+    """Path of a file named by the user, confined to the session's working directory if it has one
+
+    Raises PermissionError for a path leading out of that directory, so
+    server sessions cannot read, overwrite or run each other's files.
+    """
+    workdir = get_session().workdir
+    if workdir is None:
+        return filename
+    path = os.path.realpath(os.path.join(workdir, filename))
+    if os.path.commonpath([path, workdir]) != workdir:
+        raise PermissionError(f"{filename} is outside this session's directory")
+    return path
+
 def save_conversation(filename: str = None) -> None:
-    """Save the current conversation to a file"""
-    if not msgMemory:
+    """Report the session journal, or copy it to a file"""
+    journal = get_session().journal
+    if journal.session_id is None:
         print(f"{BLUE}System>> {RESET}No conversation to save.")
         return
 
     if not filename:
-        timestamp = time.strftime("%Y%m%d-%H%M%S")
-        filename = f"conversation_{timestamp}.json"
+        journal.sync()
+        print(f"{GREEN}System>> {RESET}Conversation is saved automatically as session {journal.session_id} ({journal.path_for(journal.session_id)})")
+        return
 
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(msgMemory, f, indent=2)
+        journal.sync()
+        with open(journal.path_for(journal.session_id), "rb") as src, open(session_path(filename), "wb") as dst:
+            while True:
+                block = src.read(JOURNAL_TAIL_BLOCK)
+                if not block:
+                    break
+                dst.write(block)
         print(f"{GREEN}System>> {RESET}Conversation saved to {filename}")
     except Exception as e:
         print(f"{RED}System>> Error saving conversation: {str(e)}{RESET}")
         logging.error(f"Error saving conversation: {str(e)}")
 
-def load_conversation(filename: str) -> None:
-    """Load a conversation from a file"""
-    global msgMemory
-
+def is_json_conversation(path: str) -> bool:
+    """True for a file in the old whole-conversation JSON format, a list, rather than a journal of one object per line"""
+    with open(path, "rb") as f:
+        start = f.read(64).lstrip(b"\xef\xbb\xbf \t\r\n")
+    return start.startswith(b"[")
+
+def load_conversation(target: str, turns: int = JOURNAL_RESUME_TURNS) -> None:
+    """Resume a journaled session by id or path, reading only its last turns
+
+    Files in the old whole-conversation JSON format are still accepted and
+    are copied into a new journal; the format is told from the content,
+    since journals saved with 'save' may also be named *.json.
+    """
+    session = get_session()
+    journal, memory = session.journal, session.memory
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            loaded_memory = json.load(f)
-
-        msgMemory = loaded_memory
-        print(f"{GREEN}System>> {RESET}Loaded conversation with {len(msgMemory)} messages from {filename}")
+        path = session_path(target)
+        if not os.path.exists(path):
+            if os.path.basename(target) != target:
+                raise FileNotFoundError(f"No saved session or file named {target}")
+            # Only this session's own journal directory is searched for ids
+            path = journal.path_for(target)
+        if is_json_conversation(path):
+            with open(path, 'r', encoding='utf-8-sig') as f:
+                loaded_memory = json.load(f)
+            journal.close()
+            memory[:] = loaded_memory
+            journal.append(memory)
+        else:
+            loaded_memory = read_journal_tail(path, turns)
+            session_id = os.path.splitext(os.path.basename(path))[0]
+            if os.path.abspath(os.path.dirname(path)) == os.path.abspath(journal.directory):
+                journal.resume(session_id)
+            else:
+                # A journal copied elsewhere is continued as a new session
+                journal.close()
+                journal.append(loaded_memory)
+            memory[:] = loaded_memory
+        print(f"{GREEN}System>> {RESET}Loaded conversation with {len(memory)} messages from {path}")
     except Exception as e:
         print(f"{RED}System>> Error loading conversation: {str(e)}{RESET}")
         logging.error(f"Error loading conversation: {str(e)}")
 
-def runPyFile(filename: str) -> str:
-    """Run a Python file and return its output"""
+def list_sessions(limit: int = 20) -> None:
+    """Show the most recent journaled sessions"""
+    journal = get_session().journal
+    try:
+        sessions = journal.sessions()
+    except OSError as e:
+        print(f"{RED}System>> Error reading session index: {str(e)}{RESET}")
+        return
+    if not sessions:
+        print(f"{BLUE}System>> {RESET}No saved sessions.")
+        return
+    print(f"{BLUE}System>> {RESET}Recent sessions (load <id> [turns] to resume):")
+    for entry in sessions[:limit]:
+        updated = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["updated"]))
+        current = " (current)" if entry["id"] == journal.session_id else ""
+        print(f"{BLUE}System>> {RESET}  {entry['id']:<20} {updated}  {entry['bytes'] / 1024:8.1f} KB  {entry['title']}{current}")
+
+# Shared by every session so a busy server does not run an unbounded number of generated files
+exec_slots = asyncio.Semaphore(EXEC_CONCURRENCY)
+
+class ExecutionResult:
+    """Outcome of running a Python file"""
+
+    def __init__(self):
+        self.returncode: Optional[int] = None
+        self.runtime = 0.0
+        self.peak_rss: Optional[int] = None  # bytes
+        self.tail = ""
+        self.stopped: Optional[str] = None  # why the process was stopped early
+
+def apply_limits(pid: int) -> None:
+    """Set CPU and memory rlimits on a started process (Linux)"""
+    if resource is None or not hasattr(resource, "prlimit"):
+        return
+    try:
+        resource.prlimit(pid, resource.RLIMIT_CPU, (EXEC_CPU_SECONDS, EXEC_CPU_SECONDS + 1))
+        resource.prlimit(pid, resource.RLIMIT_AS, (EXEC_MEMORY_BYTES, EXEC_MEMORY_BYTES))
+    except (OSError, ValueError) as e:
+        logging.error(f"Could not apply execution limits: {str(e)}")
+
+def read_peak_rss(pid: int) -> Optional[int]:
+    """Peak resident set size of a running process from /proc (Linux)"""
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def kill_process(process) -> None:
+    """Kill a process and anything it started"""
     try:
-        result = subprocess.run(['python', filename], capture_output=True, text=True, check=True)
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Python execution error: {e.stderr}")
-        return f"{RED}Error: {e.stderr}{RESET}"
+        if os.name != "nt":
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+async def runPyFile(filename: str) -> ExecutionResult:
+    """Run a Python file in the sandbox, waiting while EXEC_CONCURRENCY runs are already going"""
+    async with exec_slots:
+        return await run_sandboxed(filename)
+
+async def run_sandboxed(filename: str) -> ExecutionResult:
+    """Run a Python file with the current interpreter, streaming its output under time, CPU, memory and output limits"""
+    result = ExecutionResult()
+    started = time.perf_counter()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-u", filename,  # Unbuffered, or output to a pipe would only arrive in blocks
+            cwd=get_session().workdir,
+            stdin=asyncio.subprocess.DEVNULL,  # The console owns stdin
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=os.name != "nt"
+        )
     except Exception as e:
         logging.error(f"Execution error: {str(e)}")
-        return f"{RED}Execution error: {str(e)}{RESET}"
-
-def config(type: str) -> None:
-    """Handle configuration changes"""
-    global model, models, prompt, speed
+        result.stopped = f"could not start: {str(e)}"
+        return result
+    apply_limits(process.pid)
+    output_size = 0
+
+    async def pump(stream, color: str) -> None:
+        nonlocal output_size
+        while True:
+            chunk = await stream.read(4096)
+            if not chunk:
+                return
+            output_size += len(chunk)
+            if output_size > EXEC_MAX_OUTPUT:
+                result.stopped = f"output limit of {EXEC_MAX_OUTPUT} bytes reached"
+                kill_process(process)
+                return
+            text = chunk.decode("utf-8", errors="replace")
+            print(f"{color}{text}{RESET}" if color else text, end="", flush=True)
+            result.tail = (result.tail + text)[-EXEC_TAIL_CHARS:]
+
+    async def watch_memory() -> None:
+        while True:
+            rss = read_peak_rss(process.pid)
+            if rss is not None:
+                result.peak_rss = max(result.peak_rss or 0, rss)
+            await asyncio.sleep(0.1)
+
+    async def run() -> None:
+        await asyncio.gather(pump(process.stdout, ""), pump(process.stderr, RED))
+        await process.wait()
+
+    watcher = asyncio.ensure_future(watch_memory())
+    try:
+        await asyncio.wait_for(run(), timeout=EXEC_TIMEOUT)
+    except asyncio.TimeoutError:
+        result.stopped = f"time limit of {EXEC_TIMEOUT}s reached"
+        kill_process(process)
+        await process.wait()
+    except asyncio.CancelledError:
+        kill_process(process)
+        await process.wait()
+        raise
+    finally:
+        watcher.cancel()
+        result.runtime = time.perf_counter() - started
+
+    result.returncode = process.returncode
+    if result.stopped is None and resource is not None and process.returncode == -signal.SIGXCPU:
+        result.stopped = f"CPU limit of {EXEC_CPU_SECONDS}s reached"
+    if result.returncode:
+        logging.error(f"Python execution of {filename} exited with {result.returncode}")
+    return result
+
+async def config(type: str) -> None:
+    """Handle configuration changes for the current session"""
+    session = get_session()
 
     if type.lower() == "m":
         print(f"{BLUE}System>> {RESET}Current models:")
         for i, m in enumerate(models):
             print(f"{BLUE}System>> {RESET}\t{i}: {m}")
-        print(f"{BLUE}System>> {RESET}Current model in use: {models[model]}")
+        print(f"{BLUE}System>> {RESET}Current model in use: {models[session.model]}")
 
         try:
-            new_model = int(input("Config>> Enter the model number to use: "))
+            new_model = int(await ainput("Config>> Enter the model number to use: "))
             if 0 <= new_model < len(models):
-                model = new_model
-                print(f"{BLUE}System>> {RESET}Model changed to: {models[model]}")
+                session.model = new_model
+                print(f"{BLUE}System>> {RESET}Model changed to: {models[session.model]}")
                 save_config()
             else:
                 print(f"{RED}Invalid model number. Please choose between 0 and {len(models)-1}{RESET}")
@@ -289,28 +2493,53 @@ def config(type: str) -> None:
             print(f"{RED}Please enter a valid number{RESET}")
 
     elif type.lower() == "p":
-        print(f"{BLUE}System>> {RESET}Current prompt: {prompt}")
-        prompt = input("Config>> Enter a new prompt: ")
-        print(f"{BLUE}System>> {RESET}Prompt changed to: {prompt}")
+        print(f"{BLUE}System>> {RESET}Current prompt: {session.prompt}")
+        session.prompt = await ainput("Config>> Enter a new prompt: ")
+        print(f"{BLUE}System>> {RESET}Prompt changed to: {session.prompt}")
         save_config()
 
     elif type.lower() == "s":
-        print(f"{BLUE}System>> {RESET}Current speed: {speed}")
+        print(f"{BLUE}System>> {RESET}Current speed: {session.speed}")
         try:
-            speed = float(input("Config>> Enter a new speed (in seconds): "))
-            print(f"{BLUE}System>> {RESET}Speed changed to: {speed}")
+            session.speed = float(await ainput("Config>> Enter a new speed (in seconds): "))
+            print(f"{BLUE}System>> {RESET}Speed changed to: {session.speed}")
             save_config()
         except ValueError:
             print(f"{RED}Please enter a valid number{RESET}")
 
+    elif type.lower() == "c":
+        print(f"{BLUE}System>> {RESET}Current context budget: {session.context_budget} tokens")
+        try:
+            new_budget = int(await ainput("Config>> Enter a new context budget (in tokens): "))
+            if new_budget > 0:
+                session.context_budget = new_budget
+                print(f"{BLUE}System>> {RESET}Context budget changed to: {session.context_budget} tokens")
+                save_config()
+            else:
+                print(f"{RED}Please enter a positive number{RESET}")
+        except ValueError:
+            print(f"{RED}Please enter a valid number{RESET}")
+
+    elif type.lower() == "j":
+        state = "on" if session.journal.compress else "off"
+        print(f"{BLUE}System>> {RESET}Journal compression is {state}: messages over {JOURNAL_COMPRESS_MIN // 1024} KB are stored zlib-compressed.")
+        choice = (await ainput("Config>> Compress large messages in the journal? (y/n): ")).strip().lower()
+        if choice in ["y", "n"]:
+            session.journal.compress = choice == "y"
+            print(f"{BLUE}System>> {RESET}Journal compression turned {'on' if session.journal.compress else 'off'}.")
+            save_config()
+        else:
+            print(f"{RED}Please enter y or n{RESET}")
+
     elif type.lower() == "e":
         print(f"{BLUE}System>> {RESET}Exiting configuration...")
     else:
-        print(f"{RED}Unknown configuration option. Choose (m)odel, (p)rompt, (s)peed, or (e)xit{RESET}")
+        print(f"{RED}Unknown configuration option. Choose (m)odel, (p)rompt, (s)peed, (c)ontext, (j)ournal compression, or (e)xit{RESET}")
 
 def clear_screen() -> None:
     """Clear the terminal screen"""
-    os.system('cls' if os.name == 'nt' else 'clear')
+    # ANSI erase-display and cursor-home, instead of starting a cls/clear subprocess
+    print("\033[2J\033[3J\033[H", end="", flush=True)
 
 def menu() -> None:
     """Display the main menu"""
@@ -318,7 +2547,8 @@ def menu() -> None:
 
     # Get terminal width (fallback to 80 if can't determine)
     try:
-        terminal_width = os.get_terminal_size().columns
+        # Server clients get the fallback; this process's terminal is not theirs
+        terminal_width = os.get_terminal_size().columns if get_session().output is None else 80
     except:
         terminal_width = 80
 
@@ -330,13 +2560,20 @@ def menu() -> None:
     print("Commands:".center(terminal_width))
 
     commands = [
-        "- 'scrape [url]' to retrieve information from a website",
+        "- 'scrape [url ...]' or 'scrape @urls.txt' to retrieve information from websites",
         "- 'read [filename] [question]' to read a file and ask about it",
-        "- 'save [filename]' to save the conversation",
-        "- 'load [filename]' to load a saved conversation",
-        "- 'settings' or 'config' to change model, prompt or speed",
-        "- 'memory' or 'mem' to view message memory size",
+        "- 'save [filename]' to show where the conversation is saved, or copy it to a file",
+        "- 'load [session|filename] [turns]' to resume a saved conversation",
+        "- 'sessions' to list saved conversations",
+        "- 'settings' or 'config' to change model, prompt, speed, context budget or journal compression",
+        "- 'memory' or 'mem' to view message memory size and tokens",
         "- 'reset' to clear message memory",
+        "- 'cache [stats|clear|on|off]' to manage the local response cache",
+        "- 'index [stats|clear|on|off]' to send only relevant parts of read/scraped documents",
+        "- 'multi [off|compare|race|draft] [model numbers]' to send each question to several models",
+        "- 'limits [command] [tokens]' or 'limits stop [\"sequence\" ...]' to cap answers",
+        "- 'stats' to show latency and throughput for this session",
+        "- 'cancel' to stop the response in flight (Ctrl-C in the local console)",
         "- 'test' or 'testfile' to create and analyze a file",
         "- 'clear' or 'cls' to clear the screen",
         "- 'cd' to view the current directory",
@@ -353,80 +2590,734 @@ def menu() -> None:
 
     print(f"{ORANGE}" + "=" * terminal_width + RESET)
 
+ELIDED_SUFFIX = "elided to save context ...]"
+
+def estimate_tokens(text: str) -> int:
+    """Cheap local token estimate"""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def count_tokens(messages: List[Dict[str, Any]]) -> int:
+    """Estimated tokens for a list of messages"""
+    return sum(estimate_tokens(message["content"]) for message in messages)
+
+def fit_context(messages: List[Dict[str, Any]], budget: int) -> None:
+    """Shrink messages in place until they fit the token budget
+
+    Older long messages (file and scrape bodies) are elided first, then the
+    oldest turns are dropped. The most recent messages are left untouched.
+    """
+    total = count_tokens(messages)
+    if total <= budget:
+        return
+    before = total
+    elided = dropped = 0
+
+    for message in messages[:-CONTEXT_KEEP_MESSAGES]:
+        if total <= budget:
+            break
+        content = message["content"]
+        if len(content) > CONTEXT_ELIDE_CHARS and not content.endswith(ELIDED_SUFFIX):
+            removed = estimate_tokens(content[CONTEXT_ELIDE_CHARS:])
+            message["content"] = content[:CONTEXT_ELIDE_CHARS] + f"\n[... ~{removed} tokens of earlier content {ELIDED_SUFFIX}"
+            total = count_tokens(messages)
+            elided += 1
+
+    # Drop whole turns from the front, keeping the latest message and a user message first
+    while total > budget and len(messages) > 1:
+        messages.pop(0)
+        dropped += 1
+        while len(messages) > 1 and messages[0]["role"] != "user":
+            messages.pop(0)
+            dropped += 1
+        total = count_tokens(messages)
+
+    print(f"{BLUE}System>> {RESET}Context over budget: elided {elided} and dropped {dropped} messages (~{before} -> ~{total} tokens).")
+    logging.info(f"Context compacted: elided {elided}, dropped {dropped}, {before} -> {total} tokens")
+    if total > budget:
+        print(f"{RED}System>> The latest message alone is ~{total} tokens, over the {budget} token budget.{RESET}")
+
+async def converse(content: str, attachment: Optional[str] = None) -> str:
+    """Send a user message, stream the reply and record both in memory
+
+    An attachment (retrieved excerpts) is sent with this turn only and is
+    not kept in memory, so later turns do not carry it again.
+    """
+    session = get_session()
+    memory = session.memory
+    message = {"role": "user", "content": content}
+    memory.append(message)
+    fit_context(memory, session.context_budget)
+
+    request_messages = memory
+    if attachment:
+        request_messages = memory[:-1] + [{"role": "user", "content": content + "\n" + attachment}]
+
+    try:
+        if session.multi_mode != "off":
+            response_text = await fan_out(request_messages, session.multi_mode)
+        else:
+            # Stream the response with retry logic
+            response_text = await stream_with_retry(
+                messages=request_messages,
+                model=models[session.model]
+            )
+    except asyncio.CancelledError:
+        # Drop the unanswered message so the conversation stays well formed
+        if memory and memory[-1] is message:
+            memory.pop()
+        raise
+
+    # Add Claude's response to memory
+    if response_text:
+        reply = {"role": "assistant", "content": response_text}
+        memory.append(reply)
+        try:
+            session.journal.append([message, reply])
+        except OSError as e:
+            print(f"{RED}System>> Error writing session journal: {str(e)}{RESET}")
+            logging.error(f"Error writing session journal: {str(e)}")
+    return response_text
+
+async def offer_code_blocks(blocks: List[CodeBlock]) -> None:
+    """Offer to write the code blocks of a response to files and run Python ones"""
+    if not blocks:
+        return
+
+    if len(blocks) == 1:
+        write_choice = await ainput(f"{BLUE}System>> {RESET}Detected code block in response. Do you want to write it to a file? (y/n): ")
+        selected = blocks if write_choice.lower() == "y" else []
+    else:
+        print(f"{BLUE}System>> {RESET}Detected {len(blocks)} code blocks in response:")
+        for i, block in enumerate(blocks, 1):
+            note = "" if block.complete else ", incomplete"
+            print(f"{BLUE}System>> {RESET}\t{i}: {block.language or 'plain'} ({block.code.count(chr(10))} lines{note})")
+        choice = (await ainput(f"{BLUE}System>> {RESET}Which blocks do you want to write to files? (all, none, or numbers like 1,3): ")).strip().lower()
+        if choice in ["all", "a", "y"]:
+            selected = blocks
+        else:
+            selected = []
+            for part in choice.replace(",", " ").split():
+                if part.isdigit() and 1 <= int(part) <= len(blocks):
+                    selected.append(blocks[int(part) - 1])
+
+    used_names = set()
+    for block in selected:
+        # Determine file extension
+        file_extension = determine_file_extension(block.language)
+        default_filename = f"new_file{file_extension}"
+        counter = 2
+        while default_filename in used_names:
+            default_filename = f"new_file_{counter}{file_extension}"
+            counter += 1
+
+        print(f"{BLUE}System>> {RESET}Default filename: {default_filename}")
+        rename_choice = await ainput(f"{BLUE}System>> {RESET}Do you want to rename the file? (y/n): ")
+
+        if rename_choice.lower() == "y":
+            custom_filename = await ainput(f"{BLUE}System>> {RESET}Enter new filename (without extension): ")
+            # Ensure the extension stays the same
+            new_filename = f"{custom_filename}{file_extension}"
+        else:
+            new_filename = default_filename
+        used_names.add(new_filename)
+
+        try:
+            path = session_path(new_filename)
+        except PermissionError as e:
+            print(f"{RED}System>> {str(e)}{RESET}")
+            continue
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(block.code)
+        print(f"{BLUE}System>> {RESET}{new_filename} created.")
+
+        # Ask about running the file if it's a Python file
+        if file_extension == ".py" and not get_session().allow_exec:
+            print(f"{BLUE}System>> {RESET}Running code is turned off on this server.")
+        elif file_extension == ".py":
+            run_choice = await ainput(f"{BLUE}System>> {RESET}Would you like to run {new_filename}? (y/n): ")
+            if run_choice.lower() == "y":
+                print(f"{BLUE}System>> {RESET}Running {new_filename}...")
+                result = await runPyFile(path)
+                if result.tail and not result.tail.endswith("\n"):
+                    print()
+                memory = f", peak memory {result.peak_rss / 1024 / 1024:.1f} MB" if result.peak_rss else ""
+                stopped = f" Stopped: {result.stopped}." if result.stopped else ""
+                print(f"{BLUE}System>> {RESET}{new_filename} execution completed with exit code {result.returncode} in {result.runtime:.2f}s{memory}.{stopped}")
+                metrics.record("exec", seconds=result.runtime, peak_rss=result.peak_rss or 0, returncode=result.returncode)
+
+                feedback = await ainput(f"{BLUE}System>> {RESET}Send the output to Claude so it can iterate on the code? (y/n): ")
+                if feedback.lower() == "y":
+                    await handle_chat(
+                        f"I ran {new_filename}. It exited with code {result.returncode} after {result.runtime:.2f}s.{stopped} "
+                        f"Last {EXEC_TAIL_CHARS} characters of output:\n```\n{result.tail}\n```"
+                    )
+
+def iter_file_chunks(filename: str, chunk_chars: int) -> Iterator[str]:
+    """Yield a text file in pieces of about chunk_chars characters, split at line ends"""
+    with open(filename, "r", encoding="utf-8", errors="replace") as f:
+        yield from iter_text_chunks(f, chunk_chars)
+
+async def handle_large_file(filename: str, question: Optional[str] = None) -> None:
+    """Answer a question about a file too large for one message
+
+    Chunks are streamed from disk and each is answered concurrently on its
+    own (map); the per-chunk notes are then combined into one answer that
+    is streamed and kept in memory (reduce). At most READ_MAP_CONCURRENCY
+    chunks are held in memory at once.
+    """
+    size = os.path.getsize(filename)
+    chunk_chars = READ_CHUNK_TOKENS * CHARS_PER_TOKEN
+    expected = max(1, -(-size // chunk_chars))
+    print(f"{BLUE}System>> {RESET}{filename} is {size / 1024 / 1024:.1f} MB (~{size // CHARS_PER_TOKEN} tokens), too large to send at once.")
+    choice = await ainput(f"{BLUE}System>> {RESET}Answer by reading it in ~{expected} chunks ({expected} extra requests)? (y/n): ")
+    if choice.lower() != "y":
+        return
+
+    if not question:
+        question = await ainput("User>> ")
+
+    model_name = models[get_session().model]
+    semaphore = asyncio.Semaphore(READ_MAP_CONCURRENCY)
+    notes: Dict[int, str] = {}
+    failures = 0
+    started = time.perf_counter()
+
+    async def map_chunk(index: int, chunk: str) -> None:
+        nonlocal failures
+        chunk_started = time.perf_counter()
+        try:
+            text, usage = await request_with_retry([{
+                "role": "user",
+                "content": f"This is part {index + 1} of the file '{filename}'. Using only this part, write concise notes that help answer the question below. "
+                           f"Quote exact lines where useful. If this part contains nothing relevant, reply with exactly {READ_NOTHING_RELEVANT}.\n\n"
+                           f"QUESTION: {question}\n\nFILE PART:\n{chunk}"
+            }], model_name, echo=False, cache_messages=False, max_tokens=generation_budget("read_chunk"),
+                stop_sequences=[READ_NOTHING_RELEVANT])
+            notes[index] = text.strip()
+            metrics.record("read_chunk", seconds=time.perf_counter() - chunk_started, chars=len(chunk), **usage)
+            print(f"{BLUE}System>> {RESET}Chunk {index + 1}/~{expected} done in {time.perf_counter() - chunk_started:.2f}s.")
+        except Exception as e:
+            failures += 1
+            logging.error(f"Error reading chunk {index + 1} of {filename}: {str(e)}")
+            print(f"{RED}System>> Chunk {index + 1} failed: {str(e)}{RESET}")
+        finally:
+            semaphore.release()
+
+    tasks = []
+    try:
+        for index, chunk in enumerate(iter_file_chunks(filename, chunk_chars)):
+            # Only read the next chunk once a worker is free, so memory stays bounded
+            await semaphore.acquire()
+            tasks.append(asyncio.ensure_future(map_chunk(index, chunk)))
+        await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    relevant = [(i, notes[i]) for i in sorted(notes) if notes[i] and READ_NOTHING_RELEVANT not in notes[i][:len(READ_NOTHING_RELEVANT) + 5]]
+    print(f"{BLUE}System>> {RESET}Read {len(tasks)} chunks in {time.perf_counter() - started:.2f}s: {len(relevant)} relevant, {failures} failed.")
+
+    if relevant:
+        combined = "\n\n".join(f"--- Notes from part {i + 1} ---\n{note}" for i, note in relevant)
+    else:
+        combined = "No part of the file contained anything relevant."
+    response_text = await converse(
+        f"{question}\nUSER PROVIDED FILE '{filename}' was too large to send at once, so it was read in {len(tasks)} parts. "
+        f"Combine these notes into one answer:\n\n{combined}"
+    )
+    if response_text:
+        await offer_code_blocks(list(get_session().last_code_blocks))
+
+async def handle_indexed_file(filename: str, question: Optional[str] = None) -> None:
+    """Index a file and answer with only the chunks most relevant to the question"""
+    started = time.perf_counter()
+    chunks, reindexed = await asyncio.get_running_loop().run_in_executor(None, document_index.add_file, filename)
+    get_session().add_source(os.path.abspath(filename))
+    state = "indexed" if reindexed else "already indexed"
+    print(f"{BLUE}System>> {RESET}{filename} {state} ({chunks} chunks) in {time.perf_counter() - started:.2f}s.")
+
+    if not question:
+        question = await ainput("User>> ")
+
+    hits = document_index.search(question, [os.path.abspath(filename)])
+    if not hits:
+        # Nothing matched the question's words; fall back to the start of the file
+        hits = document_index.head(os.path.abspath(filename))
+    response_text = await converse(
+        f"{question}\n[Relevant excerpts of the user provided file '{filename}' were attached to this message.]",
+        f"EXCERPTS FROM USER PROVIDED FILE '{filename}' ({len(hits)} of {chunks} parts):\n{format_excerpts(hits)}"
+    )
+    if response_text:
+        await offer_code_blocks(list(get_session().last_code_blocks))
+
 async def handle_read_file(filename=None, question=None) -> None:
     """Handle the read file command with optional parameters"""
     if not filename:
-        filename = input(f"{BLUE}System>> {RESET}Enter the filename: ")
+        filename = await ainput(f"{BLUE}System>> {RESET}Enter the filename: ")
 
+    try:
+        filename = session_path(filename)
+    except PermissionError as e:
+        print(f"{RED}System>> {str(e)}{RESET}")
+        return
     if not os.path.exists(filename):
         print(f"{RED}System>> File not found: {filename}{RESET}")
         return
 
     try:
+        if get_session().retrieval_enabled:
+            await handle_indexed_file(filename, question)
+            return
+
+        if os.path.getsize(filename) > READ_LARGE_FILE_BYTES:
+            await handle_large_file(filename, question)
+            return
+
         with open(filename, "r", encoding="utf-8") as f:
             text = f.read()
         print(f"{BLUE}System>> {RESET}File read successfully.")
 
         if not question:
-            question = input("User>> ")
-
-        # Add the user message to memory
-        msgMemory.append({
-            "role": "user",
-            "content": question + "\nUSER PROVIDED FILE '" + filename + "' CONTENTS:\n" + text
-        })
-
-        # Stream the response with retry logic
-        response_text = await stream_with_retry(
-            messages=msgMemory,
-            model=models[model]
-        )
+            question = await ainput("User>> ")
+
+        response_text = await converse(question + "\nUSER PROVIDED FILE '" + filename + "' CONTENTS:\n" + text)
 
-        # Add Claude's response to memory
         if response_text:
-            msgMemory.append({
-                "role": "assistant",
-                "content": response_text
-            })
-
-            # Check for code blocks in response
-            if "```" in response_text:
-                write_choice = input(f"{BLUE}System>> {RESET}Detected code block in response. Do you want to write it to a file? (y/n): ")
-
-                if write_choice.lower() == "y":
-                    new_filename = input(f"{BLUE}System>> {RESET}What would you like to name the file? (default is a py file if no extension): ")
-
-                    if os.path.splitext(new_filename)[1] == "":
-                        new_filename += ".py"  # Add .py extension only if no extension exists
-
-                    code = extract_code_from_response(response_text)
-                    if code:
-                        with open(new_filename, "w", encoding="utf-8") as f:
-                            f.write(code)
-                        print(f"{BLUE}System>> {RESET}{new_filename} created.")
-
-                        # Ask about running the file
-                        if new_filename.endswith(".py"):
-                            run_choice = input(f"{BLUE}System>> {RESET}Would you like to run {new_filename}? (y/n): ")
-                            if run_choice.lower() == "y":
-                                print(f"{BLUE}System>> {RESET}Running {new_filename}...")
-                                output = runPyFile(new_filename)
-                                print(output)
-                                print(f"{BLUE}System>> {RESET}{new_filename} execution completed.")
-                    else:
-                        print(f"{RED}System>> Could not extract code properly from the response.{RESET}")
+            await offer_code_blocks(list(get_session().last_code_blocks))
     except Exception as e:
         print(f"{RED}System>> Error reading file: {str(e)}{RESET}")
         logging.error(f"Error reading file: {str(e)}")
 
-async def main() -> None:
-    """Main application function"""
+async def handle_scrape(args: str) -> None:
+    """Scrape one or more websites and ask Claude about them"""
+    try:
+        urls = parse_scrape_targets(args)
+    except OSError as e:
+        print(f"{RED}System>> Error reading URL list: {str(e)}{RESET}")
+        return
+    if not urls:
+        print(f"{RED}System>> Please specify a URL to scrape.{RESET}")
+        return
+    session = get_session()
+
+    if len(urls) == 1:
+        url = urls[0]
+        text = await scrape_website(url)
+        if session.retrieval_enabled and not text.startswith("Error scraping website"):
+            chunks, _ = document_index.add_text(url, text)
+            session.add_source(url)
+            hits = document_index.head(url)
+            await converse(
+                f"I want to learn about this website: {url}. [The start of its content was attached; ask away and more will be retrieved.]",
+                f"CONTENT ({len(hits)} of {chunks} parts):\n{format_excerpts(hits)}"
+            )
+            return
+        await converse(f"I want to learn about this website: {url}. Here is the content: {text}")
+        return
+
+    print(f"{BLUE}System>> {RESET}Scraping {len(urls)} pages...")
+    start = time.perf_counter()
+    parts = []
+    indexed = []
+    failures = 0
+    async for url, text, elapsed, error in scrape_many(urls):
+        if error:
+            failures += 1
+            print(f"{RED}System>> Failed {url} after {elapsed:.2f}s: {error}{RESET}")
+        else:
+            print(f"{BLUE}System>> {RESET}Scraped {url} in {elapsed:.2f}s ({len(text)} chars)")
+            parts.append(f"--- {url} ---\n{text}")
+            if session.retrieval_enabled:
+                document_index.add_text(url, text)
+                session.add_source(url)
+                indexed.append(url)
+    print(f"{BLUE}System>> {RESET}Scraped {len(parts)}/{len(urls)} pages in {time.perf_counter() - start:.2f}s.")
+
+    if not parts:
+        print(f"{RED}System>> No pages could be scraped.{RESET}")
+        return
+
+    if session.retrieval_enabled:
+        await converse(
+            f"I want to learn about these websites: {' '.join(indexed)}. [They were indexed; relevant excerpts will be attached to my questions.]",
+            "OPENING EXCERPTS:\n" + format_excerpts([hit for url in indexed for hit in document_index.head(url, 1)])
+        )
+        return
+
+    await converse("I want to learn about these websites. Here is the content of each page:\n\n" + "\n\n".join(parts))
+
+def show_stop_savings(turns: List[Dict[str, Any]]) -> None:
+    """Print why answers ended, and what budgets, stop sequences and cancels saved
+
+    Savings are estimates: an answer stopped early is assumed to have gone
+    on to the median length of answers that ended on their own, at the
+    median streaming rate.
+    """
+    stops = {"end_turn": 0, "stop_sequence": 0, "max_tokens": 0, "cancelled": 0}
+    early = []
+    for record in turns:
+        reason = "cancelled" if record.get("cancelled") else record.get("stop_reason")
+        if reason in stops:
+            stops[reason] += 1
+            if reason != "end_turn":
+                early.append(record.get("output_tokens", record.get("generated_tokens", 0)))
+    if not early:
+        return
+    print(f"{BLUE}System>> {RESET}  stops: " + ", ".join(f"{count} {reason}" for reason, count in stops.items() if count))
+    finished = [r["output_tokens"] for r in turns if r.get("stop_reason") == "end_turn" and "output_tokens" in r]
+    if not finished:
+        return
+    typical = Metrics.percentile(finished, 50)
+    saved = sum(max(0, typical - generated) for generated in early)
+    rates = [r["tokens_per_second"] for r in turns if r.get("tokens_per_second")]
+    line = f"  stopping early saved ~{saved} output tokens (est.)"
+    if rates:
+        line += f" and ~{saved / Metrics.percentile(rates, 50):.1f}s of generation"
+    print(f"{BLUE}System>> {RESET}{line}")
+
+def show_stats() -> None:
+    """Print latency and throughput percentiles for the current session"""
+    records = list(get_session().records)
+    summary = metrics.summary(records)
+    if not summary:
+        print(f"{BLUE}System>> {RESET}No measurements yet.")
+        return
+
+    print(f"{BLUE}System>> {RESET}Session performance:")
+    print(f"{BLUE}System>> {RESET}  {'metric':<32}{'count':>7}{'p50':>11}{'p90':>11}{'p99':>11}{'max':>11}")
+    for kind, fields in summary.items():
+        for field, stats in fields.items():
+            row = "".join(f"{stats[key]:>11.3f}" if isinstance(stats[key], float) else f"{stats[key]:>11}" for key in ("p50", "p90", "p99", "max"))
+            print(f"{BLUE}System>> {RESET}  {kind + '.' + field:<32}{stats['count']:>7}{row}")
+
+    commands = {}
+    for record in records:
+        if record["kind"] == "command":
+            commands.setdefault(record["command"], []).append(record["seconds"])
+    if commands:
+        breakdown = ", ".join(f"{name} x{len(times)} p50 {Metrics.percentile(times, 50):.2f}s" for name, times in commands.items())
+        print(f"{BLUE}System>> {RESET}  commands: {breakdown}")
+    per_model = {}
+    for record in records:
+        if record["kind"] == "turn" and "model" in record and not record.get("response_cache_hit"):
+            per_model.setdefault(record["model"], []).append(record)
+    if len(per_model) > 1:
+        for name, records in per_model.items():
+            answered = [r for r in records if not r.get("error") and not r.get("cancelled")]
+            line = f"{name}: {len(answered)} answered, {sum(bool(r.get('error')) for r in records)} failed, {sum(bool(r.get('cancelled')) for r in records)} cancelled"
+            for field, label in (("latency", "latency"), ("ttft", "first token")):
+                values = [r[field] for r in answered if field in r]
+                if values:
+                    line += f", {label} p50 {Metrics.percentile(values, 50):.2f}s p90 {Metrics.percentile(values, 90):.2f}s"
+            line += f", {sum(r.get('output_tokens', 0) for r in answered)} output tokens"
+            print(f"{BLUE}System>> {RESET}  {line}")
+    show_stop_savings([r for r in records if r["kind"] == "turn" and not r.get("response_cache_hit")])
+    shared = " (all sessions)" if get_session() is not local_session else ""
+    print(f"{BLUE}System>> {RESET}  retries{shared}: {retry_policy.total_retries}, time spent backing off: {retry_policy.total_backoff:.2f}s")
+
+def handle_cache_command(args: str) -> None:
+    """Handle 'cache stats|clear|on|off' for the local response cache"""
+    session = get_session()
+    action = args.strip().lower() or "stats"
+
+    try:
+        if action == "stats":
+            stats = response_cache.stats()
+            state = "on" if session.response_cache_enabled else "off"
+            print(f"{BLUE}System>> {RESET}Response cache is {state}: {stats['entries']} entries, {stats['bytes'] / 1024:.1f} KB, "
+                  f"{stats['stored_hits']} hits on stored entries; this session {session.cache_hits} hits, {session.cache_misses} misses.")
+        elif action == "clear" and session is not local_session:
+            print(f"{RED}System>> The response cache is shared by every session on this server; only the operator can clear it.{RESET}")
+        elif action == "clear":
+            response_cache.clear()
+            print(f"{BLUE}System>> {RESET}Response cache cleared.")
+        elif action in ["on", "off"]:
+            session.response_cache_enabled = action == "on"
+            print(f"{BLUE}System>> {RESET}Response cache turned {action}.")
+            save_config()
+        else:
+            print(f"{RED}System>> Unknown cache command. Use 'cache stats', 'cache clear', 'cache on' or 'cache off'.{RESET}")
+    except sqlite3.Error as e:
+        print(f"{RED}System>> Response cache error: {str(e)}{RESET}")
+        logging.error(f"Response cache error: {str(e)}")
+
+def handle_index_command(args: str) -> None:
+    """Handle 'index stats|clear|on|off' for the local retrieval index"""
+    session = get_session()
+    action = args.strip().lower() or "stats"
+
+    try:
+        if action == "stats":
+            stats = document_index.stats()
+            state = "on" if session.retrieval_enabled else "off"
+            print(f"{BLUE}System>> {RESET}Retrieval is {state}: {stats['documents']} documents, {stats['chunks']} chunks, "
+                  f"{stats['chars'] / 1024:.1f} KB indexed; {len(session.sources)} used this session.")
+        elif action == "clear" and session is not local_session:
+            # Other sessions' sources live in the same index
+            print(f"{RED}System>> The retrieval index is shared by every session on this server; only the operator can clear it.{RESET}")
+        elif action == "clear":
+            document_index.clear()
+            session.sources.clear()
+            print(f"{BLUE}System>> {RESET}Retrieval index cleared.")
+        elif action in ["on", "off"]:
+            session.retrieval_enabled = action == "on"
+            print(f"{BLUE}System>> {RESET}Retrieval turned {action}.")
+            save_config()
+        else:
+            print(f"{RED}System>> Unknown index command. Use 'index stats', 'index clear', 'index on' or 'index off'.{RESET}")
+    except sqlite3.Error as e:
+        print(f"{RED}System>> Retrieval index error: {str(e)}{RESET}")
+        logging.error(f"Retrieval index error: {str(e)}")
+
+def handle_multi_command(args: str) -> None:
+    """Handle 'multi [off|compare|race|draft] [model numbers]'"""
+    session = get_session()
+    parts = args.lower().replace(",", " ").split()
+    if not parts:
+        names = f"{draft_model_name()} then {models[session.model]}" if session.multi_mode == "draft" else ", ".join(multi_model_names())
+        print(f"{BLUE}System>> {RESET}Multi-model mode is {session.multi_mode}" + (f" ({names})." if session.multi_mode != "off" else "."))
+        return
+
+    mode, numbers = parts[0], parts[1:]
+    if mode not in ["off", "compare", "race", "draft"]:
+        print(f"{RED}System>> Unknown multi-model mode. Use 'multi off', 'multi compare', 'multi race' or 'multi draft'.{RESET}")
+        return
+    try:
+        chosen = [int(n) for n in numbers]
+    except ValueError:
+        print(f"{RED}System>> Model numbers must be integers between 0 and {len(models) - 1}.{RESET}")
+        return
+    if any(not 0 <= n < len(models) for n in chosen):
+        print(f"{RED}System>> Model numbers must be between 0 and {len(models) - 1}.{RESET}")
+        return
+
+    session.multi_mode = mode
+    if numbers:
+        session.multi_models = chosen
+    if mode == "off":
+        print(f"{BLUE}System>> {RESET}Multi-model mode turned off; answering with {models[session.model]}.")
+    elif mode == "draft":
+        print(f"{BLUE}System>> {RESET}Drafting with {draft_model_name()} while {models[session.model]} answers.")
+    else:
+        print(f"{BLUE}System>> {RESET}Multi-model mode set to {mode} across {', '.join(multi_model_names())}.")
+    save_config()
+
+def handle_limits_command(args: str) -> None:
+    """Handle 'limits', 'limits [command] [tokens]' and 'limits stop ["sequence" ...]'"""
+    session = get_session()
+    try:
+        parts = shlex.split(args)
+    except ValueError as e:
+        print(f"{RED}System>> Could not parse limits: {str(e)}{RESET}")
+        return
+    if not parts:
+        budgets = ", ".join(f"{name} {tokens}" for name, tokens in session.max_tokens.items())
+        stops = ", ".join(repr(s) for s in session.stop_sequences) or "none"
+        print(f"{BLUE}System>> {RESET}Output token budgets: {budgets}. Stop sequences: {stops}.")
+        return
+
+    if parts[0].lower() == "stop":
+        # Quoted arguments may use \n for a newline; with none, stop sequences are cleared
+        sequences = [part.replace("\\n", "\n") for part in parts[1:]]
+        if any(not s.strip() for s in sequences):
+            print(f"{RED}System>> Stop sequences must contain something other than whitespace.{RESET}")
+            return
+        session.stop_sequences = sequences
+        print(f"{BLUE}System>> {RESET}" + (f"Stop sequences set to {', '.join(repr(s) for s in sequences)}." if sequences else "Stop sequences cleared."))
+        save_config()
+        return
+
+    command = parts[0].lower()
+    if command not in MAX_TOKENS_BY_COMMAND or len(parts) != 2:
+        print(f"{RED}System>> Use 'limits [{'|'.join(MAX_TOKENS_BY_COMMAND)}] [tokens]' or 'limits stop \"sequence\" ...'.{RESET}")
+        return
+    try:
+        tokens = int(parts[1])
+    except ValueError:
+        tokens = 0
+    model_name = models[session.model]
+    limit = model_output_limit(model_name)
+    if not 1 <= tokens <= limit:
+        print(f"{RED}System>> The budget must be a number of tokens between 1 and {limit}, the most {model_name} can write.{RESET}")
+        return
+    session.max_tokens[command] = tokens
+    print(f"{BLUE}System>> {RESET}Answers to '{command}' now stop after {tokens} output tokens.")
+    save_config()
+
+async def handle_chat(question: str) -> None:
+    """Send a plain question and offer to save any code in the answer"""
+    attachment = None
+    session = get_session()
+    if session.retrieval_enabled and session.sources:
+        try:
+            hits = document_index.search(question, session.sources)
+        except sqlite3.Error as e:
+            hits = []
+            logging.error(f"Retrieval index error: {str(e)}")
+        if hits:
+            attachment = f"RELEVANT EXCERPTS FROM DOCUMENTS SHARED EARLIER:\n{format_excerpts(hits)}"
+    response_text = await converse(question, attachment)
+
+    if response_text:
+        await offer_code_blocks(list(get_session().last_code_blocks))
+
+class RateLimiter:
+    """Token bucket limiting how many requests start per second"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Wait until a request may start"""
+        if self.rate <= 0:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def load_batch_prompts(path: str) -> List[Dict[str, str]]:
+    """Read prompts from a JSONL or plain text file
+
+    JSON lines may use "prompt", or "title"/"body" as in requests.jsonl, with
+    an optional "id" or "request_id". Other lines are used as the prompt text.
+    """
+    prompts = []
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = line
+            if not isinstance(record, dict):
+                prompts.append({"id": str(number), "prompt": str(record)})
+                continue
+
+            text = record.get("prompt") or record.get("content")
+            if not text:
+                text = "\n\n".join(str(record[field]) for field in ("title", "body") if record.get(field))
+            prompt_id = record.get("id") or record.get("request_id") or str(number)
+            prompts.append({"id": str(prompt_id), "prompt": text})
+    return prompts
+
+def load_batch_done(path: str) -> set:
+    """IDs already answered successfully in an existing output file"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # A partial line left by a crash
+            if record.get("status") == "ok":
+                done.add(str(record.get("id")))
+    return done
+
+async def run_batch(input_path: str, output_path: str, concurrency: int = 4, rate: float = 0) -> Dict[str, float]:
+    """Answer every prompt in a file concurrently, appending results to a JSONL file as they complete"""
+    prompts = load_batch_prompts(input_path)
+    done = load_batch_done(output_path)
+    pending = [item for item in prompts if item["id"] not in done]
+    print(f"{BLUE}System>> {RESET}Batch: {len(prompts)} prompts, {len(prompts) - len(pending)} already done, {len(pending)} to run with concurrency {concurrency}.")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = RateLimiter(rate, burst=concurrency)
+    current_command.set("batch")
+    model_name = models[get_session().model]
+    totals = {"ok": 0, "error": 0, "input_tokens": 0, "output_tokens": 0}
+    start = time.perf_counter()
+
+    torn = ends_with_partial_line(output_path)
+    with open(output_path, "a", encoding="utf-8") as out:
+        if torn:
+            # End a line cut short by a crash, so the next record does not merge into it
+            out.write("\n")
+
+        async def run_one(item: Dict[str, str]) -> None:
+            async with semaphore:
+                await limiter.acquire()
+                current_turn.set(item["id"])
+                began = time.perf_counter()
+                record = {"id": item["id"], "model": model_name}
+                usage: Dict[str, Any] = {}
+                try:
+                    text, usage = await request_with_retry([{"role": "user", "content": item["prompt"]}], model_name, echo=False)
+                    record.update(status="ok", response=text, **usage)
+                    totals["input_tokens"] += usage.get("input_tokens", 0)
+                    totals["output_tokens"] += usage.get("output_tokens", 0)
+                except Exception as e:
+                    logging.error(f"Batch prompt {item['id']} failed: {str(e)}")
+                    record.update(status="error", error=str(e))
+                record["latency"] = round(time.perf_counter() - began, 3)
+                totals[record["status"]] += 1
+                metrics.record("turn", model=model_name, latency=record["latency"], error=int(record["status"] == "error"), **usage)
+
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                color = BLUE if record["status"] == "ok" else RED
+                print(f"{color}System>> {RESET}[{totals['ok'] + totals['error']}/{len(pending)}] {item['id']}: {record['status']} in {record['latency']:.2f}s")
+
+        await asyncio.gather(*(run_one(item) for item in pending))
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    totals["seconds"] = elapsed
+    print(f"{BLUE}System>> {RESET}Batch finished: {totals['ok']} ok, {totals['error']} failed in {elapsed:.2f}s "
+          f"({(totals['ok'] + totals['error']) / elapsed:.2f} requests/s, {totals['output_tokens'] / elapsed:.1f} output tokens/s).")
+    show_stats()
+    return totals
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Command line options; without --batch or --serve the interactive console starts"""
+    parser = argparse.ArgumentParser(description="Claude In The Console")
+    parser.add_argument("--batch", metavar="PROMPTS", help="answer every prompt in a JSONL/text file non-interactively")
+    parser.add_argument("--output", metavar="RESULTS", help="JSONL file results are appended to (default: PROMPTS.results.jsonl)")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight at once (default: 4)")
+    parser.add_argument("--rate", type=float, default=0, help="maximum requests started per second (default: unlimited)")
+    parser.add_argument("--metrics-jsonl", metavar="PATH", help="append every timing record to a JSONL file")
+    parser.add_argument("--metrics-prom", metavar="PATH", help="keep a Prometheus textfile-collector summary up to date")
+    parser.add_argument("--log-level", choices=["debug", "info", "warning", "error"], default="info", help="level written to claude_console.log (default: info)")
+    parser.add_argument("--log-token-sample", type=int, default=LOG_TOKEN_SAMPLE, metavar="N",
+                        help=f"with --log-level debug, log every Nth streamed chunk; 0 disables (default: {LOG_TOKEN_SAMPLE})")
+    parser.add_argument("--serve", metavar="ADDRESS", nargs="?", const=SERVER_SOCKET,
+                        help=f"serve sessions to several users on a Unix socket path, or on [HOST:]PORT with an access token (default: {SERVER_SOCKET})")
+    parser.add_argument("--allow-exec", action="store_true", help="with --serve, let sessions run the Python files they write")
+    parser.add_argument("--max-sessions", type=int, default=SERVER_MAX_SESSIONS, help=f"with --serve, connections served at once (default: {SERVER_MAX_SESSIONS})")
+    parser.add_argument("--max-requests", type=int, default=SERVER_MAX_REQUESTS, help=f"with --serve, API requests in flight across all sessions (default: {SERVER_MAX_REQUESTS})")
+    parser.add_argument("--session-requests", type=int, default=SERVER_SESSION_REQUESTS, help=f"with --serve, API requests in flight per session (default: {SERVER_SESSION_REQUESTS})")
+    return parser.parse_args(argv)
+
+async def run_session(session: Session) -> None:
+    """Read and run one session's commands until it exits; the session must be the current one"""
     menu()
     load_config()
     done = False
 
+    # Conversation commands run as tasks so the next command can be typed while Claude answers
+    turns = session.turns
+    journal = session.journal
+
     while not done:
-        question = input("User>> ")
+        try:
+            question = await ainput("User>> ")
+        except EOFError:
+            question = "exit"
+            if session.output is not None:
+                await turns.shutdown()  # the client has gone, so nobody is left to read the answers
 
         # Split command and arguments
         parts = question.strip().split(maxsplit=1)
@@ -434,10 +3325,11 @@ async def main() -> None:
         args = parts[1] if len(parts) > 1 else ""
 
         if command in ["exit", "quit", "bye"]:
-            save_choice = input(f"{BLUE}System>> {RESET}Do you want to save this conversation before exiting? (y/n): ")
-            if save_choice.lower() == "y":
-                filename = input(f"{BLUE}System>> {RESET}Enter filename (or press Enter for default): ")
-                save_conversation(filename if filename else None)
+            # Scripted sessions queue their questions and then exit; their answers still arrive ('cancel' or Ctrl-C stops them)
+            await turns.drain()
+            if journal.session_id is not None:
+                print(f"{BLUE}System>> {RESET}Conversation saved as session {journal.session_id} ('load {journal.session_id}' to resume).")
+            journal.close()
             print(f"{BLUE}System>> {RESET}Goodbye!")
             done = True
         elif command in ["menu", "help", "cmd"]:
@@ -445,112 +3337,227 @@ async def main() -> None:
         elif command in ["clear", "cls"]:
             clear_screen()
             menu()
+        elif command == "cancel":
+            if not turns.interrupt():
+                print(f"{BLUE}System>> {RESET}Nothing to cancel.")
         elif command == "cd":
-            print(f"{BLUE}System>> {RESET}Current directory: {os.getcwd()}")
+            print(f"{BLUE}System>> {RESET}Current directory: {session.workdir or os.getcwd()}")
         elif command in ["settings", "config"]:
-            config_choice = input(f"{BLUE}System>> {RESET}What would you like to change? (m)odel, (p)rompt, (s)peed, or (e)xit: ").lower()
-            config(config_choice)
+            config_choice = (await ainput(f"{BLUE}System>> {RESET}What would you like to change? (m)odel, (p)rompt, (s)peed, (c)ontext, (j)ournal compression, or (e)xit: ")).lower()
+            await config(config_choice)
         elif command in ["memory", "mem"]:
-            print(f"{BLUE}System>> {RESET}Message memory size: {len(msgMemory)}")
+            print(f"{BLUE}System>> {RESET}Message memory size: {len(session.memory)} messages, ~{count_tokens(session.memory)} tokens (budget {session.context_budget})")
         elif command in ["reset"]:
-            msgMemory.clear()
+            if turns.busy(command):
+                continue
+            session.memory.clear()
+            journal.close()
+            session.sources.clear()
             print(f"{BLUE}System>> {RESET}Message memory cleared.")
         elif command in ["test", "testfile"]:
-            await handle_read_file()
+            turns.submit(handle_read_file(), "test")
         elif command == "read":
             if args:
                 # Parse the multi-parameter command: read filename [question]
                 file_parts = args.split(maxsplit=1)
                 filename = file_parts[0]
                 question = file_parts[1] if len(file_parts) > 1 else None
-                await handle_read_file(filename, question)
+                turns.submit(handle_read_file(filename, question), command)
             else:
-                await handle_read_file()
+                turns.submit(handle_read_file(), command)
+        elif command == "stats":
+            show_stats()
+        elif command == "cache":
+            handle_cache_command(args)
+        elif command == "index":
+            handle_index_command(args)
+        elif command == "multi":
+            handle_multi_command(args)
+        elif command == "limits":
+            handle_limits_command(args)
         elif command == "save":
             save_conversation(args if args else None)
         elif command == "load":
-            if args:
+            if turns.busy(command):
+                continue
+            load_parts = args.split()
+            if len(load_parts) == 2 and load_parts[1].isdigit():
+                load_conversation(load_parts[0], int(load_parts[1]))
+            elif args:
                 load_conversation(args)
             else:
-                print(f"{RED}System>> Please specify a filename to load.{RESET}")
+                print(f"{RED}System>> Please specify a session or filename to load.{RESET}")
+        elif command == "sessions":
+            list_sessions()
         elif command == "scrape":
             if args:
-                url = args
-                text = scrape_website(url)
-
-                # Add the user message to memory
-                msgMemory.append({
-                    "role": "user",
-                    "content": f"I want to learn about this website: {url}. Here is the content: {text}"
-                })
-
-                # Stream the response with retry logic
-                response_text = await stream_with_retry(
-                    messages=msgMemory,
-                    model=models[model]
-                )
-
-                # Add Claude's response to memory
-                if response_text:
-                    msgMemory.append({
-                        "role": "assistant",
-                        "content": response_text
-                    })
+                turns.submit(handle_scrape(args), command)
             else:
                 print(f"{RED}System>> Please specify a URL to scrape.{RESET}")
         elif question.strip():
-            # Add the user message to memory
-            msgMemory.append({
-                "role": "user",
-                "content": question
-            })
+            turns.submit(handle_chat(question), "chat")
 
-            # Stream the response with retry logic
-            response_text = await stream_with_retry(
-                messages=msgMemory,
-                model=models[model]
-            )
+async def main() -> None:
+    """Main application function"""
+    def interrupt() -> None:
+        """Ctrl-C cancels the response in flight instead of ending the session"""
+        if not local_session.turns.interrupt():
+            print(f"\n{BLUE}System>> {RESET}Nothing to cancel. Type 'exit' to quit.")
+            local_session.console.reprompt()
+
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGINT, interrupt)
+    except (NotImplementedError, RuntimeError):
+        pass  # Signal handlers are unavailable on Windows event loops
+
+    await run_session(local_session)
+
+class SessionOutput:
+    """Stand-in for sys.stdout that sends print() output to the current session's connection"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text: str) -> int:
+        output = get_session().output
+        if output is None:
+            return self.stream.write(text)
+        if not output.is_closing():
+            # Telnet clients expect CRLF line endings
+            output.write(text.replace("\n", "\r\n").encode("utf-8"))
+        return len(text)
+
+    def flush(self) -> None:
+        if get_session().output is None:
+            self.stream.flush()
+
+    def __getattr__(self, name: str):
+        return getattr(self.stream, name)
+
+class ConsoleServer:
+    """Serve the console to several users at once, each connection with its own Session"""
+
+    def __init__(self, max_sessions: int = SERVER_MAX_SESSIONS, session_turns: int = SERVER_SESSION_TURNS, sessions_dir: str = SERVER_SESSIONS_DIR,
+                 token: Optional[str] = None, allow_exec: bool = False):
+        self.max_sessions = max_sessions
+        self.session_turns = session_turns
+        self.sessions_dir = sessions_dir
+        # Line a client must send before anything else; None when the socket's permissions decide who connects
+        self.token = token
+        self.allow_exec = allow_exec
+        self.sessions = set()
+        self.connections = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Run one connection's session until the client exits or disconnects"""
+        peer = writer.get_extra_info("peername")
+        peer = f"{peer[0]}:{peer[1]}" if isinstance(peer, tuple) else "local socket"
+        if len(self.sessions) >= self.max_sessions:
+            writer.write(f"{RED}System>> The server is full ({self.max_sessions} sessions). Try again later.{RESET}\r\n".encode("utf-8"))
+            writer.close()
+            logging.warning(f"Refused connection from {peer}: {self.max_sessions} sessions open")
+            return
+        if self.token is not None and not await self.authenticate(reader, writer):
+            writer.write(f"{RED}System>> Access denied.{RESET}\r\n".encode("utf-8"))
+            writer.close()
+            logging.warning(f"Refused connection from {peer}: wrong or missing token")
+            return
+
+        self.connections += 1
+        session = Session(f"client-{self.connections}", ConnectionInput(reader), writer, config_file=None, max_turns=self.session_turns)
+        # Files and journals of one connection are kept apart from every other's; without
+        # authentication there is no user to tie them to, so a new connection starts empty
+        root = os.path.abspath(os.path.join(self.sessions_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{session.name}-{os.urandom(3).hex()}"))
+        session.workdir = os.path.realpath(os.path.join(root, "work"))
+        os.makedirs(session.workdir)
+        session.journal = SessionJournal(os.path.join(root, "journal"))
+        session.allow_exec = self.allow_exec
+        self.sessions.add(session)
+        print(f"{BLUE}System>> {RESET}{session.name} connected from {peer} ({len(self.sessions)} sessions open).")
+        logging.info(f"{session.name} connected from {peer}")
+        token = current_session.set(session)
+        try:
+            await run_session(session)
+        except ConnectionError:
+            pass
+        finally:
+            await session.turns.shutdown()
+            session.journal.close()
+            session.console.stop()
+            current_session.reset(token)
+            self.sessions.discard(session)
+            writer.close()
+            print(f"{BLUE}System>> {RESET}{session.name} disconnected ({len(self.sessions)} sessions open).")
+            logging.info(f"{session.name} disconnected")
+
+    async def authenticate(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        """Ask for the access token and check the first line the client sends"""
+        writer.write(b"Token: ")
+        try:
+            line = await asyncio.wait_for(reader.readline(), SERVER_AUTH_TIMEOUT)
+        except (asyncio.TimeoutError, ValueError, ConnectionError):
+            return False
+        return hmac.compare_digest(line.strip(), self.token.encode("utf-8"))
+
+async def serve(address: str = SERVER_SOCKET, max_sessions: int = SERVER_MAX_SESSIONS, max_requests: int = SERVER_MAX_REQUESTS,
+                session_requests: int = SERVER_SESSION_REQUESTS, allow_exec: bool = False) -> None:
+    """Accept console sessions on a Unix socket path, or on "[host:]port" with a token, until interrupted"""
+    request_slots.capacity = max_requests
+    request_slots.per_session = session_requests
+    sys.stdout = SessionOutput(sys.stdout)
+    # Connections' files and journals are readable by the server's user only
+    os.makedirs(SERVER_SESSIONS_DIR, mode=0o700, exist_ok=True)
+
+    if os.sep in address:
+        console_server = ConsoleServer(max_sessions, allow_exec=allow_exec)
+        os.makedirs(os.path.dirname(os.path.abspath(address)), mode=0o700, exist_ok=True)
+        # Bind under a umask so the socket never exists with wider permissions: the owner and their group may connect
+        umask = os.umask(0o117)
+        try:
+            server = await asyncio.start_unix_server(console_server.handle, address, limit=SERVER_LINE_LIMIT)
+        finally:
+            os.umask(umask)
+        where, connect, access = address, f"nc -U {address}", ""
+    else:
+        token = os.environ.get(SERVER_TOKEN_ENV) or secrets.token_urlsafe(16)
+        console_server = ConsoleServer(max_sessions, token=token, allow_exec=allow_exec)
+        host, _, port = address.rpartition(":")
+        host = host or SERVER_HOST
+        server = await asyncio.start_server(console_server.handle, host, int(port), limit=SERVER_LINE_LIMIT)
+        where, connect = f"{host}:{port}", f"nc {host} {port}"
+        shown = f"${SERVER_TOKEN_ENV}" if os.environ.get(SERVER_TOKEN_ENV) else token
+        access = f" Clients must send the access token ({shown}) first."
+
+    running = "may run generated code" if allow_exec else "cannot run generated code (--allow-exec turns it on)"
+    print(f"{BLUE}System>> {RESET}Serving on {where}: up to {max_sessions} sessions, {max_requests} API requests at once "
+          f"({session_requests} per session); sessions {running}. Connect with '{connect}'; Ctrl-C stops the server.{access}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if os.sep in address and os.path.exists(address):
+            os.remove(address)
 
-            # Add Claude's response to memory
-            if response_text:
-                msgMemory.append({
-                    "role": "assistant",
-                    "content": response_text
-                })
-
-                # Check for code blocks and offer to save them
-                if "`" + "``" in response_text:
-                    code_data = extract_code_from_response(response_text)
-                    if code_data:
-                        write_choice = input(f"{BLUE}System>> {RESET}Detected code block in response. Do you want to write it to a file? (y/n): ")
-                
-                        if write_choice.lower() == "y":
-                            # Determine file extension
-                            code_content, language = code_data
-                            file_extension = determine_file_extension(language)
-                            default_filename = f"new_file{file_extension}"
-                
-                            print(f"{BLUE}System>> {RESET}Default filename: {default_filename}")
-                            rename_choice = input(f"{BLUE}System>> {RESET}Do you want to rename the file? (y/n): ")
-                
-                            if rename_choice.lower() == "y":
-                                custom_filename = input(f"{BLUE}System>> {RESET}Enter new filename (without extension): ")
-                                # Ensure the extension stays the same
-                                new_filename = f"{custom_filename}{file_extension}"
-                            else:
-                                new_filename = default_filename
-                
-                            with open(new_filename, "w", encoding="utf-8") as f:
-                                f.write(code_content)
-                            print(f"{BLUE}System>> {RESET}{new_filename} created.")
-                
-                            # Ask about running the file if it's a Python file
-                            if file_extension == ".py":
-                                run_choice = input(f"{BLUE}System>> {RESET}Would you like to run {new_filename}? (y/n): ")
-                                if run_choice.lower() == "y":
-                                    print(f"{BLUE}System>> {RESET}Running {new_filename}...")
-                                    output = runPyFile(new_filename)
-                                    print(output)
-                                    print(f"{BLUE}System>> {RESET}{new_filename} execution completed.")
 if __name__ == "__main__":
-    asyncio.run(main())
+    cli_args = parse_args()
+    metrics.jsonl_path = cli_args.metrics_jsonl
+    metrics.prom_path = cli_args.metrics_prom
+    if cli_args.log_level != "info" or cli_args.log_token_sample != LOG_TOKEN_SAMPLE:
+        setup_logging(level=getattr(logging, cli_args.log_level.upper()), token_sample=cli_args.log_token_sample)
+    if cli_args.batch:
+        load_config()
+        asyncio.run(run_batch(
+            cli_args.batch,
+            cli_args.output or os.path.splitext(cli_args.batch)[0] + ".results.jsonl",
+            concurrency=max(cli_args.concurrency, 1),
+            rate=cli_args.rate
+        ))
+    elif cli_args.serve:
+        try:
+            asyncio.run(serve(cli_args.serve, max(cli_args.max_sessions, 1), max(cli_args.max_requests, 1), max(cli_args.session_requests, 1),
+                              cli_args.allow_exec))
+        except KeyboardInterrupt:
+            pass
+    else:
+        asyncio.run(main())
+    metrics.flush()
@@ -0,0 +1,286 @@
+import argparse
+import http.server
+import json
+import random
+import socket
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+# Words the mock answers are made of; answer i is WORDS repeated and numbered so continuations can be checked
+WORDS = ["streaming", "tokens", "from", "the", "local", "mock", "server", "arrive", "at", "a", "configured", "rate"]
+
+class MockSettings:
+    """Behaviour of the mock server: pacing, answer length and injected failures"""
+
+    def __init__(self, tokens_per_second: float = 50, burst: int = 1, jitter: float = 0.0, ttft: float = 0.2,
+                 prefill_per_mb: float = 0.0, output_tokens: int = 200, rate_limit_rate: float = 0.0,
+                 overload_rate: float = 0.0, stream_error_rate: float = 0.0, disconnect_rate: float = 0.0,
+                 retry_after: float = 1.0, seed: Optional[int] = None):
+        self.tokens_per_second = tokens_per_second
+        self.burst = max(1, burst)  # tokens sent per network write
+        self.jitter = jitter  # 0..1, random variation of the gap between writes
+        self.ttft = ttft  # seconds before message_start
+        self.prefill_per_mb = prefill_per_mb  # extra seconds before message_start per MB of request
+        self.output_tokens = output_tokens
+        self.rate_limit_rate = rate_limit_rate  # share of requests answered with 429
+        self.overload_rate = overload_rate  # share of requests answered with 529
+        self.stream_error_rate = stream_error_rate  # share of streams ending in an overloaded_error event
+        self.disconnect_rate = disconnect_rate  # share of streams cut off mid-answer
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def roll(self, rate: float) -> bool:
+        """True with the given probability"""
+        with self.lock:
+            return self.random.random() < rate
+
+    def cut_point(self, tokens: int) -> int:
+        """Token after which a failing stream stops"""
+        with self.lock:
+            return self.random.randint(0, max(tokens - 1, 0))
+
+    def gap(self) -> float:
+        """Seconds between writes"""
+        base = self.burst / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+        if not self.jitter:
+            return base
+        with self.lock:
+            return max(0.0, base * (1 + self.jitter * (2 * self.random.random() - 1)))
+
+class MockStats:
+    """Counters of what the server did, for checking benchmark runs"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts: Dict[str, int] = {}
+        self.times: Dict[str, float] = {}  # perf_counter of the latest event of each kind
+
+    def add(self, name: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+            self.times[name] = time.perf_counter()
+
+def answer_tokens(count: int) -> List[str]:
+    """The full answer as a list of tokens, each a word followed by a space"""
+    return [f"{WORDS[i % len(WORDS)]}{i} " for i in range(count)]
+
+def continuation(tokens: List[str], prefill: str) -> List[str]:
+    """Tokens still to send after an assistant prefill; the first one repeats the trimmed whitespace"""
+    done = len(prefill.split())
+    rest = tokens[done:]
+    if rest and prefill and not prefill[-1].isspace():
+        rest[0] = " " + rest[0]
+    return rest
+
+def apply_stop_sequences(tokens: List[str], stop_sequences: List[str]) -> Tuple[List[str], Optional[str]]:
+    """Tokens up to the first stop sequence, which is left out, and the sequence that matched"""
+    text = "".join(tokens)
+    matches = [(text.find(sequence), sequence) for sequence in stop_sequences if sequence in text]
+    if not matches:
+        return tokens, None
+    end, sequence = min(matches)
+    kept, length = [], 0
+    for token in tokens:
+        if length + len(token) > end:
+            if end > length:
+                kept.append(token[:end - length])
+            break
+        kept.append(token)
+        length += len(token)
+    return kept, sequence
+
+def content_text(content: Any) -> str:
+    """Text of a message content given as a string or a list of blocks"""
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content if isinstance(block, dict))
+
+class MockAnthropicHandler(http.server.BaseHTTPRequestHandler):
+    """Answers POST /v1/messages with a Messages API event stream"""
+
+    protocol_version = "HTTP/1.1"  # chunked responses, so a cut-off stream is detectable
+    settings = MockSettings()
+    stats = MockStats()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if self.path.split("?")[0] != "/v1/messages":
+            self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": "Not found"}})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length)
+        try:
+            body = json.loads(raw)
+        except ValueError:
+            self.send_json(400, {"type": "error", "error": {"type": "invalid_request_error", "message": "Invalid JSON"}})
+            return
+
+        settings = self.settings
+        self.stats.add("requests")
+        if settings.roll(settings.rate_limit_rate):
+            self.stats.add("rate_limited")
+            self.send_json(429, {"type": "error", "error": {"type": "rate_limit_error", "message": "Mock rate limit"}},
+                           {"retry-after": str(settings.retry_after)})
+            return
+        if settings.roll(settings.overload_rate):
+            self.stats.add("overloaded")
+            self.send_json(529, {"type": "error", "error": {"type": "overloaded_error", "message": "Mock overload"}})
+            return
+
+        messages = body.get("messages", [])
+        tokens = answer_tokens(settings.output_tokens)
+        if messages and messages[-1].get("role") == "assistant":
+            tokens = continuation(tokens, content_text(messages[-1].get("content", "")))
+        tokens, stop_sequence = apply_stop_sequences(tokens, body.get("stop_sequences") or [])
+        stop_reason = "stop_sequence" if stop_sequence else "end_turn"
+        max_tokens = body.get("max_tokens", len(tokens))
+        if len(tokens) > max_tokens:
+            tokens, stop_reason, stop_sequence = tokens[:max_tokens], "max_tokens", None
+        input_tokens = len(raw) // 4
+
+        if not body.get("stream"):
+            time.sleep(settings.ttft + settings.prefill_per_mb * len(raw) / 1e6)
+            self.stats.add("completed")
+            self.send_json(200, self.message(body, input_tokens, "".join(tokens), len(tokens), stop_reason, stop_sequence))
+            return
+        self.stream(body, input_tokens, tokens, len(raw), stop_reason, stop_sequence)
+
+    def message(self, body: Dict[str, Any], input_tokens: int, text: str, output_tokens: int,
+                stop_reason: Optional[str], stop_sequence: Optional[str] = None) -> Dict[str, Any]:
+        """A Messages API message object"""
+        return {
+            "id": f"msg_mock_{int(time.time() * 1000)}", "type": "message", "role": "assistant",
+            "model": body.get("model", "mock"), "content": [{"type": "text", "text": text}] if text else [],
+            "stop_reason": stop_reason, "stop_sequence": stop_sequence,
+            "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                      "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+        }
+
+    def send_json(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        """Send a complete JSON response"""
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunk(self, data: str) -> None:
+        """Write one HTTP chunk"""
+        encoded = data.encode("utf-8")
+        self.wfile.write(f"{len(encoded):x}\r\n".encode("ascii") + encoded + b"\r\n")
+        self.wfile.flush()
+
+    @staticmethod
+    def event(name: str, payload: Dict[str, Any]) -> str:
+        """One Server-Sent Event"""
+        return f"event: {name}\ndata: {json.dumps(payload)}\n\n"
+
+    def stream(self, body: Dict[str, Any], input_tokens: int, tokens: List[str], request_bytes: int,
+               stop_reason: str = "end_turn", stop_sequence: Optional[str] = None) -> None:
+        """Send the answer as message_start, text deltas, message_delta and message_stop events
+
+        A client that closes the connection mid-answer is counted in
+        client_closed, and the tokens it spared the server in tokens_unsent.
+        """
+        settings = self.settings
+        disconnect = settings.roll(settings.disconnect_rate)
+        stream_error = not disconnect and settings.roll(settings.stream_error_rate)
+        cut = settings.cut_point(len(tokens)) if disconnect or stream_error else None
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        time.sleep(settings.ttft + settings.prefill_per_mb * request_bytes / 1e6)
+        start = self.message(body, input_tokens, "", 1, None)
+        sent = 0
+        try:
+            self.send_chunk(
+                self.event("message_start", {"type": "message_start", "message": start})
+                + self.event("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+                + self.event("ping", {"type": "ping"})
+            )
+            while sent < len(tokens):
+                if cut is not None and sent >= cut:
+                    break
+                group = tokens[sent:sent + settings.burst]
+                self.send_chunk("".join(
+                    self.event("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": token}})
+                    for token in group
+                ))
+                sent += len(group)
+                if sent < len(tokens):
+                    time.sleep(settings.gap())
+        except (BrokenPipeError, ConnectionResetError):
+            self.stats.add("client_closed")
+            self.stats.add("tokens_unsent", len(tokens) - sent)
+            self.close_connection = True
+            return
+
+        if disconnect:
+            self.stats.add("disconnects")
+            # Drop the connection without the terminating chunk
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = True
+            return
+        if stream_error:
+            self.stats.add("stream_errors")
+            self.send_chunk(self.event("error", {"type": "error", "error": {"type": "overloaded_error", "message": "Mock overload"}}))
+            self.send_chunk("")
+            return
+
+        self.stats.add("completed")
+        self.send_chunk(
+            self.event("content_block_stop", {"type": "content_block_stop", "index": 0})
+            + self.event("message_delta", {"type": "message_delta", "delta": {"stop_reason": stop_reason, "stop_sequence": stop_sequence},
+                                           "usage": {"output_tokens": len(tokens)}})
+            + self.event("message_stop", {"type": "message_stop"})
+        )
+        self.send_chunk("")
+
+def start_mock_server(settings: MockSettings, host: str = "127.0.0.1", port: int = 0) -> Tuple[http.server.ThreadingHTTPServer, str]:
+    """Serve the mock API from a background thread; returns the server and its base URL"""
+    handler = type("Handler", (MockAnthropicHandler,), {"settings": settings, "stats": MockStats()})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Command line options mirroring MockSettings"""
+    parser = argparse.ArgumentParser(description="Local mock of the Anthropic Messages streaming API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--burst", type=int, default=1, help="tokens per network write")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random variation of write gaps, 0..1")
+    parser.add_argument("--ttft", type=float, default=0.2, help="seconds before the first event")
+    parser.add_argument("--prefill-per-mb", type=float, default=0.0, help="extra seconds before the first event per MB of request")
+    parser.add_argument("--output-tokens", type=int, default=200)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--overload-rate", type=float, default=0.0, help="share of requests answered with 529")
+    parser.add_argument("--stream-error-rate", type=float, default=0.0, help="share of streams ending in an overloaded_error event")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="share of streams cut off mid-answer")
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--seed", type=int)
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    options = vars(args)
+    host, port = options.pop("host"), options.pop("port")
+    server, url = start_mock_server(MockSettings(**options), host, port)
+    print(f"Mock Anthropic API on {url} (set ANTHROPIC_BASE_URL={url} and any ANTHROPIC_API_KEY)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,349 @@
+import asyncio
+import http.server
+import json
+import os
+import random
+import threading
+from types import SimpleNamespace
+from typing import List
+
+import pytest
+
+import claude
+
+ANSWER = (
+    "Here is the script:\n"
+    "```python\n"
+    "print('hello')\n"
+    "\n"
+    "for i in range(3):\n"
+    "    print(i)\n"
+    "```\n"
+    "And the config, fenced with tildes:\n"
+    "~~~~ yaml\n"
+    "key: value\n"
+    "```not a fence inside a tilde block```\n"
+    "~~~~\n"
+    "A block without a language:\n"
+    "```\n"
+    "plain text\n"
+    "```\n"
+)
+
+def split_randomly(text: str, rng: random.Random) -> List[str]:
+    """text cut at random points into chunks of 1 to 12 characters"""
+    chunks, start = [], 0
+    while start < len(text):
+        end = start + rng.randint(1, 12)
+        chunks.append(text[start:end])
+        start = end
+    return chunks
+
+def parse(chunks: List[str]) -> List[claude.CodeBlock]:
+    parser = claude.CodeBlockParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+    return parser.blocks
+
+def describe(blocks: List[claude.CodeBlock]):
+    return [(block.language, block.code, block.complete) for block in blocks]
+
+EXPECTED = [
+    ("python", "print('hello')\n\nfor i in range(3):\n    print(i)\n", True),
+    ("yaml", "key: value\n```not a fence inside a tilde block```\n", True),
+    ("", "plain text\n", True),
+]
+
+def test_whole_answer():
+    assert describe(parse([ANSWER])) == EXPECTED
+
+def test_one_character_chunks():
+    assert describe(parse(list(ANSWER))) == EXPECTED
+
+@pytest.mark.parametrize("seed", range(50))
+def test_random_chunk_splits(seed):
+    assert describe(parse(split_randomly(ANSWER, random.Random(seed)))) == EXPECTED
+
+def test_unterminated_block_is_kept_incomplete():
+    text = "Start:\n```js\nconsole.log(1);\nconsole.log(2);"
+    for chunks in ([text], list(text), split_randomly(text, random.Random(1))):
+        assert describe(parse(chunks)) == [("js", "console.log(1);\nconsole.log(2);\n", False)]
+
+def test_shorter_fence_does_not_close_a_longer_one():
+    text = "````markdown\n```python\nx = 1\n```\n````\n"
+    assert describe(parse(list(text))) == [("markdown", "```python\nx = 1\n```\n", True)]
+
+def test_blocks_are_published_as_their_fence_closes():
+    published = []
+    parser = claude.CodeBlockParser(on_block=published.append)
+    parser.feed("```python\nx = 1\n")
+    assert published == []
+    parser.feed("```\nmore prose")
+    assert describe(published) == [("python", "x = 1\n", True)]
+    parser.close()
+    assert len(published) == 1
+
+class ScriptedStream:
+    """One streaming attempt: text events, then either the closing events or an error"""
+
+    def __init__(self, chunks: List[str], error: Exception = None):
+        self.chunks = chunks
+        self.error = error
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def close(self):
+        pass
+
+    async def __aiter__(self):
+        usage = SimpleNamespace(input_tokens=10, output_tokens=1)
+        yield SimpleNamespace(type="message_start", message=SimpleNamespace(usage=usage))
+        for chunk in self.chunks:
+            await asyncio.sleep(0)
+            yield SimpleNamespace(type="text", text=chunk)
+        if self.error:
+            raise self.error
+        yield SimpleNamespace(type="message_delta", delta=SimpleNamespace(stop_reason="end_turn", stop_sequence=None),
+                              usage=SimpleNamespace(output_tokens=len(self.chunks)))
+        yield SimpleNamespace(type="message_stop")
+
+class ScriptedClient:
+    """Stands in for client.messages, handing out one scripted stream per request"""
+
+    def __init__(self, streams: List[ScriptedStream]):
+        self.streams = streams
+        self.requests = []
+        self.messages = self
+
+    def stream(self, **kwargs) -> ScriptedStream:
+        self.requests.append(kwargs)
+        return self.streams[len(self.requests) - 1]
+
+@pytest.fixture
+def scripted(monkeypatch):
+    """Install a scripted client, retrying at once and displaying without delay"""
+    def install(streams: List[ScriptedStream]) -> ScriptedClient:
+        client = ScriptedClient(streams)
+        monkeypatch.setattr(claude, "client", client)
+        monkeypatch.setattr(claude, "retry_policy", claude.RetryPolicy(base_delay=0, max_delay=0))
+        monkeypatch.setattr(claude.local_session, "speed", 0)
+        return client
+    return install
+
+def test_retry_continues_a_block_cut_off_mid_answer(scripted):
+    # The first attempt breaks off after a newline; the prefill drops it and the continuation repeats it
+    first = "Code:\n```python\nx = 1\n"
+    client = scripted([
+        ScriptedStream(split_randomly(first, random.Random(2)), ConnectionResetError("reset")),
+        ScriptedStream(["\ny", " = 2\n", "``", "`\nDone."]),
+    ])
+    state = claude.StreamState()
+    text, usage = asyncio.run(claude.request_with_retry([{"role": "user", "content": "hi"}], "fake", echo=False, state=state))
+
+    assert client.requests[1]["messages"][-1] == {"role": "assistant", "content": first.rstrip()}
+    assert text == "Code:\n```python\nx = 1\ny = 2\n```\nDone."
+    assert usage["attempts"] == 2
+    assert describe(state.code.blocks) == [("python", "x = 1\ny = 2\n", True)]
+
+def test_retry_without_repeated_whitespace(scripted):
+    # A continuation may also start straight after the trimmed prefill; the whitespace already received is kept
+    scripted([
+        ScriptedStream(["```python\nx = 1\n"], ConnectionResetError("reset")),
+        ScriptedStream(["y = 2\n```\n"]),
+    ])
+    state = claude.StreamState()
+    text, _ = asyncio.run(claude.request_with_retry([{"role": "user", "content": "hi"}], "fake", echo=False, state=state))
+    assert text == "```python\nx = 1\ny = 2\n```\n"
+    assert describe(state.code.blocks) == [("python", "x = 1\ny = 2\n", True)]
+
+def test_echoed_answer_publishes_blocks_before_it_ends(scripted):
+    seen = []
+
+    class WatchedStream(ScriptedStream):
+        async def __aiter__(self):
+            async for event in super().__aiter__():
+                if event.type == "message_delta":
+                    # The stream has not finished yet, but the closed block is already available
+                    seen.extend(describe(claude.local_session.last_code_blocks))
+                yield event
+
+    scripted([WatchedStream(["```sh\nls\n```\n", "still streaming"])])
+    asyncio.run(claude.request_with_retry([{"role": "user", "content": "hi"}], "fake"))
+    assert seen == [("sh", "ls\n", True)]
+    assert describe(claude.local_session.last_code_blocks) == [("sh", "ls\n", True)]
+
+def test_cancel_while_painting_keeps_the_reply(scripted, monkeypatch, tmp_path):
+    scripted([ScriptedStream([f"word{i} " for i in range(100)])])
+    monkeypatch.setattr(claude.local_session, "speed", 0.05)
+    monkeypatch.setattr(claude.local_session, "response_cache_enabled", False)
+    monkeypatch.setattr(claude.local_session, "memory", [])
+    monkeypatch.setattr(claude.local_session, "journal", claude.SessionJournal(str(tmp_path)))
+
+    async def run():
+        turns = claude.TurnScheduler()
+        task = turns.submit(claude.converse("hi"), "chat")
+        # The stream ends at once; painting 100 chunks at this speed takes 5 s
+        await asyncio.sleep(0.3)
+        assert turns.interrupt()
+        await task
+
+    asyncio.run(run())
+    assert claude.local_session.memory == [
+        {"role": "user", "content": "hi"},
+        {"role": "assistant", "content": "".join(f"word{i} " for i in range(100))},
+    ]
+
+def test_server_sessions_write_but_do_not_run_code(monkeypatch, tmp_path):
+    answers = iter(["y", "n"])  # write the block, keep the default name
+
+    async def ainput(prompt=""):
+        return next(answers)
+
+    async def run_file(path):
+        raise AssertionError("generated code ran without --allow-exec")
+
+    monkeypatch.setattr(claude, "ainput", ainput)
+    monkeypatch.setattr(claude, "runPyFile", run_file)
+    session = claude.Session("client-1", config_file=None)
+    session.workdir = str(tmp_path)
+    session.allow_exec = claude.ConsoleServer().allow_exec
+    token = claude.current_session.set(session)
+    try:
+        asyncio.run(claude.offer_code_blocks([claude.CodeBlock("python", "print(1)\n", True)]))
+    finally:
+        claude.current_session.reset(token)
+    assert (tmp_path / "new_file.py").read_text() == "print(1)\n"
+
+def test_server_sessions_cannot_clear_shared_stores(monkeypatch):
+    cleared = []
+    monkeypatch.setattr(claude.response_cache, "clear", lambda: cleared.append("cache"))
+    monkeypatch.setattr(claude.document_index, "clear", lambda: cleared.append("index"))
+    token = claude.current_session.set(claude.Session("client-1", config_file=None))
+    try:
+        claude.handle_cache_command("clear")
+        claude.handle_index_command("clear")
+    finally:
+        claude.current_session.reset(token)
+    assert cleared == []
+    claude.handle_cache_command("clear")
+    claude.handle_index_command("clear")
+    assert cleared == ["cache", "index"]
+
+def test_load_tells_journals_from_old_json_by_content(tmp_path):
+    session = claude.Session("client-1", config_file=None)
+    session.workdir = str(tmp_path)
+    session.journal = claude.SessionJournal(str(tmp_path / "journal"))
+    exchange = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]
+    (tmp_path / "old.json").write_text(json.dumps(exchange))
+    token = claude.current_session.set(session)
+    try:
+        session.journal.append(exchange)
+        claude.save_conversation("conv.json")
+        session.memory.clear()
+        claude.load_conversation("conv.json")
+        assert session.memory == exchange
+        session.memory.clear()
+        claude.load_conversation("old.json")
+        assert session.memory == exchange
+    finally:
+        session.journal.close()
+        claude.current_session.reset(token)
+
+def test_budgets_are_capped_at_the_model_output_limit(scripted, monkeypatch):
+    monkeypatch.setitem(claude.local_session.max_tokens, "chat", 20000)
+    client = scripted([ScriptedStream(["a"]), ScriptedStream(["b"])])
+    for model in ("claude-3-5-haiku-latest", "claude-3-7-sonnet-20250219"):
+        asyncio.run(claude.request_with_retry([{"role": "user", "content": "hi"}], model, echo=False))
+    assert [request["max_tokens"] for request in client.requests] == [8192, 20000]
+
+class PageHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in web server: one page with an ETag, answering 304 when the client already has it"""
+
+    body = "<html><body>first version</body></html>"
+    etag = '"v1"'
+    requests = []
+
+    def do_GET(self):
+        type(self).requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.send_header("ETag", self.etag)
+            self.end_headers()
+            return
+        encoded = self.body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.send_header("ETag", self.etag)
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def page(monkeypatch):
+    """URL of a page on a local server, whose handler class exposes the requests it received"""
+    monkeypatch.setattr(PageHandler, "requests", [])
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/page.html"
+    server.shutdown()
+    server.server_close()
+
+def test_fresh_pages_are_served_from_the_cache(page, tmp_path):
+    fetcher = claude.WebFetcher(claude.FetchCache(str(tmp_path)))
+    assert asyncio.run(fetcher.fetch(page)) == PageHandler.body
+    assert asyncio.run(fetcher.fetch(page)) == PageHandler.body
+    fetcher.close()
+    assert len(PageHandler.requests) == 1
+
+def age_entry(cache: claude.FetchCache, url: str, seconds: float) -> None:
+    """Move a cached page's fetch time back"""
+    entry = cache.get(url)
+    entry["fetched_at"] -= seconds
+    with open(cache._path(url), "w", encoding="utf-8") as f:
+        json.dump(entry, f)
+
+def test_stale_pages_are_revalidated_and_a_304_reuses_the_cached_body(page, tmp_path, monkeypatch):
+    cache = claude.FetchCache(str(tmp_path), ttl=60)
+    fetcher = claude.WebFetcher(cache)
+    first = asyncio.run(fetcher.fetch(page))
+
+    # Past the TTL the page is revalidated; the server answers with an empty 304
+    age_entry(cache, page, 61)
+    assert asyncio.run(fetcher.fetch(page)) == first
+    assert PageHandler.requests[-1]["If-None-Match"] == PageHandler.etag
+    # The 304 restarted the TTL, so the next fetch needs no request
+    assert asyncio.run(fetcher.fetch(page)) == first
+    assert len(PageHandler.requests) == 2
+
+    # A changed page is fetched again in full once the entry is stale
+    monkeypatch.setattr(PageHandler, "body", "<html><body>second version</body></html>")
+    monkeypatch.setattr(PageHandler, "etag", '"v2"')
+    age_entry(cache, page, 61)
+    assert asyncio.run(fetcher.fetch(page)) == PageHandler.body
+    assert cache.get(page)["etag"] == '"v2"'
+    fetcher.close()
+
+def test_eviction_keeps_the_cache_under_max_bytes(tmp_path):
+    cache = claude.FetchCache(str(tmp_path), max_bytes=10_000)
+    urls = [f"http://example.com/{i}" for i in range(10)]
+    for i, url in enumerate(urls):
+        cache.put(url, "x" * 2_000)
+        # Distinct, increasing access times, oldest first
+        os.utime(cache._path(url), (1_000_000 + i, 1_000_000 + i))
+        sizes = [entry.stat().st_size for entry in tmp_path.iterdir()]
+        assert sum(sizes) <= cache.max_bytes
+
+    os.utime(cache._path(urls[-1]), (0, 0))  # least recently used now
+    cache.put("http://example.com/new", "x" * 2_000)
+    assert sum(entry.stat().st_size for entry in tmp_path.iterdir()) <= cache.max_bytes
+    assert cache.get(urls[-1]) is None
+    assert cache.get(urls[-2]) is not None
+    assert cache.get("http://example.com/new") is not None